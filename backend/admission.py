@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import deque
+from typing import Callable, Deque, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Bytes held per decoded image byte while an image is processed: the decoded
+# array, the colour-converted copy used for face encodings, float32 noise
+# (4 bytes per sample, bounded by the image when faces fill it) and the
+# encoded output buffer.
+MEMORY_PER_IMAGE_BYTE = 7
+
+
+class AdmissionError(Exception):
+    """Raised when a request cannot be admitted under the memory and CPU budget."""
+
+    def __init__(self, message: str, retry_after: int, queue_full: bool):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.queue_full = queue_full
+
+
+def estimate_image_memory(width: int, height: int, channels: int = 3, encoded_bytes: int = 0) -> int:
+    """
+    Estimate the peak memory of processing one image.
+
+    Args:
+        width: Image width in pixels
+        height: Image height in pixels
+        channels: Samples per pixel
+        encoded_bytes: Size of the encoded upload, held during processing
+
+    Returns:
+        Estimated bytes
+    """
+    return int(width * height * channels * MEMORY_PER_IMAGE_BYTE) + encoded_bytes
+
+
+def container_memory() -> int:
+    """
+    Memory available to this process: the cgroup limit when running in a
+    container, otherwise the physical memory.
+
+    Returns:
+        Memory in bytes
+    """
+    limits = []
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit():
+            limits.append(int(value))
+    try:
+        limits.append(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"))
+    except (AttributeError, ValueError, OSError):
+        pass
+    # cgroup v1 reports an enormous number when unlimited, so the smallest value wins
+    return min(limits) if limits else 8 * 1024 ** 3
+
+
+class AdmissionController:
+    """
+    Admits requests under a global memory and CPU budget.
+
+    Every request reserves its estimated memory and one CPU slot until its
+    work in the worker pool has finished. Requests that do not fit wait in
+    FIFO order, so a large image is not starved by a stream of small ones;
+    when the wait queue is full they are rejected right away, and when they
+    wait too long they give up. A request larger than the whole memory
+    budget is admitted only while nothing else runs.
+
+    All methods must be called from the event loop.
+    """
+
+    def __init__(self, memory_budget: int, cpu_slots: int, max_waiting: int = 32, max_wait: float = 10.0):
+        """
+        Initialize the admission controller.
+
+        Args:
+            memory_budget: Bytes that running requests may reserve together
+            cpu_slots: Requests that may run at the same time
+            max_waiting: Requests allowed to wait for admission before new ones are rejected
+            max_wait: Seconds a request may wait for admission
+        """
+        self.memory_budget = memory_budget
+        self.cpu_slots = max(cpu_slots, 1)
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.memory_in_use = 0
+        self.running = 0
+        self._waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+        self._service_seconds = 1.0  # Moving average of the time a request holds its reservation
+
+    @property
+    def waiting(self) -> int:
+        """Number of requests waiting for admission."""
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        """Seconds after which a rejected request is likely to be admitted."""
+        seconds = self._service_seconds * (len(self._waiters) + 1) / self.cpu_slots
+        return min(max(int(math.ceil(seconds)), 1), 60)
+
+    def _fits(self, memory: int) -> bool:
+        if self.running == 0:
+            return True
+        return self.running < self.cpu_slots and self.memory_in_use + memory <= self.memory_budget
+
+    def _take(self, memory: int) -> Callable[[], None]:
+        self.memory_in_use += memory
+        self.running += 1
+        started = time.perf_counter()
+        released = False
+
+        def release() -> None:
+            nonlocal released
+            if released:
+                return
+            released = True
+            self.memory_in_use -= memory
+            self.running -= 1
+            self._service_seconds = 0.8 * self._service_seconds + 0.2 * (time.perf_counter() - started)
+            self._admit_waiters()
+
+        return release
+
+    def _admit_waiters(self) -> None:
+        while self._waiters and self._fits(self._waiters[0][0]):
+            memory, future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(self._take(memory))
+
+    async def acquire(self, memory: int) -> Callable[[], None]:
+        """
+        Reserve memory and a CPU slot, waiting for them if needed.
+
+        Args:
+            memory: Estimated bytes the request will hold
+
+        Returns:
+            Function releasing the reservation; safe to call more than once
+
+        Raises:
+            AdmissionError: If the wait queue is full or the wait timed out
+        """
+        if not self._waiters and self._fits(memory):
+            return self._take(memory)
+        if len(self._waiters) >= self.max_waiting:
+            raise AdmissionError("Server is busy, please retry shortly", self.retry_after(), queue_full=True)
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (memory, future)
+        self._waiters.append(entry)
+        try:
+            return await asyncio.wait_for(future, self.max_wait)
+        except BaseException as e:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # Admitted just as the wait ended
+                future.result()()
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                # A large request at the head may have been holding back smaller ones
+                self._admit_waiters()
+            if isinstance(e, asyncio.TimeoutError):
+                raise AdmissionError("Server is overloaded, please retry later", self.retry_after(),
+                                     queue_full=False)
+            raise
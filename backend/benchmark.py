@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for the InvisiFace cloaking pipeline.
+
+Drives a FaceCloaker configured like the server's workers (and optionally
+the FastAPI app in-process) on synthetic and fixture images, reporting
+per-stage latency, throughput and peak RSS. Results are written as JSON so
+runs from different commits can be compared:
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+
+With --detectors, the face detection backends are compared on real photos
+instead, and the most accurate one within a latency budget is recommended:
+
+    python benchmark.py --fixtures ~/photos --detectors hog yunet dnn \
+        --yunet-model face_detection_yunet_2023mar.onnx --max-detect-ms 50
+"""
+
+import argparse
+import glob
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+import config
+from detectors import create_detector
+from face_cloaker import FaceCloaker, _box_iou
+from image_io import decode_image, encode_image
+from workers import create_cloaker
+
+STAGES = ["decode", "detect", "encode", "noise", "apply", "serialize"]
+
+DEFAULT_RESOLUTIONS = ["640x480", "1920x1080", "4000x3000"]
+DEFAULT_FACE_COUNTS = [1, 4]
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in KiB elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def synthetic_image(width: int, height: int, face_count: int, seed: int = 0) -> Tuple[bytes, List[Tuple[int, int, int, int]]]:
+    """
+    Create a reproducible synthetic photo and the face boxes to cloak in it.
+
+    HOG does not find faces in synthetic content, so the boxes are laid out
+    explicitly; they drive the encode, noise and apply stages.
+
+    Args:
+        width: Image width
+        height: Image height
+        face_count: Number of face boxes to lay out
+        seed: Random seed of the image content
+
+    Returns:
+        PNG encoded image and the (top, right, bottom, left) face boxes
+    """
+    rng = np.random.default_rng(seed)
+    # Smooth gradients plus mild noise compress and decode like a photo
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack([x / width, y / height, (x + y) / (width + height)], axis=2) * 200
+    image = np.clip(base + rng.normal(0, 8, base.shape), 0, 255).astype(np.uint8)
+
+    face_size = max(min(width, height) // 5, 40)
+    columns = max(int(np.ceil(np.sqrt(face_count))), 1)
+    boxes = []
+    for index in range(face_count):
+        row, column = divmod(index, columns)
+        top = min(row * (face_size + 10) + 10, height - face_size)
+        left = min(column * (face_size + 10) + 10, width - face_size)
+        boxes.append((top, left + face_size, top + face_size, left))
+
+    buffered = io.BytesIO()
+    Image.fromarray(image).save(buffered, format="PNG", compress_level=1)
+    return buffered.getvalue(), boxes
+
+
+def fixture_images(directory: str) -> List[Tuple[str, bytes]]:
+    """Load image fixtures (real photos with faces) from a directory."""
+    paths = []
+    for pattern in ("*.jpg", "*.jpeg", "*.png", "*.webp"):
+        paths.extend(glob.glob(os.path.join(directory, pattern)))
+    fixtures = []
+    for path in sorted(paths):
+        with open(path, "rb") as f:
+            fixtures.append((os.path.basename(path), f.read()))
+    return fixtures
+
+
+def timed(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Tuple[Any, float]:
+    """Run a function and return its result and duration in milliseconds."""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """Median, p95, mean and minimum of a list of millisecond timings."""
+    ordered = sorted(samples)
+    p95_index = min(int(round(0.95 * (len(ordered) - 1))), len(ordered) - 1)
+    return {
+        "median_ms": statistics.median(ordered),
+        "p95_ms": ordered[p95_index],
+        "mean_ms": statistics.fmean(ordered),
+        "min_ms": ordered[0],
+    }
+
+
+def run_pipeline_case(cloaker: FaceCloaker, name: str, contents: bytes,
+                      boxes: Optional[List[Tuple[int, int, int, int]]], repeats: int,
+                      output_format: str, compression: Optional[int]) -> Dict[str, Any]:
+    """
+    Time every stage of the cloaking pipeline on one image.
+
+    Args:
+        cloaker: FaceCloaker under test
+        name: Case name used in the report
+        contents: Encoded input image
+        boxes: Face boxes to cloak; None uses whatever detection finds
+        repeats: Number of timed runs
+        output_format: Output format of the serialize stage
+        compression: Compression setting of the serialize stage
+
+    Returns:
+        Per-stage timing summary, throughput and peak RSS for the case
+    """
+    timings: Dict[str, List[float]] = {stage: [] for stage in STAGES + ["total"]}
+    faces_found = 0
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        image, timing = timed(decode_image, contents)
+        timings["decode"].append(timing)
+
+        faces, timing = timed(cloaker.detect_faces, image, with_encodings=False)
+        timings["detect"].append(timing)
+        faces_found = len(faces)
+        if boxes is not None:
+            faces = [{"id": i, "location": box, "encoding": None, "confidence": 0.9} for i, box in enumerate(boxes)]
+
+        _, timing = timed(cloaker.encode_faces, image, faces)
+        timings["encode"].append(timing)
+
+        regions = [image[top:bottom, left:right] for top, right, bottom, left in (f["location"] for f in faces)]
+        noises, timing = timed(cloaker.generate_adversarial_noise_batch, regions)
+        timings["noise"].append(timing)
+
+        apply_start = time.perf_counter()
+        for face_info, noise in zip(faces, noises):
+            cloaker.apply_cloaking_to_face(image, face_info, noise=noise)
+        timings["apply"].append((time.perf_counter() - apply_start) * 1000)
+
+        _, timing = timed(encode_image, image, output_format, compression)
+        timings["serialize"].append(timing)
+        timings["total"].append((time.perf_counter() - start) * 1000)
+
+    total_median = statistics.median(timings["total"])
+    return {
+        "name": name,
+        "input_bytes": len(contents),
+        "faces_cloaked": len(faces),
+        "faces_detected": faces_found,
+        "stages": {stage: summarize(samples) for stage, samples in timings.items()},
+        "throughput_images_per_s": 1000.0 / total_median if total_median else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_api_case(name: str, contents: bytes, repeats: int) -> Dict[str, Any]:
+    """
+    Time the FastAPI endpoints in-process with the test client.
+
+    The result cache is disabled so every request exercises the full pipeline.
+    """
+    # config is already loaded, so override it before main reads it
+    config.CACHE_MAX_BYTES = 0
+    from fastapi.testclient import TestClient
+    import main
+
+    timings: Dict[str, List[float]] = {"cloak_binary": [], "cloak_json": [], "check": []}
+    with TestClient(main.app) as client:
+        for _ in range(repeats):
+            for key, path in (("cloak_binary", "/api/cloak-image?response=binary"),
+                              ("cloak_json", "/api/cloak-image"),
+                              ("check", "/api/check-protection")):
+                response, timing = timed(client.post, path, files={"file": ("bench.png", contents, "image/png")})
+                response.raise_for_status()
+                timings[key].append(timing)
+
+    return {
+        "name": name,
+        "input_bytes": len(contents),
+        "endpoints": {key: summarize(samples) for key, samples in timings.items()},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def match_count(found: List[Tuple[int, int, int, int]], truth: List[Tuple[int, int, int, int]],
+                min_iou: float = 0.4) -> int:
+    """Number of true faces matched by a found box, each box matching at most one face."""
+    unmatched = list(found)
+    matched = 0
+    for box in truth:
+        best = max(unmatched, key=lambda candidate: _box_iou(candidate, box), default=None)
+        if best is not None and _box_iou(best, box) >= min_iou:
+            unmatched.remove(best)
+            matched += 1
+    return matched
+
+
+def run_detector_comparison(names: List[str], fixtures: List[Tuple[str, bytes]], args: argparse.Namespace,
+                            labels: Optional[Dict[str, List[List[int]]]]) -> Dict[str, Any]:
+    """
+    Compare face detection backends on real photos.
+
+    Args:
+        names: Detector backends to compare
+        fixtures: (filename, encoded image) pairs
+        args: Parsed command line, for repeats, proxy size and model paths
+        labels: True face boxes per filename; without them the first detector is the reference
+
+    Returns:
+        Per detector: latency per image (single and batched), recall, precision and faces found
+    """
+    images = [decode_image(contents) for _, contents in fixtures]
+    results: Dict[str, Any] = {}
+    found: Dict[str, List[List[Tuple[int, int, int, int]]]] = {}
+    for name in names:
+        model_path = {"dnn": args.dnn_model, "yunet": args.yunet_model}.get(name, "")
+        cloaker = create_cloaker()
+        cloaker.detection_max_side = args.detection_max_side or None
+        cloaker.detector = create_detector(name, model_path, args.dnn_config)
+        cloaker.detector.warm_up()
+
+        timings: List[float] = []
+        for image in images:
+            cloaker.locate_faces(image)
+            for _ in range(args.repeats):
+                faces, timing = timed(cloaker.locate_faces, image)
+                timings.append(timing)
+            found.setdefault(name, []).append([face["location"] for face in faces])
+        _, batch_timing = timed(cloaker.locate_faces_batch, images)
+
+        results[name] = {
+            "settings": cloaker.detector.settings(),
+            "detect": summarize(timings),
+            "batch_ms_per_image": batch_timing / max(len(images), 1),
+            "faces": sum(len(boxes) for boxes in found[name]),
+        }
+
+    for name in names:
+        true_positives = true_faces = 0
+        for (filename, _), reference, boxes in zip(fixtures, found[names[0]], found[name]):
+            truth = [tuple(box) for box in labels.get(filename, [])] if labels is not None else reference
+            true_positives += match_count(boxes, truth)
+            true_faces += len(truth)
+        faces = results[name]["faces"]
+        results[name]["recall"] = true_positives / true_faces if true_faces else 1.0
+        results[name]["precision"] = true_positives / faces if faces else 1.0
+    return results
+
+
+def select_detector(results: Dict[str, Any], max_detect_ms: Optional[float], min_recall: float) -> Optional[str]:
+    """
+    Pick the detector with the best recall within the latency budget, preferring the faster one on ties.
+
+    Returns:
+        Detector name, or None if no detector meets both the budget and the minimum recall
+    """
+    eligible = [
+        (result["recall"], -result["detect"]["median_ms"], name) for name, result in results.items()
+        if result["recall"] >= min_recall and (max_detect_ms is None or result["detect"]["median_ms"] <= max_detect_ms)
+    ]
+    return max(eligible)[2] if eligible else None
+
+
+def print_detector_report(results: Dict[str, Any], recommended: Optional[str]) -> None:
+    """Print a human-readable table of a detector comparison."""
+    print(f"\n{'detector':<10} {'median ms':>10} {'p95 ms':>8} {'batch ms':>9} {'faces':>6} {'recall':>7} "
+          f"{'precision':>9}")
+    for name, result in results.items():
+        print(f"{name:<10} {result['detect']['median_ms']:10.1f} {result['detect']['p95_ms']:8.1f} "
+              f"{result['batch_ms_per_image']:9.1f} {result['faces']:6d} {result['recall']:7.2f} "
+              f"{result['precision']:9.2f}")
+    if recommended:
+        print(f"\nRecommended: INVISIFACE_DETECTOR={recommended}")
+    else:
+        print("\nNo detector meets the latency budget and minimum recall")
+
+
+def git_revision() -> Optional[str]:
+    """Current git commit, if the benchmark runs inside a checkout."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """
+    Print median deltas against a baseline report.
+
+    Args:
+        current: Report of this run
+        baseline: Report of an earlier run
+        threshold: Relative slowdown (e.g. 0.1 for 10%) that counts as a regression
+
+    Returns:
+        Descriptions of the regressions found
+    """
+    regressions = []
+    baseline_cases = {case["name"]: case for case in baseline.get("pipeline", [])}
+    print(f"\nComparison against {baseline.get('revision') or 'baseline'} (median ms):")
+    for case in current.get("pipeline", []):
+        previous = baseline_cases.get(case["name"])
+        if previous is None:
+            continue
+        for stage, summary in case["stages"].items():
+            before = previous["stages"].get(stage, {}).get("median_ms")
+            after = summary["median_ms"]
+            if not before:
+                continue
+            delta = (after - before) / before
+            marker = ""
+            # Ignore sub-millisecond stages, where noise dominates
+            if delta > threshold and after - before > 1.0:
+                marker = "  <-- regression"
+                regressions.append(f"{case['name']}/{stage}: {before:.1f} -> {after:.1f} ms ({delta:+.0%})")
+            print(f"  {case['name']:<28} {stage:<10} {before:9.1f} -> {after:9.1f}  {delta:+7.1%}{marker}")
+    return regressions
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    """Print a human-readable table of a report."""
+    print(f"InvisiFace benchmark  revision={report['revision']}  cpus={report['cpu_count']}")
+    header = "  ".join(f"{stage:>9}" for stage in STAGES + ["total"])
+    print(f"\n{'case':<28} {header}  {'img/s':>7}  {'rss MB':>7}")
+    for case in report["pipeline"]:
+        medians = "  ".join(f"{case['stages'][stage]['median_ms']:9.1f}" for stage in STAGES + ["total"])
+        print(f"{case['name']:<28} {medians}  {case['throughput_images_per_s']:7.2f}  {case['peak_rss_mb']:7.0f}")
+    for case in report.get("api", []):
+        endpoints = ", ".join(f"{key} {summary['median_ms']:.1f} ms" for key, summary in case["endpoints"].items())
+        print(f"API {case['name']}: {endpoints}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the InvisiFace cloaking pipeline")
+    parser.add_argument("--resolutions", nargs="+", default=DEFAULT_RESOLUTIONS, help="Synthetic image sizes, WxH")
+    parser.add_argument("--faces", nargs="+", type=int, default=DEFAULT_FACE_COUNTS, help="Face counts per synthetic image")
+    parser.add_argument("--fixtures", help="Directory of real photos to benchmark with detected faces")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed runs per case")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed runs per case")
+    parser.add_argument("--format", default="png", help="Output format of the serialize stage")
+    parser.add_argument("--compression", type=int, default=None,
+                        help="Compression setting of the serialize stage (defaults to the server's)")
+    parser.add_argument("--detection-max-side", type=int, default=config.DETECTION_MAX_SIDE,
+                        help="Detect on a downscaled proxy (0 = full resolution; default: the server setting)")
+    parser.add_argument("--api", action="store_true", help="Also benchmark the FastAPI endpoints in-process")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument("--compare", help="Baseline JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Relative slowdown reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 on regressions")
+    parser.add_argument("--detectors", nargs="+", help="Compare these face detectors on the fixtures instead "
+                        "(the first one is the reference unless --labels is given)")
+    parser.add_argument("--labels", help="JSON file of true face boxes, {filename: [[top, right, bottom, left], ...]}")
+    parser.add_argument("--dnn-model", default=config.DETECTOR_MODEL, help="Caffe weights of the dnn detector")
+    parser.add_argument("--dnn-config", default=config.DETECTOR_CONFIG, help="prototxt of the dnn detector")
+    parser.add_argument("--yunet-model", default=config.DETECTOR_MODEL, help="ONNX model of the yunet detector")
+    parser.add_argument("--max-detect-ms", type=float, default=None, help="Latency budget of the recommended detector")
+    parser.add_argument("--min-recall", type=float, default=0.9, help="Minimum recall of the recommended detector")
+    args = parser.parse_args()
+    if args.format == "png" and args.compression is None:
+        args.compression = config.PNG_COMPRESSION
+
+    if args.detectors:
+        if not args.fixtures:
+            parser.error("--detectors needs --fixtures with real photos")
+        labels = None
+        if args.labels:
+            with open(args.labels) as f:
+                labels = json.load(f)
+        results = run_detector_comparison(args.detectors, fixture_images(args.fixtures), args, labels)
+        recommended = select_detector(results, args.max_detect_ms, args.min_recall)
+        print_detector_report(results, recommended)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"revision": git_revision(), "detectors": results, "recommended": recommended}, f, indent=2)
+            print(f"\nReport written to {args.output}")
+        return 0
+
+    cloaker = create_cloaker()
+    cloaker.detection_max_side = args.detection_max_side or None
+    warm_up = cloaker.warm_up()
+
+    cases: List[Tuple[str, bytes, Optional[List[Tuple[int, int, int, int]]]]] = []
+    for resolution in args.resolutions:
+        width, height = (int(value) for value in resolution.lower().split("x"))
+        for face_count in args.faces:
+            contents, boxes = synthetic_image(width, height, face_count)
+            cases.append((f"synthetic-{width}x{height}-{face_count}f", contents, boxes))
+    if args.fixtures:
+        for filename, contents in fixture_images(args.fixtures):
+            cases.append((f"fixture-{filename}", contents, None))
+
+    report: Dict[str, Any] = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "warm_up": warm_up,
+        "settings": {**cloaker.parameters(), "format": args.format, "compression": args.compression,
+                     "repeats": args.repeats},
+        "pipeline": [],
+    }
+
+    for name, contents, boxes in cases:
+        if args.warmup:
+            run_pipeline_case(cloaker, name, contents, boxes, args.warmup, args.format, args.compression)
+        report["pipeline"].append(
+            run_pipeline_case(cloaker, name, contents, boxes, args.repeats, args.format, args.compression)
+        )
+
+    if args.api:
+        report["api"] = [run_api_case(name, contents, args.repeats) for name, contents, _ in cases]
+
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s):")
+            for regression in regressions:
+                print(f"  {regression}")
+            if args.fail_on_regression:
+                return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
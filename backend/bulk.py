@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Offline bulk cloaking of photo archives.
+
+Walks directories (or reads a file list), cloaks every image across a pool
+of processes that each keep one warm FaceCloaker, and mirrors the input
+tree into an output directory:
+
+    python bulk.py ~/Pictures --output-dir ~/Pictures-cloaked --workers 8
+
+Every finished image is appended to a JSONL report with its faces and
+per-stage timings. The report doubles as the manifest: running the same
+command again skips images already listed as done, so an interrupted run
+resumes where it stopped.
+"""
+
+import os
+
+# One process per core already uses every core; keep the numeric libraries
+# from starting thread pools of their own in each worker.
+for _variable in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+    os.environ.setdefault(_variable, "1")
+
+import argparse
+import json
+import logging
+import multiprocessing
+import sys
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import cv2
+
+import config
+import metrics
+from image_io import file_extension, image_size, normalize_format
+from workers import cloak_large_task, cloak_task, get_cloaker
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+
+
+def find_images(inputs: List[str], file_list: Optional[str]) -> Iterator[Tuple[str, str]]:
+    """
+    Enumerate the images to cloak.
+
+    Args:
+        inputs: Directories (walked recursively) and image files
+        file_list: File with one image path per line
+
+    Yields:
+        (absolute path, path mirrored in the output directory) per image, in a stable order
+    """
+    for entry in inputs:
+        if os.path.isdir(entry):
+            for root, dirs, names in os.walk(entry):
+                dirs.sort()
+                for name in sorted(names):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        path = os.path.join(root, name)
+                        yield os.path.abspath(path), os.path.relpath(path, entry)
+        else:
+            yield _mirrored(entry)
+    if file_list:
+        with open(file_list) as f:
+            for line in f:
+                path = line.strip()
+                if path:
+                    yield _mirrored(path)
+
+
+def _mirrored(path: str) -> Tuple[str, str]:
+    """
+    Mirror a file named on its own by its path from the current directory, so
+    files from different directories keep apart; files outside the current
+    directory are mirrored by absolute path, which never leaves the output directory.
+    """
+    path = os.path.abspath(path)
+    relative = os.path.relpath(path)
+    if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+        relative = path.lstrip(os.sep)
+    return path, relative
+
+
+def load_manifest(report_path: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Read the records of images already cloaked by previous runs.
+
+    Args:
+        report_path: JSONL report of previous runs
+
+    Returns:
+        Latest successful record per input path
+    """
+    done: Dict[str, Dict[str, Any]] = {}
+    if not os.path.exists(report_path):
+        return done
+    with open(report_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # line cut short by an interrupted run
+            if record.get("status") == "done":
+                done[record["input"]] = record
+    return done
+
+
+def is_done(record: Optional[Dict[str, Any]], path: str) -> bool:
+    """Check that a manifest record still matches the input file and its output exists."""
+    if record is None or not os.path.exists(record["output"]) or not os.path.exists(path):
+        return False
+    stat = os.stat(path)
+    return record["size"] == stat.st_size and record["mtime_ns"] == stat.st_mtime_ns
+
+
+def _init_process(detection_max_side: Optional[int], cloak_method: str) -> None:
+    """Create and warm up the FaceCloaker owned by a pool process."""
+    cv2.setNumThreads(1)
+    cloaker = get_cloaker()
+    cloaker.detection_max_side = detection_max_side
+    cloaker.cloak_method = cloak_method
+    cloaker.warm_up()
+
+
+def cloak_file(task: Tuple[str, str, bool, str, Optional[int]]) -> Dict[str, Any]:
+    """
+    Cloak one image file inside a pool process.
+
+    Args:
+        task: (input path, output path, whether to use tiled mode, output format, compression)
+
+    Returns:
+        Report record: input file identity, number of faces and their boxes
+        (top, right, bottom, left), per-stage timings and status
+    """
+    input_path, output_path, tiled, output_format, compression = task
+    record: Dict[str, Any] = {"input": input_path, "output": output_path, "pid": os.getpid()}
+    started = time.perf_counter()
+    # Written under a temporary name so an interrupted run never leaves a partial output
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    try:
+        stat = os.stat(input_path)
+        record["size"], record["mtime_ns"] = stat.st_size, stat.st_mtime_ns
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with metrics.collect_trace() as spans:
+            if tiled:
+                stats = cloak_large_task(input_path, tmp_path, compression if output_format == "png" else None)
+                boxes = stats["boxes"]
+                record["tiles"] = stats["tiles"]
+            else:
+                with open(input_path, "rb") as f:
+                    contents = f.read()
+                encoded, faces = cloak_task(contents, None, output_format, compression)
+                with open(tmp_path, "wb") as f:
+                    f.write(encoded)
+                boxes = [[int(value) for value in face['location']] for face in faces]
+            record["faces"] = len(boxes)
+            record["boxes"] = boxes
+        os.replace(tmp_path, output_path)
+
+        stages: Dict[str, float] = {}
+        for name, elapsed in spans:
+            stages[name] = stages.get(name, 0.0) + elapsed
+        record["stages"] = stages
+        record["status"] = "done"
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        record["status"] = "failed"
+        record["error"] = str(e)
+    record["seconds"] = time.perf_counter() - started
+    return record
+
+
+def output_path_for(output_dir: str, relative_path: str, output_format: str, tiled: bool) -> str:
+    """Mirror an input path into the output directory with the output format's extension."""
+    stem = os.path.splitext(relative_path)[0]
+    return os.path.join(output_dir, f"{stem}_cloaked.{'png' if tiled else file_extension(output_format)}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Cloak whole directories of photos")
+    parser.add_argument("inputs", nargs="*", help="Directories (walked recursively) and image files")
+    parser.add_argument("--file-list", help="File with one image path per line")
+    parser.add_argument("--output-dir", required=True, help="Directory receiving the cloaked images")
+    parser.add_argument("--report", help="JSONL report and resume manifest (default: OUTPUT_DIR/report.jsonl)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Pool processes")
+    parser.add_argument("--format", default=config.OUTPUT_FORMAT, help="Output format: png, webp or jpeg")
+    parser.add_argument("--compression", type=int, default=None, help="Compression setting of the output format")
+    parser.add_argument("--detection-max-side", type=int, default=config.DETECTION_MAX_SIDE,
+                        help="Detect on a downscaled proxy (0 = full resolution)")
+    parser.add_argument("--method", default=config.CLOAK_METHOD, choices=["noise", "optimize"], help="Cloaking method")
+    parser.add_argument("--force", action="store_true", help="Cloak images the manifest lists as done")
+    args = parser.parse_args()
+
+    if not args.inputs and not args.file_list:
+        parser.error("Give input directories or files, or --file-list")
+    try:
+        output_format = normalize_format(args.format, args.compression)
+    except ValueError as e:
+        parser.error(str(e))
+    compression = args.compression
+    if output_format == "png" and compression is None:
+        compression = config.PNG_COMPRESSION
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    os.makedirs(args.output_dir, exist_ok=True)
+    report_path = args.report or os.path.join(args.output_dir, "report.jsonl")
+    manifest = {} if args.force else load_manifest(report_path)
+
+    tasks, skipped = [], 0
+    # Output path -> input path, so two inputs never overwrite each other's output
+    outputs: Dict[str, str] = {}
+    seen = set()
+    for input_path, relative_path in find_images(args.inputs, args.file_list):
+        if input_path in seen:
+            continue  # named twice, e.g. on its own and through its directory
+        seen.add(input_path)
+        record = manifest.get(input_path)
+        done = is_done(record, input_path)
+        if done:
+            output_path = record["output"]
+        else:
+            try:
+                with open(input_path, "rb") as f:
+                    width, height = image_size(f, config.TILED_MAX_PIXELS)
+                tiled = width * height > config.TILED_MIN_PIXELS
+            except Exception:
+                tiled = False  # reported as failed by the worker
+            output_path = output_path_for(args.output_dir, relative_path, output_format, tiled)
+        claimed = outputs.setdefault(os.path.abspath(output_path), input_path)
+        if claimed != input_path:
+            parser.error(f"{claimed} and {input_path} would both be cloaked to {output_path}")
+        if done:
+            skipped += 1
+        else:
+            tasks.append((input_path, output_path, tiled, output_format, compression))
+    logger.info(f"{len(tasks)} image(s) to cloak, {skipped} already done")
+
+    summary = {"done": 0, "failed": 0, "skipped": skipped, "faces": 0}
+    started = time.perf_counter()
+    if tasks:
+        pool = multiprocessing.Pool(
+            processes=min(args.workers, len(tasks)),
+            initializer=_init_process,
+            initargs=(args.detection_max_side or None, args.method),
+        )
+        try:
+            # The parent is the only writer of the report; lines are flushed as
+            # images finish so an interrupted run keeps its progress
+            with open(report_path, "a") as report:
+                for record in pool.imap_unordered(cloak_file, tasks, chunksize=1):
+                    report.write(json.dumps(record) + "\n")
+                    report.flush()
+                    summary[record["status"]] += 1
+                    summary["faces"] += record.get("faces", 0)
+                    if record["status"] == "failed":
+                        logger.error(f"Error cloaking {record['input']}: {record['error']}")
+                    processed = summary["done"] + summary["failed"]
+                    if processed % 100 == 0 or processed == len(tasks):
+                        logger.info(f"{processed}/{len(tasks)} image(s) processed")
+        except KeyboardInterrupt:
+            logger.info("Interrupted; run the same command again to resume")
+            return 130
+        finally:
+            pool.terminate()
+            pool.join()
+
+    elapsed = time.perf_counter() - started
+    summary["seconds"] = elapsed
+    summary["images_per_second"] = (summary["done"] + summary["failed"]) / elapsed if elapsed > 0 else 0.0
+    print(json.dumps(summary, indent=2))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
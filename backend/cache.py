@@ -0,0 +1,265 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """
+    Content-addressed cache for detection results and encoded outputs.
+
+    Entries live in an in-memory LRU bounded by their total size in bytes.
+    An optional on-disk tier keeps entries across restarts; disk writes
+    happen on a background thread so callers never wait for them.
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: Optional[str] = None, disk_max_bytes: int = 0):
+        """
+        Initialize the cache.
+
+        Args:
+            max_bytes: Memory budget of the in-memory tier
+            disk_dir: Directory of the on-disk tier (None disables it)
+            disk_max_bytes: Size budget of the on-disk tier
+        """
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries: "OrderedDict[str, Tuple[Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk_writer: Optional[ThreadPoolExecutor] = None
+        self._disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-writer")
+            disk_bytes = sum(size for _, size, _ in self._disk_files())
+            with self._lock:
+                self._disk_bytes = disk_bytes
+
+    @staticmethod
+    def digest(contents: bytes) -> str:
+        """
+        Hash uploaded bytes; the digest is combined with parameters by make_key.
+
+        Args:
+            contents: Raw bytes of the uploaded image
+
+        Returns:
+            Hex digest of the contents
+        """
+        return hashlib.blake2b(contents, digest_size=20).hexdigest()
+
+    @staticmethod
+    def make_key(namespace: str, content_digest: str, params: Dict[str, Any]) -> str:
+        """
+        Build a cache key from an upload digest and the parameters that affect the result.
+
+        Args:
+            namespace: Kind of cached result (e.g. "cloak", "faces")
+            content_digest: Digest of the uploaded bytes from digest()
+            params: Parameters the result depends on
+
+        Returns:
+            Hex digest identifying the result
+        """
+        key = hashlib.blake2b(digest_size=20)
+        key.update(namespace.encode())
+        key.update(content_digest.encode())
+        key.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return key.hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Look up a cached value, falling back to the on-disk tier.
+
+        Reads the disk tier on the calling thread; use get_async on the event loop.
+
+        Args:
+            key: Key from make_key
+
+        Returns:
+            The cached value, or None on a miss
+        """
+        found, value = self._get_memory(key)
+        if found:
+            return value
+        return self._found_on_disk(key, self._read_disk(key))
+
+    async def get_async(self, key: str) -> Optional[Any]:
+        """
+        Look up a cached value without blocking the event loop.
+
+        The in-memory tier is checked inline; a miss there reads the on-disk
+        tier in the loop's default executor.
+
+        Args:
+            key: Key from make_key
+
+        Returns:
+            The cached value, or None on a miss
+        """
+        found, value = self._get_memory(key)
+        if found:
+            return value
+        if self.disk_dir:
+            value = await asyncio.get_running_loop().run_in_executor(None, self._read_disk, key)
+        return self._found_on_disk(key, value)
+
+    def put(self, key: str, value: Any) -> None:
+        """
+        Store a value in the cache.
+
+        Args:
+            key: Key from make_key
+            value: Bytes or any picklable value (pickled on the disk writer thread)
+        """
+        self._store(key, value, self._sizeof(value))
+        if self._disk_writer is not None:
+            self._disk_writer.submit(self._write_disk, key, value)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and tier sizes."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "disk_bytes": self._disk_bytes,
+                "disk_enabled": self._disk_writer is not None,
+            }
+
+    def close(self) -> None:
+        """Wait for pending disk writes; the cache stays usable afterwards."""
+        if self._disk_writer is not None:
+            # The single writer thread runs writes in order, so this returns after all earlier ones
+            self._disk_writer.submit(lambda: None).result()
+
+    def _get_memory(self, key: str) -> Tuple[bool, Optional[Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def _found_on_disk(self, key: str, value: Optional[Any]) -> Optional[Any]:
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+        self._store(key, value, self._sizeof(value))
+        return value
+
+    @classmethod
+    def _sizeof(cls, value: Any) -> int:
+        """Approximate memory held by a value: buffers by their length, containers by their items."""
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return len(value)
+        if isinstance(value, np.ndarray):
+            return value.nbytes
+        if isinstance(value, (list, tuple)):
+            return sys.getsizeof(value) + sum(cls._sizeof(item) for item in value)
+        if isinstance(value, dict):
+            return sys.getsizeof(value) + sum(cls._sizeof(item) for item in value.values())
+        return sys.getsizeof(value)
+
+    def _store(self, key: str, value: Any, size: int) -> None:
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def _disk_path(self, key: str, raw: bool) -> str:
+        return os.path.join(self.disk_dir, key[:2], key + (".bin" if raw else ".pkl"))
+
+    def _disk_files(self):
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                if name.endswith((".bin", ".pkl")):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    yield path, stat.st_size, stat.st_mtime
+
+    def _read_disk(self, key: str) -> Optional[Any]:
+        if not self.disk_dir:
+            return None
+        try:
+            raw_path = self._disk_path(key, raw=True)
+            if os.path.exists(raw_path):
+                with open(raw_path, "rb") as f:
+                    return f.read()
+            pickle_path = self._disk_path(key, raw=False)
+            if os.path.exists(pickle_path):
+                with open(pickle_path, "rb") as f:
+                    return pickle.load(f)
+        except Exception as e:
+            logger.error(f"Error reading cache entry {key}: {str(e)}")
+        return None
+
+    def _write_disk(self, key: str, value: Any) -> None:
+        try:
+            raw = isinstance(value, bytes)
+            payload = value if raw else pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            path = self._disk_path(key, raw)
+            replaced = os.path.getsize(path) if os.path.exists(path) else 0
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._disk_bytes += len(payload) - replaced
+                over_budget = self._disk_bytes > self.disk_max_bytes
+            if over_budget:
+                self._evict_disk()
+        except Exception as e:
+            logger.error(f"Error writing cache entry {key}: {str(e)}")
+
+    def _evict_disk(self) -> None:
+        # Drop the oldest files until the tier is back under 90% of its budget
+        files = sorted(self._disk_files(), key=lambda entry: entry[2])
+        target = int(self.disk_max_bytes * 0.9)
+        for path, size, _ in files:
+            with self._lock:
+                if self._disk_bytes <= target:
+                    break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            with self._lock:
+                self._disk_bytes -= size
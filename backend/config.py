@@ -0,0 +1,171 @@
+import os
+import tempfile
+
+
+def _env_int(name: str, default: int) -> int:
+    """Read an integer setting from the environment."""
+    value = os.environ.get(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    """Read a boolean setting from the environment."""
+    value = os.environ.get(name)
+    if value in (None, ""):
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+def _env_float(name: str, default: float) -> float:
+    """Read a float setting from the environment."""
+    value = os.environ.get(name)
+    return float(value) if value not in (None, "") else default
+
+
+# Execution backend for CPU-bound work: "thread" or "process"
+WORKER_MODE = os.environ.get("INVISIFACE_WORKER_MODE", "thread").lower()
+
+# Number of workers in the pool (defaults to the number of cores)
+WORKER_COUNT = _env_int("INVISIFACE_WORKERS", os.cpu_count() or 1)
+
+# Requests allowed to wait for a free worker before new ones are rejected
+MAX_QUEUE_DEPTH = _env_int("INVISIFACE_MAX_QUEUE_DEPTH", 16)
+
+# Pass image buffers to process workers through shared memory instead of pickling them
+SHM_TRANSPORT = _env_bool("INVISIFACE_SHM_TRANSPORT", True)
+
+# Total size of the shared memory segments kept for reuse across requests, in bytes
+SHM_POOL_BYTES = _env_int("INVISIFACE_SHM_POOL_BYTES", 256 * 1024 * 1024)
+
+# Smallest buffer passed through shared memory, in bytes; smaller ones are pickled
+SHM_MIN_BYTES = _env_int("INVISIFACE_SHM_MIN_BYTES", 64 * 1024)
+
+# Memory budget of the requests being processed, in bytes (0 = half of the container or machine memory)
+ADMISSION_MEMORY_BYTES = _env_int("INVISIFACE_ADMISSION_MEMORY_BYTES", 0)
+
+# Requests processed at the same time under admission control
+ADMISSION_CPU_SLOTS = _env_int("INVISIFACE_ADMISSION_CPU_SLOTS", WORKER_COUNT)
+
+# Requests allowed to wait for admission before new ones get 429
+ADMISSION_MAX_WAITING = _env_int("INVISIFACE_ADMISSION_MAX_WAITING", 32)
+
+# Seconds a request may wait for admission before it gets 503
+ADMISSION_MAX_WAIT = _env_float("INVISIFACE_ADMISSION_MAX_WAIT", 10.0)
+
+# Seconds a single request may spend queued and processing
+REQUEST_TIMEOUT = _env_float("INVISIFACE_REQUEST_TIMEOUT", 120.0)
+
+# Maximum number of images accepted by the batch cloaking endpoint
+MAX_BATCH_SIZE = _env_int("INVISIFACE_MAX_BATCH_SIZE", 32)
+
+# Largest image upload, in bytes, read into memory by the image endpoints
+MAX_UPLOAD_BYTES = _env_int("INVISIFACE_MAX_UPLOAD_BYTES", 50 * 1024 * 1024)
+
+# Largest image, in pixels, decoded in full by the image endpoints (checked on the header before decoding)
+MAX_IMAGE_PIXELS = _env_int("INVISIFACE_MAX_IMAGE_PIXELS", 100_000_000)
+
+# Largest request body, and largest upload processed from disk (videos, tiled images, job files)
+MAX_SPOOLED_UPLOAD_BYTES = _env_int("INVISIFACE_MAX_SPOOLED_UPLOAD_BYTES", 2 * 1024 * 1024 * 1024)
+
+# Longest side of the downscaled image used for face detection (0 = full resolution)
+DETECTION_MAX_SIDE = _env_int("INVISIFACE_DETECTION_MAX_SIDE", 2048)
+
+# Face detection backend: "hog", "cnn", "dnn" (OpenCV ResNet-10 SSD) or "yunet" (see benchmark.py --detectors)
+DETECTOR = os.environ.get("INVISIFACE_DETECTOR", "hog").lower()
+
+# Model file of the dnn (Caffe weights) and yunet (ONNX) detectors
+DETECTOR_MODEL = os.environ.get("INVISIFACE_DETECTOR_MODEL", "")
+
+# Network definition (prototxt) of the dnn detector
+DETECTOR_CONFIG = os.environ.get("INVISIFACE_DETECTOR_CONFIG", "")
+
+# Minimum detection score of the dnn and yunet detectors (0 = backend default)
+DETECTOR_CONFIDENCE = _env_float("INVISIFACE_DETECTOR_CONFIDENCE", 0.0)
+
+# Re-detect upmapped faces on padded full-resolution regions
+REFINE_DETECTIONS = _env_bool("INVISIFACE_REFINE_DETECTIONS", False)
+
+# Memory budget of the result cache in bytes (0 disables caching)
+CACHE_MAX_BYTES = _env_int("INVISIFACE_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+
+# Directory of the on-disk cache tier (empty disables it)
+CACHE_DIR = os.environ.get("INVISIFACE_CACHE_DIR", "")
+
+# Size budget of the on-disk cache tier in bytes
+CACHE_DISK_MAX_BYTES = _env_int("INVISIFACE_CACHE_DISK_MAX_BYTES", 2 * 1024 * 1024 * 1024)
+
+# Cloaking method: "noise" (smoothed random noise) or "optimize" (embedding optimization)
+CLOAK_METHOD = os.environ.get("INVISIFACE_CLOAK_METHOD", "noise").lower()
+
+# Side length of the pre-blurred noise fields faces are cut from (0 draws fresh noise per face)
+NOISE_BANK_SIZE = _env_int("INVISIFACE_NOISE_BANK_SIZE", 512)
+
+# Number of noise fields in the bank
+NOISE_BANK_FIELDS = _env_int("INVISIFACE_NOISE_BANK_FIELDS", 4)
+
+# Seed of the noise bank; when set, the same image always gets the same cloak (empty = random)
+NOISE_SEED = os.environ.get("INVISIFACE_NOISE_SEED", "")
+
+# Load the face models in every worker when the server starts
+WARM_UP_ON_STARTUP = _env_bool("INVISIFACE_WARM_UP", True)
+
+# Default output format of cloaked images: "png", "webp" or "jpeg"
+OUTPUT_FORMAT = os.environ.get("INVISIFACE_OUTPUT_FORMAT", "png").lower()
+
+# zlib level of PNG output when the request does not set one (0-9, lower is faster)
+PNG_COMPRESSION = _env_int("INVISIFACE_PNG_COMPRESSION", 1)
+
+# Size of the encoded image chunks sent by the streaming endpoint, in bytes
+STREAM_CHUNK_BYTES = _env_int("INVISIFACE_STREAM_CHUNK_BYTES", 256 * 1024)
+
+# Allow single requests to be profiled with ?profile=true
+ENABLE_PROFILING = _env_bool("INVISIFACE_ENABLE_PROFILING", False)
+
+# Directory where request profiles are written as folded stacks (empty only logs them)
+PROFILE_DIR = os.environ.get("INVISIFACE_PROFILE_DIR", "")
+
+# Directory of the reference gallery used by protection checks (empty disables it)
+GALLERY_DIR = os.environ.get("INVISIFACE_GALLERY_DIR", "")
+
+# Encoding distance at or below which a face matches a gallery identity
+GALLERY_TOLERANCE = _env_float("INVISIFACE_GALLERY_TOLERANCE", 0.6)
+
+# Gallery size from which searches use the approximate index, once it is built
+GALLERY_APPROXIMATE_THRESHOLD = _env_int("INVISIFACE_GALLERY_APPROXIMATE_THRESHOLD", 100000)
+
+# Index clusters searched per face in approximate mode
+GALLERY_NPROBE = _env_int("INVISIFACE_GALLERY_NPROBE", 8)
+
+# Frames between full face detections in videos (faces are tracked in between)
+VIDEO_KEYFRAME_INTERVAL = _env_int("INVISIFACE_VIDEO_KEYFRAME_INTERVAL", 30)
+
+# Histogram distance between consecutive frames that counts as a scene cut (0-1)
+VIDEO_SCENE_THRESHOLD = _env_float("INVISIFACE_VIDEO_SCENE_THRESHOLD", 0.4)
+
+# Tile side length and overlap of the tiled mode for very large images
+TILE_SIZE = _env_int("INVISIFACE_TILE_SIZE", 2048)
+TILE_OVERLAP = _env_int("INVISIFACE_TILE_OVERLAP", 256)
+
+# Images with more pixels are processed in tiled mode when submitted as jobs
+TILED_MIN_PIXELS = _env_int("INVISIFACE_TILED_MIN_PIXELS", 50_000_000)
+
+# Largest image accepted by the tiled mode, in pixels
+TILED_MAX_PIXELS = _env_int("INVISIFACE_TILED_MAX_PIXELS", 1_000_000_000)
+
+# Directory of the job store: SQLite records plus spooled uploads and results
+JOB_DIR = os.environ.get("INVISIFACE_JOB_DIR", "") or os.path.join(tempfile.gettempdir(), "invisiface-jobs")
+
+# Jobs processed at the same time (the rest of the pool stays free for interactive requests)
+JOB_CONCURRENCY = _env_int("INVISIFACE_JOB_CONCURRENCY", max(WORKER_COUNT // 2, 1))
+
+# Queued jobs allowed before new submissions are rejected
+JOB_MAX_PENDING = _env_int("INVISIFACE_JOB_MAX_PENDING", 64)
+
+# Seconds a single job may spend processing
+JOB_TIMEOUT = _env_float("INVISIFACE_JOB_TIMEOUT", 600.0)
+
+# Scheduling penalty in seconds per MB of upload, so small images run first
+JOB_SIZE_DELAY = _env_float("INVISIFACE_JOB_SIZE_DELAY", 1.0)
+
+# Seconds finished jobs and their results are kept
+JOB_TTL = _env_float("INVISIFACE_JOB_TTL", 3600.0)
@@ -0,0 +1,272 @@
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+Location = Tuple[int, int, int, int]  # (top, right, bottom, left)
+Detection = Tuple[Location, float]  # face box and detector score
+
+# Score reported by the face_recognition backends, which do not expose one
+DEFAULT_SCORE = 0.9
+
+
+def _load_face_recognition():
+    # Same lazy import as face_cloaker, which owns the shared module reference
+    from face_cloaker import _load_face_recognition as load
+    return load()
+
+
+class FaceDetector:
+    """
+    Face detection backend.
+
+    Detectors receive uint8 images as prepared by
+    FaceCloaker._prepare_for_detection. The cloaker works on RGB arrays and
+    the preparation swaps the channels, so colour images arrive in BGR
+    order (OpenCV's order, and the order face_recognition has always been
+    given here); RGBA images keep their order and grayscale images pass
+    as is. Detections are face boxes in that image's coordinates.
+    Backends that can run several images through one inference call
+    override detect_batch.
+    """
+
+    name = ""
+
+    def detect(self, image: np.ndarray) -> List[Detection]:
+        """
+        Find the faces in one image.
+
+        Args:
+            image: BGR, RGBA or grayscale uint8 image
+
+        Returns:
+            (top, right, bottom, left) boxes with their scores
+        """
+        raise NotImplementedError
+
+    def detect_batch(self, images: List[np.ndarray]) -> List[List[Detection]]:
+        """
+        Find the faces in several images.
+
+        Args:
+            images: BGR, RGBA or grayscale uint8 images, of any sizes
+
+        Returns:
+            Per image, the detections of detect()
+        """
+        return [self.detect(image) for image in images]
+
+    def settings(self) -> Dict[str, Any]:
+        """Settings that influence the detections, for cache keys and reports."""
+        return {'name': self.name}
+
+    def warm_up(self) -> None:
+        """Load the model and run a first inference."""
+        self.detect(np.zeros((64, 64, 3), dtype=np.uint8))
+
+
+class HogDetector(FaceDetector):
+    """dlib's HOG detector through face_recognition; the original InvisiFace detector."""
+
+    name = "hog"
+
+    def __init__(self, upsample: int = 1):
+        """
+        Initialize the detector.
+
+        Args:
+            upsample: Times the image is upsampled before detection, to find smaller faces
+        """
+        self.upsample = upsample
+
+    def detect(self, image: np.ndarray) -> List[Detection]:
+        locations = _load_face_recognition().face_locations(image, number_of_times_to_upsample=self.upsample)
+        return [(tuple(location), DEFAULT_SCORE) for location in locations]
+
+    def settings(self) -> Dict[str, Any]:
+        return {'name': self.name, 'upsample': self.upsample}
+
+
+class CnnDetector(HogDetector):
+    """
+    dlib's CNN (MMOD) detector through face_recognition.
+
+    More accurate than HOG on small and turned faces but much slower on CPU.
+    Images of the same size are detected in one batched call.
+    """
+
+    name = "cnn"
+
+    def detect(self, image: np.ndarray) -> List[Detection]:
+        locations = _load_face_recognition().face_locations(image, number_of_times_to_upsample=self.upsample,
+                                                            model="cnn")
+        return [(tuple(location), DEFAULT_SCORE) for location in locations]
+
+    def detect_batch(self, images: List[np.ndarray]) -> List[List[Detection]]:
+        # dlib batches only images of identical shape
+        results: List[List[Detection]] = [[] for _ in images]
+        groups: Dict[Tuple[int, ...], List[int]] = {}
+        for index, image in enumerate(images):
+            groups.setdefault(image.shape, []).append(index)
+        face_recognition = _load_face_recognition()
+        for indices in groups.values():
+            if len(indices) == 1:
+                results[indices[0]] = self.detect(images[indices[0]])
+                continue
+            batch = face_recognition.batch_face_locations([images[index] for index in indices],
+                                                          number_of_times_to_upsample=self.upsample)
+            for index, locations in zip(indices, batch):
+                results[index] = [(tuple(location), DEFAULT_SCORE) for location in locations]
+        return results
+
+
+def _to_bgr(image: np.ndarray) -> np.ndarray:
+    """Detector input in the 3-channel BGR order of OpenCV's networks; colour images already are."""
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    if image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_RGBA2BGR)
+    return image
+
+
+def _clip_box(x1: float, y1: float, x2: float, y2: float, width: int, height: int) -> Optional[Location]:
+    top, left = max(int(y1), 0), max(int(x1), 0)
+    bottom, right = min(int(round(y2)), height), min(int(round(x2)), width)
+    if bottom <= top or right <= left:
+        return None
+    return (top, right, bottom, left)
+
+
+class OpenCvDnnDetector(FaceDetector):
+    """
+    OpenCV's ResNet-10 SSD face detector (res10_300x300_ssd) on the DNN module.
+
+    Fast on CPU at a fixed input size; several images are stacked into one
+    input blob and detected in a single forward pass.
+    """
+
+    name = "dnn"
+
+    def __init__(self, model_path: str, config_path: str, confidence: float = 0.5, input_size: int = 300):
+        """
+        Initialize the detector.
+
+        Args:
+            model_path: Caffe weights (res10_300x300_ssd_iter_140000.caffemodel)
+            config_path: Network definition (deploy.prototxt)
+            confidence: Minimum detection score
+            input_size: Side of the square network input
+        """
+        for path in (model_path, config_path):
+            if not path or not os.path.exists(path):
+                raise ValueError("The dnn face detector needs its model and config files, "
+                                 f"missing: {path or '(unset)'}")
+        self.net = cv2.dnn.readNet(model_path, config_path)
+        self.confidence = confidence
+        self.input_size = input_size
+
+    def detect(self, image: np.ndarray) -> List[Detection]:
+        return self.detect_batch([image])[0]
+
+    def detect_batch(self, images: List[np.ndarray]) -> List[List[Detection]]:
+        if not images:
+            return []
+        size = (self.input_size, self.input_size)
+        blob = cv2.dnn.blobFromImages([_to_bgr(image) for image in images], 1.0, size, (104.0, 177.0, 123.0),
+                                      swapRB=False, crop=False)
+        self.net.setInput(blob)
+        # Rows of [image index, class, score, x1, y1, x2, y2], coordinates relative to the image
+        output = self.net.forward().reshape(-1, 7)
+
+        results: List[List[Detection]] = [[] for _ in images]
+        for image_index, _, score, x1, y1, x2, y2 in output:
+            # Unused output rows are padded with an image index of -1
+            if image_index < 0 or score < self.confidence:
+                continue
+            height, width = images[int(image_index)].shape[:2]
+            box = _clip_box(x1 * width, y1 * height, x2 * width, y2 * height, width, height)
+            if box is not None:
+                results[int(image_index)].append((box, float(score)))
+        return results
+
+    def settings(self) -> Dict[str, Any]:
+        return {'name': self.name, 'confidence': self.confidence, 'input_size': self.input_size}
+
+
+class YuNetDetector(FaceDetector):
+    """
+    YuNet face detector (cv2.FaceDetectorYN).
+
+    A small CNN that runs at the image's own resolution, finds small and
+    moderately rotated faces, and is fast on CPU.
+    """
+
+    name = "yunet"
+
+    def __init__(self, model_path: str, confidence: float = 0.6, nms_threshold: float = 0.3, top_k: int = 5000):
+        """
+        Initialize the detector.
+
+        Args:
+            model_path: ONNX model (face_detection_yunet_2023mar.onnx from the OpenCV model zoo)
+            confidence: Minimum detection score
+            nms_threshold: Overlap above which duplicate boxes are suppressed
+            top_k: Candidates kept before non-maximum suppression
+        """
+        if not model_path or not os.path.exists(model_path):
+            raise ValueError(f"The yunet face detector needs its model file, missing: {model_path or '(unset)'}")
+        self.detector = cv2.FaceDetectorYN.create(model_path, "", (320, 320), confidence, nms_threshold, top_k)
+        self.confidence = confidence
+        self.nms_threshold = nms_threshold
+
+    def detect(self, image: np.ndarray) -> List[Detection]:
+        height, width = image.shape[:2]
+        self.detector.setInputSize((width, height))
+        _, faces = self.detector.detect(_to_bgr(image))
+        detections = []
+        # Rows of [x, y, w, h, 5 landmark points, score]
+        for row in faces if faces is not None else []:
+            x, y, w, h = (float(value) for value in row[:4])
+            box = _clip_box(x, y, x + w, y + h, width, height)
+            if box is not None:
+                detections.append((box, float(row[14])))
+        return detections
+
+    def settings(self) -> Dict[str, Any]:
+        return {'name': self.name, 'confidence': self.confidence, 'nms_threshold': self.nms_threshold}
+
+
+DETECTORS = ("hog", "cnn", "dnn", "yunet")
+
+
+def create_detector(name: str, model_path: str = "", config_path: str = "",
+                    confidence: Optional[float] = None) -> FaceDetector:
+    """
+    Create a detection backend by name.
+
+    Args:
+        name: One of DETECTORS
+        model_path: Model file of the dnn and yunet backends
+        config_path: Network definition of the dnn backend
+        confidence: Minimum detection score of the dnn and yunet backends (backend default if None)
+
+    Returns:
+        The detector
+
+    Raises:
+        ValueError: If the name is unknown or the backend's model files are missing
+    """
+    name = name.lower()
+    if name == "hog":
+        return HogDetector()
+    if name == "cnn":
+        return CnnDetector()
+    if name == "dnn":
+        return OpenCvDnnDetector(model_path, config_path, **({} if confidence is None else {'confidence': confidence}))
+    if name == "yunet":
+        return YuNetDetector(model_path, **({} if confidence is None else {'confidence': confidence}))
+    raise ValueError(f"Unknown face detector: {name} (expected one of {', '.join(DETECTORS)})")
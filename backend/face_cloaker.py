@@ -1,14 +1,45 @@
 import numpy as np
 import cv2
-import face_recognition
 from PIL import Image
-import tensorflow as tf
-from typing import Dict, List, Tuple, Any
+from typing import Callable, Dict, List, Optional, Tuple, Any
 import logging
 import random
+import time
+from detectors import FaceDetector, HogDetector
+from gallery import FaceGallery
+from metrics import timed_stage
+from noise_bank import NoiseBank
+from optimizer import EmbeddingOptimizer
 
 logger = logging.getLogger(__name__)
 
+# Share of a request's remaining time the optimizer may use; the rest is left
+# for applying the perturbations and encoding the output
+OPTIMIZATION_TIME_SHARE = 0.8
+
+# face_recognition loads its dlib models at import time, so it is imported on
+# first use (or by FaceCloaker.warm_up) rather than when this module loads.
+_face_recognition = None
+
+def _load_face_recognition():
+    """Import face_recognition and its dlib models on first use."""
+    global _face_recognition
+    if _face_recognition is None:
+        import face_recognition
+        _face_recognition = face_recognition
+    return _face_recognition
+
+def _box_iou(a: Tuple[int, int, int, int], b: Tuple[int, int, int, int]) -> float:
+    """Intersection over union of two (top, right, bottom, left) boxes."""
+    inter_h = min(a[2], b[2]) - max(a[0], b[0])
+    inter_w = min(a[1], b[1]) - max(a[3], b[3])
+    if inter_h <= 0 or inter_w <= 0:
+        return 0.0
+    intersection = inter_h * inter_w
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    return intersection / float(area_a + area_b - intersection)
+
 class FaceCloaker:
     """
     Face cloaking system inspired by Fawkes algorithm.
@@ -21,163 +52,646 @@ class FaceCloaker:
         self.max_iterations = 50  # Maximum optimization iterations
         self.learning_rate = 0.01  # Learning rate for perturbation generation
         self.target_shift = 0.3  # How much to shift face embeddings
+        self.detection_max_side = None  # Longest side of the detection proxy (None = full resolution)
+        self.detection_scale = None  # Fixed downscale factor of the detection proxy (None = full resolution)
+        self.refine_detections = False  # Re-detect upmapped boxes on padded full-resolution regions
+        self.refine_padding = 0.25  # Padding around upmapped boxes, as a fraction of the box size
+        self.cloak_method = "noise"  # "noise" (smoothed random noise) or "optimize" (embedding optimization)
+        self.optimization_samples = 4  # Antithetic sample pairs per face and optimization iteration
+        self.noise_bank: Optional[NoiseBank] = None  # Pre-blurred noise fields for the random-noise cloak
+        self.detector: FaceDetector = HogDetector()  # Face detection backend
+        self.deadline: Optional[float] = None  # Wall-clock time (time.time()) the current request must finish by
+        self._rng = np.random.default_rng()
+        self._scratch = np.empty(0, dtype=np.float32)  # Reused float32 buffer for per-face noise
         
-    def detect_faces(self, image: np.ndarray) -> List[Dict]:
+    def warm_up(self) -> Dict[str, float]:
+        """
+        Load the face detection and encoding models ahead of the first request.
+        
+        Returns:
+            Seconds spent importing the models and running a first inference
+        """
+        start = time.perf_counter()
+        face_recognition = _load_face_recognition()
+        loaded = time.perf_counter()
+        
+        # Run detection and encoding once so lazy initialization happens now
+        dummy = np.zeros((64, 64, 3), dtype=np.uint8)
+        face_recognition.face_locations(dummy)
+        face_recognition.face_encodings(dummy, [(0, 64, 64, 0)])
+        self.detector.warm_up()
+        finished = time.perf_counter()
+        
+        if self.noise_bank is not None:
+            self.noise_bank.build()
+        
+        return {
+            'model_load_seconds': loaded - start,
+            'first_inference_seconds': finished - loaded,
+            'noise_bank_seconds': time.perf_counter() - finished,
+        }
+    
+    def parameters(self) -> Dict[str, Any]:
+        """
+        Return the settings that influence detection and cloaking results.
+        
+        Returns:
+            Dictionary of parameter names to values
+        """
+        return {
+            'perturbation_strength': self.perturbation_strength,
+            'max_iterations': self.max_iterations,
+            'learning_rate': self.learning_rate,
+            'target_shift': self.target_shift,
+            'detection_max_side': self.detection_max_side,
+            'detection_scale': self.detection_scale,
+            'refine_detections': self.refine_detections,
+            'refine_padding': self.refine_padding,
+            'cloak_method': self.cloak_method,
+            'optimization_samples': self.optimization_samples,
+            'noise_bank': None if self.noise_bank is None else (self.noise_bank.size, self.noise_bank.fields),
+            'noise_seed': None if self.noise_bank is None else self.noise_bank.seed,
+            'detector': self.detector.settings(),
+        }
+    
+    def _prepare_for_detection(self, image: np.ndarray) -> np.ndarray:
+        """
+        Convert an image into the colour layout passed to face_recognition and the detectors.
+        
+        Args:
+            image: Input image as numpy array (RGB, RGBA or grayscale)
+            
+        Returns:
+            Image ready for face detection and encoding: 3-channel images come out
+            channel-swapped, in BGR order, other layouts unchanged
+        """
+        # Swap the red and blue channels of 3-channel images
+        if len(image.shape) == 3 and image.shape[2] == 3:
+            return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        return image
+    
+    def _detection_scale(self, image: np.ndarray) -> float:
+        """
+        Compute the downscale factor of the detection proxy for an image.
+        
+        Args:
+            image: Input image as numpy array
+            
+        Returns:
+            Scale factor in (0, 1]; 1.0 means detection runs at full resolution
+        """
+        scale = 1.0
+        if self.detection_scale:
+            scale = min(scale, self.detection_scale)
+        if self.detection_max_side:
+            scale = min(scale, self.detection_max_side / max(image.shape[:2]))
+        return scale
+    
+    def _refine_location(self, image: np.ndarray, location: Tuple[int, int, int, int]) -> Tuple[int, int, int, int]:
+        """
+        Re-detect a face in a padded full-resolution region around an upmapped box.
+        
+        Args:
+            image: Full resolution input image
+            location: Upmapped (top, right, bottom, left) face box
+            
+        Returns:
+            The refined face box, or the original box if no face is found in the region
+        """
+        top, right, bottom, left = location
+        pad_y = int((bottom - top) * self.refine_padding)
+        pad_x = int((right - left) * self.refine_padding)
+        roi_top, roi_left = max(top - pad_y, 0), max(left - pad_x, 0)
+        roi_bottom = min(bottom + pad_y, image.shape[0])
+        roi_right = min(right + pad_x, image.shape[1])
+        
+        roi = self._prepare_for_detection(image[roi_top:roi_bottom, roi_left:roi_right])
+        
+        best, best_overlap = location, 0.0
+        for (c_top, c_right, c_bottom, c_left), _ in self.detector.detect(roi):
+            candidate = (c_top + roi_top, c_right + roi_left, c_bottom + roi_top, c_left + roi_left)
+            overlap = _box_iou(candidate, location)
+            if overlap > best_overlap:
+                best, best_overlap = candidate, overlap
+        return best
+    
+    def _detection_input(self, image: np.ndarray, rgb_image: Optional[np.ndarray] = None) -> Tuple[np.ndarray, float]:
+        """
+        Build the image the detector runs on.
+        
+        Args:
+            image: Input image as numpy array
+            rgb_image: The image already converted by _prepare_for_detection, if available
+            
+        Returns:
+            The converted, possibly downscaled image and its scale relative to the input
+        """
+        height, width = image.shape[:2]
+        scale = self._detection_scale(image)
+        if scale < 1.0:
+            proxy_size = (max(int(round(width * scale)), 1), max(int(round(height * scale)), 1))
+            source = rgb_image if rgb_image is not None else image
+            proxy = cv2.resize(source, proxy_size, interpolation=cv2.INTER_AREA)
+            if rgb_image is None:
+                proxy = self._prepare_for_detection(proxy)
+            return proxy, scale
+        return (rgb_image if rgb_image is not None else self._prepare_for_detection(image)), 1.0
+    
+    def _faces_from_detections(self, image: np.ndarray, detections: List[Tuple[Tuple[int, int, int, int], float]],
+                               scale: float) -> List[Dict]:
+        """
+        Turn detector output into face records at full resolution.
+        
+        Args:
+            image: Full resolution input image
+            detections: Boxes and scores found on the detection input
+            scale: Scale of the detection input relative to the image
+            
+        Returns:
+            List of face detection results; 'encoding' is None until encode_faces is called
+        """
+        height, width = image.shape[:2]
+        faces = []
+        for i, ((top, right, bottom, left), score) in enumerate(detections):
+            location = (top, right, bottom, left)
+            if scale < 1.0:
+                # Map the proxy box back to full resolution
+                location = (
+                    max(int(top / scale), 0),
+                    min(int(round(right / scale)), width),
+                    min(int(round(bottom / scale)), height),
+                    max(int(left / scale), 0),
+                )
+                if self.refine_detections:
+                    location = self._refine_location(image, location)
+            faces.append({
+                'id': i,
+                'location': location,  # (top, right, bottom, left)
+                'encoding': None,
+                'confidence': score
+            })
+        return faces
+    
+    @timed_stage("locate_faces")
+    def locate_faces(self, image: np.ndarray, rgb_image: Optional[np.ndarray] = None) -> List[Dict]:
+        """
+        Find face locations without computing face encodings.
+        
+        When detection_max_side or detection_scale is set, the detector runs
+        on a downscaled proxy of the image and the boxes are mapped back to
+        full resolution (optionally refined on full-resolution regions when
+        refine_detections is set).
+        
+        Args:
+            image: Input image as numpy array
+            rgb_image: The image already converted by _prepare_for_detection, if available
+            
+        Returns:
+            List of face detection results; 'encoding' is None until encode_faces is called
+        """
+        try:
+            detection_input, scale = self._detection_input(image, rgb_image)
+            return self._faces_from_detections(image, self.detector.detect(detection_input), scale)
+            
+        except Exception as e:
+            logger.error(f"Error locating faces: {str(e)}")
+            return []
+    
+    @timed_stage("locate_faces")
+    def locate_faces_batch(self, images: List[np.ndarray]) -> List[List[Dict]]:
+        """
+        Find face locations in several images, with one detector call where the backend batches.
+        
+        Args:
+            images: Input images as numpy arrays
+            
+        Returns:
+            Per image, the face detection results of locate_faces
+        """
+        try:
+            inputs = [self._detection_input(image) for image in images]
+            detections = self.detector.detect_batch([detection_input for detection_input, _ in inputs])
+            return [
+                self._faces_from_detections(image, image_detections, scale)
+                for image, (_, scale), image_detections in zip(images, inputs, detections)
+            ]
+            
+        except Exception as e:
+            logger.error(f"Error locating faces in batch: {str(e)}")
+            return [self.locate_faces(image) for image in images]
+    
+    @timed_stage("encode_faces")
+    def encode_faces(self, image: np.ndarray, faces: List[Dict],
+                     rgb_image: Optional[np.ndarray] = None) -> List[Dict]:
+        """
+        Compute the 128-d encodings of faces whose locations are already known.
+        
+        Faces that already carry an encoding keep it, and faces the encoder
+        cannot handle are dropped. The input records are not modified.
+        
+        Args:
+            image: Image the faces were located in
+            faces: Face detection results from locate_faces
+            rgb_image: The image already converted by _prepare_for_detection, if available
+            
+        Returns:
+            New face records that all have an encoding
+        """
+        try:
+            pending = [face['location'] for face in faces if face['encoding'] is None]
+            if not pending:
+                return faces
+            
+            if rgb_image is None:
+                rgb_image = self._prepare_for_detection(image)
+            face_encodings = iter(_load_face_recognition().face_encodings(rgb_image, pending))
+            
+            # Build new records so callers' (possibly cached) face records are not mutated
+            encoded_faces = []
+            for face in faces:
+                encoding = face['encoding'] if face['encoding'] is not None else next(face_encodings, None)
+                if encoding is not None:
+                    encoded_faces.append({**face, 'encoding': encoding})
+            return encoded_faces
+            
+        except Exception as e:
+            logger.error(f"Error encoding faces: {str(e)}")
+            return []
+    
+    @timed_stage("detect_faces")
+    def detect_faces(self, image: np.ndarray, with_encodings: bool = True) -> List[Dict]:
         """
         Detect faces in the image using face_recognition library.
         
         Args:
             image: Input image as numpy array
+            with_encodings: Also compute face encodings, the most expensive step
             
         Returns:
             List of face detection results with locations and encodings
         """
         try:
-            # Convert BGR to RGB if needed
-            if len(image.shape) == 3 and image.shape[2] == 3:
-                rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            else:
-                rgb_image = image
-                
-            # Find face locations and encodings
-            face_locations = face_recognition.face_locations(rgb_image)
-            face_encodings = face_recognition.face_encodings(rgb_image, face_locations)
-            
-            faces = []
-            for i, (location, encoding) in enumerate(zip(face_locations, face_encodings)):
-                faces.append({
-                    'id': i,
-                    'location': location,  # (top, right, bottom, left)
-                    'encoding': encoding,
-                    'confidence': 0.9  # Default confidence
-                })
-                
-            return faces
-            
+            # Only the encoder needs the full-resolution converted image
+            rgb_image = self._prepare_for_detection(image) if with_encodings else None
         except Exception as e:
             logger.error(f"Error detecting faces: {str(e)}")
             return []
+        
+        faces = self.locate_faces(image, rgb_image)
+        if with_encodings and faces:
+            faces = self.encode_faces(image, faces, rgb_image)
+        return faces
     
-    def generate_adversarial_noise(self, face_region: np.ndarray, target_encoding: np.ndarray) -> np.ndarray:
+    def _scratch_buffer(self, shape: Tuple[int, ...]) -> np.ndarray:
+        """
+        Return a float32 scratch array of the given shape.
+        
+        The backing buffer is kept on the instance and only grows, so cloaking
+        many faces reuses one allocation instead of creating temporaries per face.
+        
+        Args:
+            shape: Shape of the required array
+            
+        Returns:
+            Uninitialized float32 view into the scratch buffer
+        """
+        size = int(np.prod(shape))
+        if self._scratch.size < size:
+            self._scratch = np.empty(size, dtype=np.float32)
+        return self._scratch[:size].reshape(shape)
+    
+    @timed_stage("generate_adversarial_noise")
+    def generate_adversarial_noise(self, face_region: np.ndarray,
+                                   target_encoding: Optional[np.ndarray] = None,
+                                   out: Optional[np.ndarray] = None) -> np.ndarray:
         """
         Generate adversarial noise to shift face embedding away from original.
         
+        When a noise bank is set, the noise is cut from its pre-blurred fields
+        instead of being drawn and smoothed here.
+        
         Args:
             face_region: Face region as numpy array
-            target_encoding: Target face encoding to move away from
+            target_encoding: Target face encoding to move away from (unused by the random-noise cloak)
+            out: float32 array with the shape of face_region to write the noise into
             
         Returns:
-            Adversarial noise array
+            Adversarial noise array (float32)
         """
         try:
+            if self.noise_bank is not None:
+                return self.noise_bank.sample(face_region, self.perturbation_strength, out=out)
+            
             # Simple noise generation approach
             # In a full Fawkes implementation, this would use gradient-based optimization
+            noise = out if out is not None else np.empty(face_region.shape, dtype=np.float32)
             
             # Generate random noise with controlled magnitude
-            noise = np.random.normal(0, self.perturbation_strength, face_region.shape)
+            self._rng.standard_normal(dtype=np.float32, out=noise)
+            noise *= self.perturbation_strength
             
-            # Apply Gaussian smoothing to make noise less detectable
-            if len(noise.shape) == 3:
-                for channel in range(noise.shape[2]):
-                    noise[:, :, channel] = cv2.GaussianBlur(noise[:, :, channel], (3, 3), 0.5)
-            else:
-                noise = cv2.GaussianBlur(noise, (3, 3), 0.5)
+            # Apply Gaussian smoothing to make noise less detectable (all channels at once)
+            cv2.GaussianBlur(noise, (3, 3), 0.5, dst=noise)
             
             # Clip noise to reasonable bounds
-            noise = np.clip(noise, -0.1, 0.1)
+            np.clip(noise, -0.1, 0.1, out=noise)
             
             return noise
             
         except Exception as e:
             logger.error(f"Error generating adversarial noise: {str(e)}")
-            return np.zeros_like(face_region)
+            return np.zeros(face_region.shape, dtype=np.float32)
     
-    def apply_cloaking_to_face(self, image: np.ndarray, face_info: Dict) -> np.ndarray:
+    @timed_stage("generate_adversarial_noise_batch")
+    def generate_adversarial_noise_batch(self, face_regions: List[np.ndarray]) -> List[np.ndarray]:
         """
-        Apply cloaking perturbations to a specific face region.
+        Generate adversarial noise for many face regions in a single pass.
+        
+        The Gaussian noise for every region is drawn into one float32 buffer in
+        one call and clipped in one call; only the smoothing runs per region,
+        in place and over all channels at once. When a noise bank is set, each
+        region's noise is cut from the bank into the shared buffer instead.
         
         Args:
-            image: Full image as numpy array
+            face_regions: Face regions as numpy arrays
+            
+        Returns:
+            Adversarial noise arrays (float32 views into one buffer), one per face region
+        """
+        try:
+            sizes = [region.size for region in face_regions]
+            offsets = np.concatenate(([0], np.cumsum(sizes))).astype(int)
+            
+            if self.noise_bank is not None:
+                noise_buffer = np.empty(int(offsets[-1]), dtype=np.float32)
+                return [
+                    self.noise_bank.sample(region, self.perturbation_strength,
+                                           out=noise_buffer[start:end].reshape(region.shape))
+                    for region, start, end in zip(face_regions, offsets[:-1], offsets[1:])
+                ]
+            
+            # Generate random noise for all faces at once
+            noise_buffer = self._rng.standard_normal(int(offsets[-1]), dtype=np.float32)
+            noise_buffer *= self.perturbation_strength
+            
+            noises = []
+            for region, start, end in zip(face_regions, offsets[:-1], offsets[1:]):
+                noise = noise_buffer[start:end].reshape(region.shape)
+                if region.size:
+                    cv2.GaussianBlur(noise, (3, 3), 0.5, dst=noise)
+                noises.append(noise)
+            
+            # Clip noise to reasonable bounds
+            np.clip(noise_buffer, -0.1, 0.1, out=noise_buffer)
+            
+            return noises
+            
+        except Exception as e:
+            logger.error(f"Error generating batched adversarial noise: {str(e)}")
+            return [np.zeros(region.shape, dtype=np.float32) for region in face_regions]
+    
+    @timed_stage("generate_optimized_noise")
+    def generate_optimized_noise(self, images_faces: List[Tuple[np.ndarray, List[Dict]]]) -> List[List[Optional[np.ndarray]]]:
+        """
+        Optimize perturbations that push face embeddings away from the originals.
+        
+        All faces of all given images are optimized together, so every
+        iteration needs a single call to the face encoder. Faces stop being
+        optimized once their embedding is target_shift away from the original,
+        and all of them when the iterations would overrun the request's
+        deadline (see OPTIMIZATION_TIME_SHARE).
+        
+        Args:
+            images_faces: (image, faces) pairs
+            
+        Returns:
+            Per image, one float32 noise array per face (None for empty face regions),
+            in the same units as generate_adversarial_noise
+        """
+        jobs, slots = [], []
+        noises: List[List[Optional[np.ndarray]]] = [[None] * len(faces) for _, faces in images_faces]
+        for image_index, (image, faces) in enumerate(images_faces):
+            for face_index, face_info in enumerate(faces):
+                top, right, bottom, left = face_info['location']
+                if bottom > top and right > left:
+                    jobs.append((image, face_info['location']))
+                    slots.append((image_index, face_index))
+        if not jobs:
+            return noises
+        
+        deadline = None
+        if self.deadline is not None:
+            now = time.time()
+            deadline = now + max(self.deadline - now, 0.0) * OPTIMIZATION_TIME_SHARE
+        
+        try:
+            optimizer = EmbeddingOptimizer(
+                encode=lambda canvas, locations: _load_face_recognition().face_encodings(
+                    self._prepare_for_detection(canvas), locations
+                ),
+                budget=self.perturbation_strength * 255,
+                step_size=self.learning_rate * 255,
+                max_iterations=self.max_iterations,
+                target_distance=self.target_shift,
+                samples=self.optimization_samples,
+                rng=self._rng,
+                deadline=deadline,
+            )
+            perturbations, distances = optimizer.optimize(jobs)
+            logger.debug(f"Optimized {len(jobs)} face(s), embedding distances: {[round(d, 3) for d in distances]}")
+            
+            for (image_index, face_index), perturbation in zip(slots, perturbations):
+                image = images_faces[image_index][0]
+                top, right, bottom, left = images_faces[image_index][1][face_index]['location']
+                noises[image_index][face_index] = (perturbation / 255).reshape(image[top:bottom, left:right].shape)
+            return noises
+            
+        except Exception as e:
+            logger.error(f"Error optimizing adversarial noise, falling back to random noise: {str(e)}")
+            for (image_index, face_index), (image, location) in zip(slots, jobs):
+                top, right, bottom, left = location
+                noises[image_index][face_index] = self.generate_adversarial_noise(image[top:bottom, left:right])
+            return noises
+    
+    @timed_stage("apply_cloaking_to_face")
+    def apply_cloaking_to_face(self, image: np.ndarray, face_info: Dict,
+                               noise: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Apply cloaking perturbations to a specific face region, in place.
+        
+        Only the face region of the image is touched; the rest of the image is
+        neither read nor copied.
+        
+        Args:
+            image: Full image as numpy array, modified in place
             face_info: Face information dictionary
+            noise: Precomputed float32 noise for the face region (generated if
+                omitted); it is used as scratch space and overwritten
             
         Returns:
-            Image with cloaked face
+            The same image array, with the face cloaked
         """
         try:
-            cloaked_image = image.copy()
             top, right, bottom, left = face_info['location']
             
-            # Extract face region
+            # View of the face region
             face_region = image[top:bottom, left:right]
             
             if face_region.size == 0:
-                return cloaked_image
+                return image
             
-            # Generate adversarial noise
-            noise = self.generate_adversarial_noise(face_region, face_info['encoding'])
+            # Generate adversarial noise into the reusable scratch buffer
+            if noise is None:
+                noise = self.generate_adversarial_noise(
+                    face_region, face_info.get('encoding'), out=self._scratch_buffer(face_region.shape)
+                )
             
             # Apply noise to face region
-            cloaked_face = face_region.astype(np.float32) + noise * 255
-            cloaked_face = np.clip(cloaked_face, 0, 255).astype(np.uint8)
+            noise *= 255
+            np.add(noise, face_region, out=noise)
+            np.clip(noise, 0, 255, out=noise)
             
-            # Replace face region in image
-            cloaked_image[top:bottom, left:right] = cloaked_face
+            # Write the cloaked face back into the image
+            face_region[...] = noise
             
-            return cloaked_image
+            return image
             
         except Exception as e:
             logger.error(f"Error applying cloaking to face: {str(e)}")
             return image
     
-    def cloak_image(self, image: np.ndarray) -> np.ndarray:
+    def cloak_image(self, image: np.ndarray, inplace: bool = False,
+                    faces: Optional[List[Dict]] = None,
+                    on_face: Optional[Callable[[int, Dict], None]] = None) -> np.ndarray:
         """
         Apply face cloaking to all faces in an image.
         
         Args:
             image: Input image as numpy array
+            inplace: Cloak the given array directly instead of a copy of it
+            faces: Previously detected faces of this image (detected if omitted)
+            on_face: Called with the index and record of every face once it is cloaked
             
         Returns:
             Cloaked image as numpy array
         """
         try:
-            logger.info("Starting face cloaking process")
+            logger.debug("Starting face cloaking process")
             
-            # Detect faces in the image
-            faces = self.detect_faces(image)
+            # Locate faces in the image; cloaking needs no encodings
+            if faces is None:
+                faces = self.detect_faces(image, with_encodings=False)
             
             if not faces:
-                logger.info("No faces detected in image")
+                logger.debug("No faces detected in image")
                 return image
             
-            logger.info(f"Detected {len(faces)} face(s) in image")
+            logger.debug(f"Detected {len(faces)} face(s) in image")
             
-            # Apply cloaking to each face
-            cloaked_image = image.copy()
-            for face_info in faces:
-                cloaked_image = self.apply_cloaking_to_face(cloaked_image, face_info)
+            # Optimized perturbations are computed from the untouched image
+            if self.cloak_method == "optimize":
+                noises = self.generate_optimized_noise([(image, faces)])[0]
+            else:
+                noises = [None] * len(faces)
+            
+            # Apply cloaking to each face in a single output buffer
+            cloaked_image = image if inplace else image.copy()
+            for index, (face_info, noise) in enumerate(zip(faces, noises)):
+                self.apply_cloaking_to_face(cloaked_image, face_info, noise=noise)
+                if on_face is not None:
+                    on_face(index, face_info)
             
-            logger.info("Face cloaking completed successfully")
+            logger.debug("Face cloaking completed successfully")
             return cloaked_image
             
         except Exception as e:
             logger.error(f"Error in cloak_image: {str(e)}")
             return image
     
-    def check_face_recognition(self, image: np.ndarray) -> Dict[str, Any]:
+    def cloak_images(self, images: List[np.ndarray], inplace: bool = False) -> List[np.ndarray]:
+        """
+        Apply face cloaking to all faces in a batch of images.
+        
+        Faces are detected in every image first, then the perturbations for
+        all face crops are generated together in one batched pass.
+        
+        Args:
+            images: Input images as numpy arrays
+            inplace: Cloak the given arrays directly instead of copies of them
+            
+        Returns:
+            Cloaked images as numpy arrays, in input order
+        """
+        try:
+            logger.debug(f"Starting batch face cloaking for {len(images)} image(s)")
+            
+            # Detect faces in every image, batched where the detector supports it
+            optimize = self.cloak_method == "optimize"
+            faces_per_image = self.locate_faces_batch(images)
+            
+            # Optimized perturbations for all faces of the batch, from the untouched images
+            if optimize:
+                optimized_noises = self.generate_optimized_noise(list(zip(images, faces_per_image)))
+            
+            noises = []
+            
+            # One output buffer per image that has faces
+            cloaked_images = [
+                image if inplace or not faces else image.copy()
+                for image, faces in zip(images, faces_per_image)
+            ]
+            
+            # Collect the non-empty face crops of the whole batch
+            crops = []
+            for image_index, (image, faces) in enumerate(zip(cloaked_images, faces_per_image)):
+                for face_index, face_info in enumerate(faces):
+                    top, right, bottom, left = face_info['location']
+                    face_region = image[top:bottom, left:right]
+                    if face_region.size:
+                        crops.append((image_index, face_info, face_region))
+                        if optimize:
+                            noises.append(optimized_noises[image_index][face_index])
+            
+            # Generate the random noise for all faces in one pass
+            if not optimize:
+                noises = self.generate_adversarial_noise_batch([region for _, _, region in crops])
+            
+            # Apply cloaking to each face
+            for (image_index, face_info, _), noise in zip(crops, noises):
+                self.apply_cloaking_to_face(cloaked_images[image_index], face_info, noise=noise)
+            
+            logger.debug(f"Batch face cloaking completed: {len(crops)} face(s) in {len(images)} image(s)")
+            return cloaked_images
+            
+        except Exception as e:
+            logger.error(f"Error in cloak_images: {str(e)}")
+            return list(images)
+    
+    def check_face_recognition(self, image: np.ndarray, faces: Optional[List[Dict]] = None,
+                               gallery: Optional[FaceGallery] = None) -> Dict[str, Any]:
         """
         Check if faces in the image can be recognized by face recognition systems.
         
+        With a non-empty gallery, every face is matched against the enrolled
+        identities and the protection level follows the match rate; otherwise
+        a confidence is estimated from the encodings alone.
+        
         Args:
             image: Input image as numpy array
+            faces: Previously detected faces of this image; missing encodings are computed
+            gallery: Reference gallery of known identities
             
         Returns:
             Dictionary with protection analysis results
         """
         try:
-            logger.info("Checking face recognition protection")
+            logger.debug("Checking face recognition protection")
             
-            # Detect faces
-            faces = self.detect_faces(image)
+            # Detect faces, reusing known locations and encodings
+            if faces is None:
+                faces = self.detect_faces(image)
+            elif faces:
+                faces = self.encode_faces(image, faces)
             
             if not faces:
                 return {
@@ -188,6 +702,9 @@ class FaceCloaker:
                     "message": "No faces detected - image is protected"
                 }
             
+            if gallery is not None and gallery.count:
+                return self._check_against_gallery(faces, gallery)
+            
             # Analyze each face
             confidence_scores = []
             for face in faces:
@@ -231,6 +748,111 @@ class FaceCloaker:
                 "message": f"Error analyzing image: {str(e)}"
             }
     
+    def _check_against_gallery(self, faces: List[Dict], gallery: FaceGallery) -> Dict[str, Any]:
+        """
+        Protection analysis from real matches of the faces against a gallery.
+        
+        Args:
+            faces: Detected faces with encodings
+            gallery: Non-empty reference gallery
+            
+        Returns:
+            Dictionary with protection analysis results, including per-face matches
+        """
+        matches = gallery.match(np.asarray([face['encoding'] for face in faces], dtype=np.float32))
+        match_rate = sum(match["matched"] for match in matches) / len(matches)
+        # Similarity to the closest enrolled face, on the same scale as compare_faces
+        confidence_scores = [max(1.0 - match["distance"], 0.0) for match in matches]
+        
+        if match_rate == 0:
+            protection_level = "high"
+            is_protected = True
+            message = "No face was matched to a known identity"
+        elif match_rate < 0.5:
+            protection_level = "medium"
+            is_protected = True
+            message = "Some faces were matched to known identities"
+        else:
+            protection_level = "low"
+            is_protected = False
+            message = "Faces were matched to known identities"
+        
+        return {
+            "is_protected": is_protected,
+            "faces_detected": len(faces),
+            "confidence_scores": confidence_scores,
+            "protection_level": protection_level,
+            "message": message,
+            "match_rate": match_rate,
+            "matches": [{**match, "face_id": face['id']} for face, match in zip(faces, matches)],
+            "gallery_size": gallery.count
+        }
+    
+    def cloak_and_verify(self, image: np.ndarray, inplace: bool = False,
+                         faces: Optional[List[Dict]] = None) -> Tuple[np.ndarray, Dict[str, Any], List[Dict]]:
+        """
+        Cloak an image and measure how far each face moved in embedding space.
+        
+        Unlike cloak_image followed by compare_faces, the faces are located
+        once: the original encodings come from the cloaking pass and the
+        cloaked image is only re-encoded at the known face locations.
+        
+        Args:
+            image: Input image as numpy array
+            inplace: Cloak the given array directly instead of a copy of it
+            faces: Previously detected faces of this image; missing encodings are computed
+            
+        Returns:
+            Cloaked image, comparison results in the format of compare_faces
+            with a per-face breakdown, and the original faces with encodings
+        """
+        try:
+            if faces is None:
+                faces = self.detect_faces(image)
+            elif faces:
+                faces = self.encode_faces(image, faces)
+            
+            # The original encodings are known, so the original pixels may be overwritten
+            cloaked_image = self.cloak_image(image, inplace=inplace, faces=faces)
+            cloaked_faces = self.encode_faces(cloaked_image, [{**face, 'encoding': None} for face in faces])
+            cloaked_encodings = {face['id']: face['encoding'] for face in cloaked_faces}
+            
+            per_face = []
+            for face in faces:
+                cloaked_encoding = cloaked_encodings.get(face['id'])
+                if cloaked_encoding is None:
+                    continue
+                distance = _load_face_recognition().face_distance([face['encoding']], cloaked_encoding)[0]
+                per_face.append({
+                    "id": face['id'],
+                    "location": list(face['location']),
+                    "similarity": float(1 - distance)  # Convert distance to similarity
+                })
+            
+            similarities = [entry["similarity"] for entry in per_face]
+            avg_similarity = float(np.mean(similarities)) if similarities else 0.0
+            
+            comparison = {
+                "original_faces": len(faces),
+                "cloaked_faces": len(cloaked_faces),
+                "face_similarities": similarities,
+                "average_similarity": avg_similarity,
+                "protection_effective": avg_similarity < 0.5,
+                "faces": per_face
+            }
+            return cloaked_image, comparison, faces
+            
+        except Exception as e:
+            logger.error(f"Error in cloak_and_verify: {str(e)}")
+            return image, {
+                "original_faces": 0,
+                "cloaked_faces": 0,
+                "face_similarities": [],
+                "average_similarity": 0,
+                "protection_effective": False,
+                "faces": []
+            }, faces or []
+    
     def compare_faces(self, original_image: np.ndarray, cloaked_image: np.ndarray) -> Dict[str, Any]:
         """
         Compare face recognition results between original and cloaked images.
@@ -250,7 +872,7 @@ class FaceCloaker:
             similarities = []
             if len(original_faces) == len(cloaked_faces):
                 for orig, cloak in zip(original_faces, cloaked_faces):
-                    similarity = face_recognition.face_distance([orig['encoding']], cloak['encoding'])[0]
+                    similarity = _load_face_recognition().face_distance([orig['encoding']], cloak['encoding'])[0]
                     similarities.append(1 - similarity)  # Convert distance to similarity
             
             avg_similarity = np.mean(similarities) if similarities else 0
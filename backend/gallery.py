@@ -0,0 +1,404 @@
+import argparse
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Size of the face_recognition (dlib) face encodings
+DIMENSION = 128
+
+# Gallery rows compared per matrix product in exact search
+SEARCH_CHUNK_ROWS = 65536
+
+
+def _merge_top_k(best_distances: np.ndarray, best_rows: np.ndarray, distances: np.ndarray,
+                 rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Merge a block of candidate distances into the running k best per query."""
+    all_distances = np.concatenate([best_distances, distances], axis=1)
+    all_rows = np.concatenate([best_rows, np.broadcast_to(rows, distances.shape)], axis=1)
+    if all_distances.shape[1] > k:
+        keep = np.argpartition(all_distances, k - 1, axis=1)[:, :k]
+        all_distances = np.take_along_axis(all_distances, keep, axis=1)
+        all_rows = np.take_along_axis(all_rows, keep, axis=1)
+    return all_distances, all_rows
+
+
+class FaceGallery:
+    """
+    Gallery of known face encodings for realistic protection checks.
+
+    Encodings are stored as a float32 matrix in a memory-mapped file, next
+    to the identity of every row and the squared row norms, so the gallery
+    can grow to millions of faces without being loaded into memory. Search
+    is a chunked matrix product (||q||^2 + ||g||^2 - 2 q.g) over the whole
+    gallery, or, once an index has been built for a large gallery, over the
+    rows of the nearest inverted-file (IVF) clusters only.
+
+    One process enrolls faces; other processes pick up new rows on their
+    next search.
+    """
+
+    def __init__(self, directory: str, tolerance: float = 0.6, approximate_threshold: int = 100000,
+                 nprobe: int = 8):
+        """
+        Open or create a gallery.
+
+        Args:
+            directory: Directory holding the gallery files
+            tolerance: Encoding distance at or below which two faces match
+                (face_recognition's default is 0.6)
+            approximate_threshold: Gallery size from which the IVF index is used, if built
+            nprobe: IVF clusters searched per query
+        """
+        self.directory = directory
+        self.tolerance = tolerance
+        self.approximate_threshold = approximate_threshold
+        self.nprobe = nprobe
+        self._lock = threading.Lock()
+        self._meta_mtime = None
+        self._meta: Dict[str, Any] = {"count": 0, "capacity": 0, "identities": [], "index_rows": 0, "version": 0}
+        self._encodings: Optional[np.memmap] = None
+        self._labels: Optional[np.memmap] = None
+        self._norms: Optional[np.memmap] = None
+        self._index: Optional[Dict[str, np.ndarray]] = None
+        self._identity_ids: Dict[str, int] = {}
+        os.makedirs(directory, exist_ok=True)
+        self.refresh()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @property
+    def count(self) -> int:
+        """Number of enrolled encodings."""
+        return self._meta["count"]
+
+    @property
+    def version(self) -> int:
+        """Counter bumped by every change, for cache keys."""
+        return self._meta["version"]
+
+    def refresh(self) -> None:
+        """Reload the gallery if another process changed it."""
+        try:
+            mtime = os.stat(self._path("meta.json")).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._meta_mtime:
+            return
+        with self._lock:
+            with open(self._path("meta.json")) as f:
+                self._meta = json.load(f)
+            self._meta_mtime = mtime
+            self._identity_ids = {name: i for i, name in enumerate(self._meta["identities"])}
+            self._map()
+            self._index = None
+            if self._meta["index_rows"]:
+                self._index = {
+                    name: np.load(self._path(f"index_{name}.npy"), mmap_mode="r")
+                    for name in ("centroids", "order", "offsets")
+                }
+
+    def _map(self) -> None:
+        capacity = self._meta["capacity"]
+        if capacity == 0:
+            self._encodings = self._labels = self._norms = None
+            return
+        self._encodings = np.memmap(self._path("encodings.f32"), dtype=np.float32, mode="r+",
+                                    shape=(capacity, DIMENSION))
+        self._labels = np.memmap(self._path("labels.i32"), dtype=np.int32, mode="r+", shape=(capacity,))
+        self._norms = np.memmap(self._path("norms.f32"), dtype=np.float32, mode="r+", shape=(capacity,))
+
+    def _reserve(self, rows: int) -> None:
+        """Grow the memory-mapped files (by doubling) to hold at least `rows` rows."""
+        if rows <= self._meta["capacity"]:
+            return
+        capacity = max(rows, self._meta["capacity"] * 2, 1024)
+        for name, row_bytes in (("encodings.f32", 4 * DIMENSION), ("labels.i32", 4), ("norms.f32", 4)):
+            with open(self._path(name), "ab") as f:
+                f.truncate(capacity * row_bytes)
+        self._meta["capacity"] = capacity
+        self._map()
+
+    def _save_meta(self) -> None:
+        for array in (self._encodings, self._labels, self._norms):
+            if array is not None:
+                array.flush()
+        self._meta["version"] += 1
+        tmp_path = self._path("meta.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self._meta, f)
+        os.replace(tmp_path, self._path("meta.json"))
+        self._meta_mtime = os.stat(self._path("meta.json")).st_mtime_ns
+
+    def enroll(self, entries: Iterable[Tuple[str, np.ndarray]]) -> int:
+        """
+        Add face encodings to the gallery in bulk.
+
+        Args:
+            entries: (identity, encoding) pairs; an identity may have many encodings
+
+        Returns:
+            Number of encodings added
+        """
+        entries = list(entries)
+        if not entries:
+            return 0
+        encodings = np.asarray([encoding for _, encoding in entries], dtype=np.float32).reshape(-1, DIMENSION)
+
+        with self._lock:
+            labels = np.empty(len(entries), dtype=np.int32)
+            for i, (identity, _) in enumerate(entries):
+                if identity not in self._identity_ids:
+                    self._identity_ids[identity] = len(self._meta["identities"])
+                    self._meta["identities"].append(identity)
+                labels[i] = self._identity_ids[identity]
+
+            start = self._meta["count"]
+            end = start + len(entries)
+            self._reserve(end)
+            self._encodings[start:end] = encodings
+            self._labels[start:end] = labels
+            self._norms[start:end] = np.einsum("ij,ij->i", encodings, encodings)
+            self._meta["count"] = end
+            self._save_meta()
+        return len(entries)
+
+    def build_index(self, nlist: Optional[int] = None, iterations: int = 10, sample_size: int = 65536,
+                    seed: int = 0) -> Dict[str, Any]:
+        """
+        Build the IVF index: k-means clusters of the gallery with the rows of each cluster.
+
+        Rows enrolled after the index was built are searched exactly until the next build.
+
+        Args:
+            nlist: Number of clusters (defaults to the square root of the gallery size)
+            iterations: k-means iterations
+            sample_size: Rows used to train the clusters
+            seed: Seed of the training sample and initial centroids
+
+        Returns:
+            Index statistics
+        """
+        with self._lock:
+            count = self._meta["count"]
+            if count == 0:
+                raise ValueError("The gallery is empty")
+            encodings = self._encodings[:count]
+            norms = self._norms[:count]
+            nlist = min(max(int(nlist or np.sqrt(count)), 1), count)
+
+            # Train the centroids with Lloyd's algorithm on a sample
+            rng = np.random.default_rng(seed)
+            sample = np.asarray(encodings[np.sort(rng.choice(count, min(sample_size, count), replace=False))])
+            centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+            for _ in range(iterations):
+                assignment = self._nearest_centroids(sample, centroids)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assignment, sample)
+                sizes = np.bincount(assignment, minlength=nlist)
+                filled = sizes > 0
+                centroids[filled] = sums[filled] / sizes[filled, np.newaxis]
+
+            # Assign every row, in chunks, and group the rows per cluster
+            assignment = np.concatenate([
+                self._nearest_centroids(np.asarray(encodings[start:start + SEARCH_CHUNK_ROWS]), centroids)
+                for start in range(0, count, SEARCH_CHUNK_ROWS)
+            ])
+            order = np.argsort(assignment, kind="stable").astype(np.int64)
+            offsets = np.searchsorted(assignment[order], np.arange(nlist + 1)).astype(np.int64)
+
+            for name, array in (("centroids", centroids), ("order", order), ("offsets", offsets)):
+                np.save(self._path(f"index_{name}.npy"), array)
+            self._index = {"centroids": centroids, "order": order, "offsets": offsets}
+            self._meta["index_rows"] = count
+            self._save_meta()
+            logger.info(f"Built gallery index with {nlist} cluster(s) over {count} encoding(s)")
+            return {"nlist": nlist, "indexed_rows": count}
+
+    @staticmethod
+    def _nearest_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        distances = np.einsum("ij,ij->i", centroids, centroids)[np.newaxis, :] - 2 * vectors @ centroids.T
+        return np.argmin(distances, axis=1)
+
+    def _search_rows(self, queries: np.ndarray, query_norms: np.ndarray, rows: np.ndarray,
+                     k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact search restricted to the given (sorted) gallery rows."""
+        best_distances = np.full((len(queries), 0), np.inf, dtype=np.float32)
+        best_rows = np.full((len(queries), 0), -1, dtype=np.int64)
+        for start in range(0, len(rows), SEARCH_CHUNK_ROWS):
+            block = rows[start:start + SEARCH_CHUNK_ROWS]
+            distances = query_norms[:, np.newaxis] + self._norms[block][np.newaxis, :] - 2 * queries @ self._encodings[block].T
+            best_distances, best_rows = _merge_top_k(best_distances, best_rows, distances, block, k)
+        return best_distances, best_rows
+
+    def _search_range(self, queries: np.ndarray, query_norms: np.ndarray, start: int, end: int,
+                      k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact search over a contiguous range of gallery rows, without gathering them."""
+        best_distances = np.full((len(queries), 0), np.inf, dtype=np.float32)
+        best_rows = np.full((len(queries), 0), -1, dtype=np.int64)
+        for block_start in range(start, end, SEARCH_CHUNK_ROWS):
+            block_end = min(block_start + SEARCH_CHUNK_ROWS, end)
+            distances = (query_norms[:, np.newaxis] + self._norms[block_start:block_end][np.newaxis, :]
+                         - 2 * queries @ self._encodings[block_start:block_end].T)
+            best_distances, best_rows = _merge_top_k(best_distances, best_rows, distances,
+                                                     np.arange(block_start, block_end), k)
+        return best_distances, best_rows
+
+    def search(self, queries: np.ndarray, k: int = 1,
+               exact: Optional[bool] = None) -> Tuple[np.ndarray, List[List[Optional[str]]]]:
+        """
+        Find the nearest gallery encodings of each query.
+
+        Args:
+            queries: Query encodings, shape (n, 128) or (128,)
+            k: Neighbours per query
+            exact: Force exact (True) or approximate (False) search; by default the
+                index is used for galleries of at least approximate_threshold encodings
+
+        Returns:
+            Euclidean distances, shape (n, k) sorted ascending (inf where the gallery
+            has fewer than k encodings), and the matching identities (None for padding)
+        """
+        self.refresh()
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, DIMENSION)
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+
+        with self._lock:
+            count = self._meta["count"]
+            indexed = self._meta["index_rows"] if self._index is not None else 0
+            if exact is None:
+                exact = indexed == 0 or count < self.approximate_threshold
+
+            if count == 0:
+                distances = np.empty((len(queries), 0), dtype=np.float32)
+                rows = np.empty((len(queries), 0), dtype=np.int64)
+            elif exact or indexed == 0:
+                distances, rows = self._search_range(queries, query_norms, 0, count, k)
+            else:
+                # Rows of the nprobe nearest clusters, plus rows enrolled since the index was built
+                centroids, order, offsets = self._index["centroids"], self._index["order"], self._index["offsets"]
+                nprobe = min(self.nprobe, len(centroids))
+                centroid_distances = (np.einsum("ij,ij->i", centroids, centroids)[np.newaxis, :]
+                                      - 2 * queries @ centroids.T)
+                probes = np.argpartition(centroid_distances, nprobe - 1, axis=1)[:, :nprobe]
+                results = []
+                for query_index, clusters in enumerate(probes):
+                    candidates = np.sort(np.concatenate([order[offsets[c]:offsets[c + 1]] for c in clusters]))
+                    query = queries[query_index:query_index + 1]
+                    query_norm = query_norms[query_index:query_index + 1]
+                    distances, rows = self._search_rows(query, query_norm, candidates, k)
+                    if indexed < count:
+                        tail = self._search_range(query, query_norm, indexed, count, k)
+                        distances, rows = _merge_top_k(distances, rows, tail[0], tail[1], k)
+                    results.append((distances, rows))
+                width = max(d.shape[1] for d, _ in results)
+                distances = np.full((len(queries), width), np.inf, dtype=np.float32)
+                rows = np.full((len(queries), width), -1, dtype=np.int64)
+                for query_index, (d, r) in enumerate(results):
+                    distances[query_index, :d.shape[1]] = d[0]
+                    rows[query_index, :r.shape[1]] = r[0]
+
+            # Sort the k best and convert squared distances to distances
+            ordering = np.argsort(distances, axis=1)[:, :k]
+            distances = np.take_along_axis(distances, ordering, axis=1)
+            rows = np.take_along_axis(rows, ordering, axis=1)
+            identities = [
+                [self._meta["identities"][self._labels[row]] if row >= 0 else None for row in query_rows]
+                for query_rows in rows
+            ]
+
+        padding = k - distances.shape[1]
+        if padding > 0:
+            distances = np.pad(distances, ((0, 0), (0, padding)), constant_values=np.inf)
+            identities = [names + [None] * padding for names in identities]
+        return np.sqrt(np.maximum(distances, 0)), identities
+
+    def match(self, queries: np.ndarray) -> List[Dict[str, Any]]:
+        """
+        Match query encodings against the gallery.
+
+        Args:
+            queries: Query encodings, shape (n, 128)
+
+        Returns:
+            Per query: the closest identity, its distance and whether it is within tolerance
+        """
+        distances, identities = self.search(queries, k=1)
+        return [
+            {
+                "identity": names[0],
+                "distance": float(row[0]) if np.isfinite(row[0]) else None,
+                "matched": bool(row[0] <= self.tolerance),
+            }
+            for row, names in zip(distances, identities)
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the gallery size and index state."""
+        self.refresh()
+        return {
+            "encodings": self._meta["count"],
+            "identities": len(self._meta["identities"]),
+            "indexed_encodings": self._meta["index_rows"],
+            "index_clusters": len(self._index["centroids"]) if self._index is not None else 0,
+            "tolerance": self.tolerance,
+        }
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    """Command-line bulk enrollment and index building."""
+    import config
+    from workers import enroll_task
+
+    parser = argparse.ArgumentParser(description="Manage the InvisiFace reference gallery")
+    parser.add_argument("--gallery-dir", default=config.GALLERY_DIR, help="Gallery directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+    enroll_parser = commands.add_parser("enroll", help="Enroll a directory of face images")
+    enroll_parser.add_argument("directory", help="One subdirectory of images per identity, "
+                                                 "or a flat directory with --identity")
+    enroll_parser.add_argument("--identity", help="Identity of all images in a flat directory")
+    enroll_parser.add_argument("--batch-size", type=int, default=64, help="Images encoded per batch")
+    index_parser = commands.add_parser("index", help="Build the approximate search index")
+    index_parser.add_argument("--nlist", type=int, default=None, help="Number of clusters")
+    commands.add_parser("stats", help="Show the gallery size")
+    args = parser.parse_args(argv)
+
+    if not args.gallery_dir:
+        parser.error("Set INVISIFACE_GALLERY_DIR or pass --gallery-dir")
+    logging.basicConfig(level=logging.INFO)
+    gallery = FaceGallery(args.gallery_dir, tolerance=config.GALLERY_TOLERANCE)
+
+    if args.command == "enroll":
+        images = []
+        for root, _, names in os.walk(args.directory):
+            identity = args.identity or os.path.relpath(root, args.directory)
+            if identity == ".":
+                continue
+            images.extend((identity, os.path.join(root, name)) for name in sorted(names))
+
+        enrolled = 0
+        for start in range(0, len(images), args.batch_size):
+            batch = images[start:start + args.batch_size]
+            uploads = []
+            for _, path in batch:
+                with open(path, "rb") as f:
+                    uploads.append((path, f.read()))
+            encodings = enroll_task(uploads)
+            enrolled += gallery.enroll(
+                (identity, encoding) for (identity, _), encoding in zip(batch, encodings) if encoding is not None
+            )
+            logger.info(f"Enrolled {enrolled} of {min(start + len(batch), len(images))} image(s)")
+    elif args.command == "index":
+        gallery.build_index(nlist=args.nlist)
+
+    print(json.dumps(gallery.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
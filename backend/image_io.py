@@ -0,0 +1,301 @@
+import io
+import math
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, Optional, Tuple, Union
+import numpy as np
+from PIL import Image
+from metrics import timed_stage
+
+
+class _MemoryReader(io.RawIOBase):
+    """Seekable file object reading a memoryview in place (io.BytesIO would copy it)."""
+
+    def __init__(self, view: memoryview):
+        self._view = view.cast("B")
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        count = max(min(len(buffer), len(self._view) - self._position), 0)
+        buffer[:count] = self._view[self._position:self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(base + offset, 0)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+
+def _open_buffer(contents: Union[bytes, memoryview]) -> BinaryIO:
+    """
+    Wrap encoded image bytes in a file object for PIL.
+
+    Workers receive uploads passed through shared memory as memoryviews,
+    which are decoded in place rather than copied first.
+    """
+    if isinstance(contents, memoryview):
+        return _MemoryReader(contents)
+    return io.BytesIO(contents)
+
+
+@timed_stage("decode_image")
+def decode_image(contents: bytes) -> np.ndarray:
+    """
+    Decode uploaded image bytes into a numpy array.
+
+    Args:
+        contents: Raw bytes of the uploaded file
+
+    Returns:
+        Decoded image as numpy array
+    """
+    image = Image.open(_open_buffer(contents))
+    return np.array(image)
+
+
+@timed_stage("decode_proxy")
+def decode_proxy(contents: bytes, max_side: int) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """
+    Decode uploaded image bytes at reduced resolution, for detection-only work.
+
+    JPEG images are decoded in draft mode: the decoder scales the DCT blocks
+    by 1/2, 1/4 or 1/8, choosing the smallest result whose longest side is
+    still at least max_side, which skips most of the decoding work. Other
+    formats are decoded at full resolution.
+
+    Args:
+        contents: Raw bytes of the uploaded file
+        max_side: Longest side the decoded image needs
+
+    Returns:
+        Decoded image as numpy array and the (width, height) of the full image
+    """
+    image = Image.open(_open_buffer(contents))
+    full_size = image.size
+    longest = max(full_size)
+    if image.format == "JPEG" and longest > max_side:
+        factor = max_side / float(longest)
+        image.draft(image.mode, (math.ceil(full_size[0] * factor), math.ceil(full_size[1] * factor)))
+    return np.array(image), full_size
+
+
+_pixel_limit_lock = threading.Lock()
+
+
+@contextmanager
+def pixel_limit(max_pixels: int) -> Iterator[None]:
+    """
+    Raise Pillow's decompression-bomb guard to max_pixels while images are opened in the block.
+
+    The guard is a module global of Pillow, checked when an image is opened;
+    it is restored when the block exits. Blocks are serialized, so keep them
+    to the Image.open call: callers that accept larger images check the
+    pixel count against their own limit right after.
+
+    Args:
+        max_pixels: Largest image the block accepts (Pillow refuses twice the guard)
+    """
+    with _pixel_limit_lock:
+        previous = Image.MAX_IMAGE_PIXELS
+        if previous is not None:
+            Image.MAX_IMAGE_PIXELS = max(previous, max_pixels)
+        try:
+            yield
+        finally:
+            Image.MAX_IMAGE_PIXELS = previous
+
+
+def image_size(source: Union[bytes, BinaryIO], max_pixels: Optional[int] = None) -> Tuple[int, int]:
+    """
+    Read the (width, height) of an encoded image from its header, without decoding it.
+
+    Args:
+        source: Raw bytes of the uploaded file, or a seekable file object
+            (read from its current position, which is restored afterwards)
+        max_pixels: Raise Pillow's decompression-bomb guard to this many pixels
+            for the header read (Pillow's default guard otherwise)
+
+    Returns:
+        Width and height in pixels
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = _open_buffer(source)
+    position = source.tell()
+    try:
+        if max_pixels is None:
+            image = Image.open(source)
+        else:
+            with pixel_limit(max_pixels):
+                image = Image.open(source)
+        with image:
+            return image.size
+    finally:
+        source.seek(position)
+
+
+# Supported output formats: media type, file extension and valid compression range
+OUTPUT_FORMATS = {
+    "png": ("image/png", "png", (0, 9)),
+    "webp": ("image/webp", "webp", (0, 6)),
+    "jpeg": ("image/jpeg", "jpg", (1, 100)),
+}
+
+
+def normalize_format(output_format: str, compression: Optional[int] = None) -> str:
+    """
+    Validate an output format name and compression setting.
+
+    Args:
+        output_format: Format name, case-insensitive ("jpg" is accepted for "jpeg")
+        compression: Compression setting for the format, see encode_image
+
+    Returns:
+        Normalized format name, a key of OUTPUT_FORMATS
+
+    Raises:
+        ValueError: If the format is not supported or the compression is out of range
+    """
+    name = output_format.lower()
+    if name == "jpg":
+        name = "jpeg"
+    if name not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format: {output_format}")
+    low, high = OUTPUT_FORMATS[name][2]
+    if compression is not None and not low <= compression <= high:
+        raise ValueError(f"Compression for {name} must be between {low} and {high}")
+    return name
+
+
+def media_type(output_format: str) -> str:
+    """Return the media type of a normalized output format."""
+    return OUTPUT_FORMATS[output_format][0]
+
+
+def file_extension(output_format: str) -> str:
+    """Return the file extension of a normalized output format."""
+    return OUTPUT_FORMATS[output_format][1]
+
+
+def encode_image(image_array: np.ndarray, output_format: str = "png", compression: Optional[int] = None) -> bytes:
+    """
+    Encode a numpy image array in the requested format.
+
+    Args:
+        image_array: Image as numpy array
+        output_format: Normalized output format ("png", "webp" or "jpeg")
+        compression: PNG: zlib level 0-9 (lower is faster);
+            WebP: encoder effort 0-6 for lossless output;
+            JPEG: quality 1-100
+
+    Returns:
+        Encoded image bytes
+    """
+    buffered = io.BytesIO()
+    write_image(image_array, buffered, output_format, compression)
+    return buffered.getvalue()
+
+
+@timed_stage("encode_image")
+def write_image(image_array: np.ndarray, fileobj: BinaryIO, output_format: str = "png",
+                compression: Optional[int] = None) -> None:
+    """
+    Encode a numpy image array into a file object.
+
+    PNG and JPEG data is written block by block as the encoder produces it,
+    so a file object that forwards its writes streams the image before
+    encoding has finished; WebP is written once fully encoded.
+
+    Args:
+        image_array: Image as numpy array
+        fileobj: Binary file object to write to
+        output_format: Normalized output format, see encode_image
+        compression: Compression setting of the output format, see encode_image
+    """
+    image = Image.fromarray(image_array)
+
+    if output_format == "png":
+        image.save(fileobj, format="PNG", compress_level=6 if compression is None else compression)
+    elif output_format == "webp":
+        # Lossless, so the perturbations survive encoding
+        image.save(fileobj, format="WEBP", lossless=True, method=4 if compression is None else compression)
+    elif output_format == "jpeg":
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(fileobj, format="JPEG", quality=95 if compression is None else compression, subsampling=0)
+    else:
+        raise ValueError(f"Unsupported output format: {output_format}")
+
+
+class PngStreamWriter:
+    """
+    Writes a PNG file row band by row band, for images too large to hold in memory.
+
+    Rows are deflated as they arrive and emitted as IDAT chunks, so only the
+    current band and the compressor state are held in memory.
+    """
+
+    # PNG colour types by number of channels
+    COLOR_TYPES = {1: 0, 3: 2, 4: 6}
+
+    def __init__(self, fileobj: BinaryIO, width: int, height: int, channels: int, compress_level: int = 6):
+        """
+        Write the PNG header.
+
+        Args:
+            fileobj: Binary file to write to
+            width: Image width in pixels
+            height: Image height in pixels
+            channels: 1 (grayscale), 3 (RGB) or 4 (RGBA); 8 bits per channel
+            compress_level: zlib level 0-9
+        """
+        if channels not in self.COLOR_TYPES:
+            raise ValueError(f"Unsupported number of channels: {channels}")
+        self.fileobj = fileobj
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.rows_written = 0
+        self._compressor = zlib.compressobj(compress_level)
+        fileobj.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, self.COLOR_TYPES[channels], 0, 0, 0))
+
+    def _chunk(self, kind: bytes, data: bytes) -> None:
+        self.fileobj.write(struct.pack(">I", len(data)))
+        self.fileobj.write(kind)
+        self.fileobj.write(data)
+        self.fileobj.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind)) & 0xFFFFFFFF))
+
+    def write_rows(self, rows: np.ndarray) -> None:
+        """
+        Append a band of rows.
+
+        Args:
+            rows: uint8 array of shape (n, width) or (n, width, channels)
+        """
+        rows = rows.reshape(rows.shape[0], self.width * self.channels)
+        # Every scanline starts with its filter type; 0 (none) keeps encoding a single pass
+        scanlines = np.zeros((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        scanlines[:, 1:] = rows
+        data = self._compressor.compress(scanlines.tobytes())
+        if data:
+            self._chunk(b"IDAT", data)
+        self.rows_written += rows.shape[0]
+
+    def close(self) -> None:
+        """Flush the compressor and write the PNG trailer."""
+        if self.rows_written != self.height:
+            raise ValueError(f"Wrote {self.rows_written} of {self.height} rows")
+        self._chunk(b"IDAT", self._compressor.flush())
+        self._chunk(b"IEND", b"")
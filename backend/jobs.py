@@ -0,0 +1,415 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import glob
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, BinaryIO, Callable, Dict, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+Upload = Tuple[str, BinaryIO]  # (filename, file object positioned at the start of the upload)
+JobInput = Tuple[str, str]  # (filename, path of the spooled upload)
+
+# Job states; the last three are final
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINAL_STATES = (DONE, FAILED, CANCELLED)
+
+
+class JobQueueFullError(Exception):
+    """Raised when the job queue cannot accept more jobs."""
+
+
+class JobError(Exception):
+    """
+    Raised by a job runner when a job cannot be completed.
+
+    Retryable errors (e.g. a saturated worker pool) put the job back in the
+    queue instead of failing it.
+    """
+
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def _file_size(fileobj: BinaryIO) -> int:
+    """Bytes from the current position of a file object to its end; the position is kept."""
+    position = fileobj.tell()
+    size = fileobj.seek(0, os.SEEK_END) - position
+    fileobj.seek(position)
+    return size
+
+
+class JobStore:
+    """
+    Persistent job records and payloads.
+
+    Job metadata lives in a SQLite database; uploads are copied from their
+    file objects and results are spooled to files next to it, so large
+    payloads never sit in the database or in memory.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Initialize the store, creating the database if needed.
+
+        Args:
+            directory: Directory holding the database and the spooled payloads
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self.open()
+
+    def open(self) -> None:
+        """Connect to the database, if not connected; a closed store can be opened again."""
+        with self._lock:
+            if self._db is not None:
+                return
+            self._db = sqlite3.connect(os.path.join(self.directory, "jobs.sqlite3"), check_same_thread=False)
+            self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    priority REAL NOT NULL,
+                    options TEXT NOT NULL,
+                    input_bytes INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    media_type TEXT,
+                    filename TEXT,
+                    error TEXT,
+                    inputs TEXT NOT NULL
+                )
+                """
+            )
+
+    def _path(self, job_id: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.{suffix}")
+
+    def create(self, kind: str, uploads: List[Upload], options: Dict[str, Any], priority: float) -> Dict[str, Any]:
+        """
+        Spool a job's uploads and record it as queued.
+
+        Args:
+            kind: Job type, interpreted by the runner
+            uploads: Uploaded files of the job, copied into the store chunk by chunk
+            options: JSON-serializable processing options
+            priority: Scheduling key, lower runs first
+
+        Returns:
+            The new job record
+        """
+        job_id = uuid.uuid4().hex
+        inputs: List[JobInput] = []
+        try:
+            for index, (filename, fileobj) in enumerate(uploads):
+                # The extension is kept for decoders that go by it; anything unusual is dropped
+                extension = os.path.splitext(filename or "")[1]
+                path = self._path(job_id, f"input{index}{extension if extension[1:].isalnum() else ''}")
+                with open(path, "wb") as f:
+                    shutil.copyfileobj(fileobj, f)
+                inputs.append((filename, path))
+        except Exception:
+            self._remove_inputs(job_id)
+            raise
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO jobs (id, kind, status, priority, options, input_bytes, created, updated, inputs) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, QUEUED, priority, json.dumps(options),
+                 sum(os.path.getsize(path) for _, path in inputs), now, now, json.dumps(inputs)),
+            )
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Return a job record, or None if it does not exist."""
+        with self._lock:
+            row = self._db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["options"] = json.loads(job["options"])
+        job["inputs"] = [tuple(entry) for entry in json.loads(job["inputs"])]
+        return job
+
+    def update(self, job_id: str, **fields: Any) -> None:
+        """Update columns of a job record."""
+        fields["updated"] = time.time()
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        with self._lock, self._db:
+            self._db.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def load_input(self, job_id: str) -> List[JobInput]:
+        """
+        Return the spooled uploads of a job.
+
+        Returns:
+            (filename, path) per upload; the files stay owned by the store
+        """
+        return self.get(job_id)["inputs"]
+
+    def result_path(self, job_id: str) -> str:
+        """Path of a finished job's result file."""
+        return self._path(job_id, "result")
+
+    def finish(self, job_id: str, payload: Union[bytes, str], media_type: str, filename: str) -> None:
+        """
+        Store a job's result and mark it done.
+
+        Args:
+            job_id: Job to complete
+            payload: Result bytes, or the path of a result file to move into the store
+            media_type: Media type of the result
+            filename: Suggested download filename
+        """
+        if isinstance(payload, str):
+            shutil.move(payload, self.result_path(job_id))
+        else:
+            tmp_path = self._path(job_id, "result.tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, self.result_path(job_id))
+        self._remove_inputs(job_id)
+        self.update(job_id, status=DONE, media_type=media_type, filename=filename)
+
+    def delete(self, job_id: str) -> None:
+        """Remove a job record and its payloads."""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        self._remove_inputs(job_id)
+        self._remove(job_id, "result")
+
+    def expired(self, cutoff: float) -> List[str]:
+        """Ids of finished jobs last updated before the cutoff timestamp."""
+        placeholders = ", ".join("?" for _ in FINAL_STATES)
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT id FROM jobs WHERE status IN ({placeholders}) AND updated < ?", (*FINAL_STATES, cutoff)
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+    def pending(self) -> List[Dict[str, Any]]:
+        """Jobs that were queued or running, e.g. when the server last stopped."""
+        with self._lock:
+            rows = self._db.execute("SELECT id FROM jobs WHERE status IN (?, ?)", (QUEUED, RUNNING)).fetchall()
+        return [self.get(row["id"]) for row in rows]
+
+    def close(self) -> None:
+        """Close the database until the next open."""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _remove_inputs(self, job_id: str) -> None:
+        # Spooled uploads, named after their index and extension
+        for path in glob.glob(self._path(job_id, "input*")):
+            self._remove(job_id, os.path.basename(path)[len(job_id) + 1:])
+
+    def _remove(self, job_id: str, suffix: str) -> None:
+        try:
+            os.remove(self._path(job_id, suffix))
+        except FileNotFoundError:
+            pass
+
+
+class JobScheduler:
+    """
+    Bounded in-process scheduler for background cloaking jobs.
+
+    Jobs are ordered by a virtual deadline: the submission time plus a delay
+    proportional to the upload size. Small images therefore overtake large
+    ones, while large jobs still age to the front instead of starving.
+    A fixed number of dispatchers run jobs, leaving the remaining worker
+    pool capacity to interactive requests.
+    """
+
+    def __init__(self, store: JobStore,
+                 runner: Callable[[Dict[str, Any], List[JobInput]], Awaitable[Tuple[Union[bytes, str], str, str]]],
+                 concurrency: int = 1, max_pending: int = 64, size_delay: float = 1.0,
+                 ttl: float = 3600.0, cleanup_interval: float = 60.0, retry_delay: float = 1.0):
+        """
+        Initialize the scheduler.
+
+        Args:
+            store: Persistent job store
+            runner: Coroutine turning a job and its (filename, path) inputs into (result bytes or
+                result file path, media type, filename); the input files stay owned by the store
+            concurrency: Jobs processed at the same time
+            max_pending: Queued jobs allowed before submissions are rejected
+            size_delay: Seconds of priority penalty per MB of upload
+            ttl: Seconds finished jobs and their results are kept
+            cleanup_interval: Seconds between expiry sweeps
+            retry_delay: Seconds to wait before retrying a job after a retryable error
+        """
+        self.store = store
+        self.runner = runner
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.size_delay = size_delay
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self.retry_delay = retry_delay
+        self._heap: List[Tuple[float, int, str]] = []
+        self._sequence = itertools.count()
+        self._wakeup: Optional[asyncio.Condition] = None
+        self._tasks: List[asyncio.Task] = []
+        self.running = 0
+
+    @property
+    def pending(self) -> int:
+        """Number of queued jobs."""
+        return len(self._heap)
+
+    def priority(self, size: int) -> float:
+        """Virtual deadline of a job of the given upload size submitted now."""
+        return time.time() + self.size_delay * size / (1024 * 1024)
+
+    async def start(self) -> None:
+        """Re-queue jobs left over from a previous run and start the dispatchers."""
+        self.store.open()
+        self._heap = []
+        self._wakeup = asyncio.Condition()
+        recovered = await asyncio.to_thread(self.store.pending)
+        for job in recovered:
+            self.store.update(job["id"], status=QUEUED)
+            heapq.heappush(self._heap, (job["priority"], next(self._sequence), job["id"]))
+        if recovered:
+            logger.info(f"Re-queued {len(recovered)} unfinished job(s)")
+
+        self._tasks = [asyncio.create_task(self._dispatch()) for _ in range(self.concurrency)]
+        self._tasks.append(asyncio.create_task(self._cleanup()))
+
+    async def stop(self) -> None:
+        """Stop the dispatchers; unfinished jobs stay in the store and resume on the next start."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.store.close()
+
+    async def submit(self, kind: str, uploads: List[Upload], options: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Queue a job.
+
+        Args:
+            kind: Job type, interpreted by the runner
+            uploads: Uploaded files of the job, copied into the store
+            options: JSON-serializable processing options
+
+        Returns:
+            The new job record
+
+        Raises:
+            JobQueueFullError: If max_pending jobs are already queued
+        """
+        if self.pending >= self.max_pending:
+            raise JobQueueFullError("Too many jobs are queued, please retry later")
+        priority = self.priority(sum(_file_size(fileobj) for _, fileobj in uploads))
+        job = await asyncio.to_thread(self.store.create, kind, uploads, options, priority)
+        await self._push(priority, job["id"])
+        return job
+
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Cancel a job.
+
+        Queued jobs never start; a running job cannot be interrupted in its
+        worker, but its result is discarded. Finished jobs are deleted.
+
+        Args:
+            job_id: Job to cancel
+
+        Returns:
+            The job record after cancellation, or None if it does not exist
+        """
+        job = self.store.get(job_id)
+        if job is None:
+            return None
+        if job["status"] in FINAL_STATES:
+            self.store.delete(job_id)
+            return {**job, "deleted": True}
+        self.store.update(job_id, status=CANCELLED)
+        if job["status"] == QUEUED:
+            self._heap = [entry for entry in self._heap if entry[2] != job_id]
+            heapq.heapify(self._heap)
+        return self.store.get(job_id)
+
+    async def _push(self, priority: float, job_id: str) -> None:
+        async with self._wakeup:
+            heapq.heappush(self._heap, (priority, next(self._sequence), job_id))
+            self._wakeup.notify()
+
+    async def _pop(self) -> str:
+        async with self._wakeup:
+            await self._wakeup.wait_for(lambda: bool(self._heap))
+            return heapq.heappop(self._heap)[2]
+
+    async def _dispatch(self) -> None:
+        while True:
+            job_id = await self._pop()
+            job = self.store.get(job_id)
+            if job is None or job["status"] != QUEUED:
+                continue  # cancelled or deleted while queued
+
+            self.running += 1
+            self.store.update(job_id, status=RUNNING)
+            try:
+                inputs = await asyncio.to_thread(self.store.load_input, job_id)
+                payload, media_type, filename = await self.runner(job, inputs)
+                if self._cancelled(job_id):
+                    if isinstance(payload, str):
+                        os.remove(payload)
+                    continue
+                await asyncio.to_thread(self.store.finish, job_id, payload, media_type, filename)
+            except JobError as e:
+                if self._cancelled(job_id):
+                    continue
+                if e.retryable:
+                    self.store.update(job_id, status=QUEUED)
+                    await asyncio.sleep(self.retry_delay)
+                    await self._push(job["priority"], job_id)
+                else:
+                    self.store.update(job_id, status=FAILED, error=str(e))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error running job {job_id}: {str(e)}")
+                self.store.update(job_id, status=FAILED, error=str(e))
+            finally:
+                self.running -= 1
+
+    def _cancelled(self, job_id: str) -> bool:
+        job = self.store.get(job_id)
+        if job is None or job["status"] == CANCELLED:
+            if job is not None:
+                # Restart the retention period from the end of the run
+                self.store.update(job_id, status=CANCELLED)
+            return True
+        return False
+
+    async def _cleanup(self) -> None:
+        while True:
+            try:
+                expired = await asyncio.to_thread(self.store.expired, time.time() - self.ttl)
+                for job_id in expired:
+                    await asyncio.to_thread(self.store.delete, job_id)
+                if expired:
+                    logger.info(f"Removed {len(expired)} expired job(s)")
+            except Exception as e:
+                logger.error(f"Error cleaning up jobs: {str(e)}")
+            await asyncio.sleep(self.cleanup_interval)
@@ -1,20 +1,41 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+import time
+
+# Start of module import, used for the startup-time report
+_import_started = time.perf_counter()
+
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-import cv2
-import numpy as np
-from PIL import Image
-import face_recognition
-import io
+from fastapi.responses import FileResponse, JSONResponse, Response
+from PIL.Image import DecompressionBombError
+from starlette.background import BackgroundTask
+import asyncio
 import base64
-from typing import Dict, Any
+import os
+import shutil
+import tempfile
+from typing import Any, Callable, Dict, List, Optional, Tuple
 import logging
-from face_cloaker import FaceCloaker
+import config
+import metrics
+from admission import (MEMORY_PER_IMAGE_BYTE, AdmissionController, AdmissionError, container_memory,
+                       estimate_image_memory)
+from cache import ResultCache
+from image_io import file_extension, image_size, media_type, normalize_format
+from jobs import JobError, JobQueueFullError, JobScheduler, JobStore
+from tiling import estimate_memory
+from transport import SharedMemoryTransport
+from video import frame_size
+from workers import (CloakingExecutor, QueueFullError, check_task, cloak_batch_task, cloak_stream_task, cloak_task,
+                     cloak_large_task, cloak_verify_task, cloak_video_task, create_cloaker, enroll_task,
+                     face_summaries, get_gallery, traced_task)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Cold-start timings, reported by /api/startup
+startup_report: Dict[str, Any] = {"import_seconds": time.perf_counter() - _import_started}
+
 app = FastAPI(title="InvisiFace API", description="Face Anonymizer and Digital Identity Protection System")
 
 # Configure CORS
@@ -26,8 +47,408 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize face cloaker
-face_cloaker = FaceCloaker()
+# Worker pool that runs face cloaking off the event loop
+executor = CloakingExecutor(
+    mode=config.WORKER_MODE,
+    workers=config.WORKER_COUNT,
+    max_queue_depth=config.MAX_QUEUE_DEPTH,
+    timeout=config.REQUEST_TIMEOUT,
+    transport=SharedMemoryTransport(config.SHM_POOL_BYTES, config.SHM_MIN_BYTES) if config.SHM_TRANSPORT else None,
+)
+
+# Global memory and CPU budget of the requests running in the worker pool
+admission = AdmissionController(
+    memory_budget=config.ADMISSION_MEMORY_BYTES or container_memory() // 2,
+    cpu_slots=config.ADMISSION_CPU_SLOTS,
+    max_waiting=config.ADMISSION_MAX_WAITING,
+    max_wait=config.ADMISSION_MAX_WAIT,
+)
+
+@app.on_event("startup")
+async def start_workers():
+    executor.start()
+    
+    if config.WARM_UP_ON_STARTUP:
+        warm_up_started = time.perf_counter()
+        try:
+            startup_report["workers"] = await executor.warm_up()
+        except Exception as e:
+            logger.error(f"Error warming up workers: {str(e)}")
+        startup_report["warm_up_seconds"] = time.perf_counter() - warm_up_started
+    
+    startup_report["startup_seconds"] = time.perf_counter() - _import_started
+    logger.info(f"Startup completed in {startup_report['startup_seconds']:.2f}s "
+                f"(imports {startup_report['import_seconds']:.2f}s, "
+                f"warm-up {startup_report.get('warm_up_seconds', 0.0):.2f}s)")
+
+# Cache of detections and outputs, keyed by the uploaded bytes and cloaker parameters
+result_cache = ResultCache(
+    max_bytes=config.CACHE_MAX_BYTES,
+    disk_dir=config.CACHE_DIR or None,
+    disk_max_bytes=config.CACHE_DISK_MAX_BYTES,
+)
+cloaker_params = create_cloaker().parameters()
+
+def remove_files(*paths: str) -> None:
+    """
+    Delete temporary files, ignoring ones that are already gone.
+    """
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def temporary_path(suffix: str = "") -> str:
+    """
+    Create an empty temporary file and return its path.
+    """
+    fd, path = tempfile.mkstemp(prefix="invisiface-", suffix=suffix)
+    os.close(fd)
+    return path
+
+async def run_file_task(fn: Callable[..., Any], input_path: str, suffix: str, *args: Any,
+                        memory: int = 0) -> Tuple[str, Dict[str, Any]]:
+    """
+    Run a file-to-file task (video or tiled cloaking) in the worker pool.
+    Returns the path of the output file, owned by the caller, and the task's statistics.
+    """
+    output_path = temporary_path(suffix)
+    try:
+        # These tasks take job-sized time even on the synchronous endpoints
+        stats = await run_in_worker(fn, input_path, output_path, *args, timeout=config.JOB_TIMEOUT, memory=memory)
+    except Exception:
+        remove_files(output_path)
+        raise
+    return output_path, stats
+
+def video_task_memory(input_path: str) -> int:
+    """
+    Memory estimate of cloaking a video: the current and previous frame at the probed frame size
+    (1080p when the container does not tell).
+    """
+    width, height = frame_size(input_path) or (1920, 1080)
+    return 2 * estimate_image_memory(width, height)
+
+def large_task_memory(input_path: str) -> int:
+    """
+    Memory estimate of cloaking an image in tiled mode, from its header (see tiling.estimate_memory).
+    """
+    try:
+        return estimate_memory(input_path, config.TILE_SIZE)
+    except OSError:
+        return 0  # unreadable; the task itself reports it
+
+def check_upload_bytes(file: UploadFile, max_bytes: int) -> None:
+    """
+    Reject an upload larger than max_bytes.
+    """
+    if file.size is not None and file.size > max_bytes:
+        raise HTTPException(status_code=413, detail=f"File {file.filename} is larger than {max_bytes} bytes")
+
+async def read_upload(file: UploadFile, max_bytes: Optional[int] = None, max_pixels: Optional[int] = None,
+                      check_pixels: bool = True) -> bytes:
+    """
+    Read an image upload into memory after checking its size limits (server defaults unless given).
+    The multipart parser spools large uploads to disk; the byte size and the pixel count
+    from the image header are checked there, before the upload is read or decoded.
+    """
+    check_upload_bytes(file, max_bytes or config.MAX_UPLOAD_BYTES)
+    if check_pixels:
+        await check_image_pixels(file.file, file.filename, max_pixels or config.MAX_IMAGE_PIXELS)
+    return await file.read()
+
+async def check_image_pixels(source: Any, filename: Optional[str], max_pixels: int) -> None:
+    """
+    Reject an image whose header announces more than max_pixels pixels, before it is decoded.
+    """
+    try:
+        width, height = await asyncio.to_thread(image_size, source, max_pixels)
+    except DecompressionBombError:
+        raise HTTPException(status_code=413, detail=f"Image {filename} has too many pixels")
+    except OSError:
+        raise HTTPException(status_code=400, detail=f"Could not read image {filename}")
+    if width * height > max_pixels:
+        raise HTTPException(status_code=413,
+                            detail=f"Image {filename} has {width * height} pixels, the limit is {max_pixels}")
+
+async def spool_upload(file: UploadFile) -> str:
+    """
+    Copy an upload to a temporary file, owned by the caller, without reading it into memory.
+    """
+    check_upload_bytes(file, config.MAX_SPOOLED_UPLOAD_BYTES)
+    path = temporary_path(os.path.splitext(file.filename or "")[1])
+    try:
+        with open(path, "wb") as f:
+            await asyncio.to_thread(shutil.copyfileobj, file.file, f)
+    except Exception:
+        remove_files(path)
+        raise
+    return path
+
+async def run_job(job: Dict[str, Any], inputs: List[Tuple[str, str]]) -> Tuple[Any, str, str]:
+    """
+    Process a background job in the worker pool.
+    Inputs are the (filename, path) of the uploads spooled by the job store; file-based modes read them in place.
+    Returns the result bytes (or the path of a result file), their media type and a download filename.
+    """
+    output_format, compression = job["options"]["format"], job["options"]["compression"]
+    try:
+        if job["kind"] == "video":
+            memory = await asyncio.to_thread(video_task_memory, inputs[0][1])
+            output_path, _ = await run_file_task(cloak_video_task, inputs[0][1], ".mp4", memory=memory)
+            return output_path, "video/mp4", "cloaked_video.mp4"
+        if job["kind"] == "large":
+            # Tiled mode always writes PNG
+            png_compression = compression if output_format == "png" else None
+            memory = await asyncio.to_thread(large_task_memory, inputs[0][1])
+            output_path, _ = await run_file_task(cloak_large_task, inputs[0][1], ".png", png_compression,
+                                                 memory=memory)
+            return output_path, "image/png", "cloaked_image.png"
+        uploads = [(filename, await asyncio.to_thread(read_file, path)) for filename, path in inputs]
+        if job["kind"] == "cloak":
+            encoded = await cloak_cached(uploads[0][1], output_format, compression, timeout=config.JOB_TIMEOUT)
+            return encoded, media_type(output_format), f"cloaked_image.{file_extension(output_format)}"
+        zip_bytes = await run_in_worker(cloak_batch_task, uploads, output_format, compression,
+                                        timeout=config.JOB_TIMEOUT, memory=batch_memory(uploads),
+                                        returns_image=True)
+        return zip_bytes, "application/zip", "cloaked_images.zip"
+    except HTTPException as e:
+        # A saturated pool or budget is transient, so the job goes back in the queue
+        raise JobError(str(e.detail), retryable=e.status_code in (429, 503))
+    except ValueError as e:
+        raise JobError(str(e))
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+# Background jobs for uploads too large to process within one HTTP request
+job_scheduler = JobScheduler(
+    JobStore(config.JOB_DIR),
+    run_job,
+    concurrency=config.JOB_CONCURRENCY,
+    max_pending=config.JOB_MAX_PENDING,
+    size_delay=config.JOB_SIZE_DELAY,
+    ttl=config.JOB_TTL,
+)
+
+@app.on_event("startup")
+async def start_jobs():
+    await job_scheduler.start()
+
+@app.on_event("shutdown")
+async def stop_workers():
+    await job_scheduler.stop()
+    executor.shutdown()
+    result_cache.close()
+
+# Operational metrics, served from /metrics
+metrics.Gauge("invisiface_queue_depth", "Requests waiting for a free worker", lambda: executor.queue_depth)
+metrics.Gauge("invisiface_requests_in_flight", "Requests queued or running in the worker pool",
+              lambda: executor.outstanding)
+metrics.Gauge("invisiface_jobs_pending", "Background jobs waiting to run", lambda: job_scheduler.pending)
+metrics.Gauge("invisiface_jobs_running", "Background jobs being processed", lambda: job_scheduler.running)
+metrics.Gauge("invisiface_admission_memory_bytes", "Memory reserved by admitted requests",
+              lambda: admission.memory_in_use)
+metrics.Gauge("invisiface_admission_waiting", "Requests waiting for admission", lambda: admission.waiting)
+if executor.transport is not None:
+    metrics.Gauge("invisiface_shm_pool_bytes", "Shared memory segments kept for reuse",
+                  lambda: executor.transport.pool.pooled_bytes)
+    metrics.Gauge("invisiface_shm_segments_in_use", "Shared memory segments carrying requests",
+                  lambda: executor.transport.pool.in_use)
+metrics.CallbackCounter("invisiface_cache_hits_total", "Result cache hits", lambda: result_cache.hits)
+metrics.CallbackCounter("invisiface_cache_misses_total", "Result cache misses", lambda: result_cache.misses)
+metrics.Gauge("invisiface_cache_bytes", "Bytes held by the in-memory result cache", lambda: result_cache.stats()["bytes"])
+
+@app.middleware("http")
+async def limit_request_size(request: Request, call_next):
+    # Refuse oversized bodies before the multipart parser spools them to disk
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > config.MAX_SPOOLED_UPLOAD_BYTES:
+        return JSONResponse(status_code=413,
+                            content={"detail": f"Request body is larger than {config.MAX_SPOOLED_UPLOAD_BYTES} bytes"})
+    return await call_next(request)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    endpoint = route.path if route is not None else "unmatched"
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint)
+    metrics.BYTES_IN.inc(endpoint, amount=int(request.headers.get("content-length") or 0))
+    metrics.BYTES_OUT.inc(endpoint, amount=int(response.headers.get("content-length") or 0))
+    return response
+
+def report_profile(task_name: str, folded: str) -> None:
+    """
+    Log the hottest stacks of a profiled request and optionally save the full profile.
+    """
+    hottest = "\n".join(folded.splitlines()[:10])
+    logger.info(f"Profile of {task_name}:\n{hottest}")
+    if config.PROFILE_DIR:
+        os.makedirs(config.PROFILE_DIR, exist_ok=True)
+        path = os.path.join(config.PROFILE_DIR, f"{task_name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.folded")
+        with open(path, "w") as f:
+            f.write(folded + "\n")
+        logger.info(f"Profile written to {path}")
+
+def profiling_requested(profile: bool) -> bool:
+    """
+    Check that profiling is enabled on this server before honouring ?profile=true.
+    """
+    if profile and not config.ENABLE_PROFILING:
+        raise HTTPException(status_code=403, detail="Profiling is disabled on this server")
+    return profile
+
+def upload_memory(contents: bytes) -> int:
+    """
+    Estimate the memory of processing an uploaded image from its header.
+    """
+    try:
+        width, height = image_size(contents)
+    except Exception:
+        # Undecodable uploads fail right after decoding starts
+        return len(contents)
+    return estimate_image_memory(width, height, encoded_bytes=len(contents))
+
+def batch_memory(uploads: List[Tuple[str, bytes]]) -> int:
+    """
+    Estimate the memory of a batch task, which holds all its images at once.
+    """
+    return sum(upload_memory(contents) for _, contents in uploads)
+
+def output_capacity(memory: int) -> int:
+    """
+    Room for the encoded images returned by a task with the given memory estimate:
+    at most the decoded pixels (with an alpha channel) plus container overhead.
+    """
+    return memory // MEMORY_PER_IMAGE_BYTE * 4 // 3 + 64 * 1024
+
+async def run_in_worker(fn: Callable[..., Any], *args: Any, profile: bool = False,
+                        timeout: Optional[float] = None, memory: int = 0, returns_image: bool = False,
+                        on_done: Optional[Callable[[], None]] = None) -> Any:
+    """
+    Run a task in the worker pool once admitted under the memory and CPU budget,
+    mapping admission and pool errors to HTTP responses and recording the task's stage timings.
+    Tasks returning encoded images get room for them in the shared memory transport.
+    on_done is called once the worker is done with the task, or right away if it never reaches one.
+    """
+    try:
+        release = await admission.acquire(memory)
+    except BaseException as e:
+        if on_done is not None:
+            on_done()
+        if not isinstance(e, AdmissionError):
+            raise
+        metrics.ADMISSION_REJECTED.inc("queue_full" if e.queue_full else "timeout")
+        raise HTTPException(status_code=429 if e.queue_full else 503, detail=str(e),
+                            headers={"Retry-After": str(e.retry_after)})
+    
+    def done() -> None:
+        release()
+        if on_done is not None:
+            on_done()
+    
+    try:
+        # The reservation is held until the worker is done, even if the request times out
+        timeout = executor.timeout if timeout is None else timeout
+        result, spans, folded = await executor.submit(traced_task, fn, profile, time.time() + timeout, *args,
+                                                      timeout=timeout, on_done=done,
+                                                      output_bytes=output_capacity(memory) if returns_image else 0)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Image processing timed out")
+    
+    metrics.observe_trace(spans)
+    if folded is not None:
+        report_profile(fn.__name__, folded)
+    return result
+
+def output_options(output_format: str, compression: Optional[int]) -> Tuple[str, Optional[int]]:
+    """
+    Validate requested output options and fill in the server defaults.
+    """
+    try:
+        output_format = normalize_format(output_format, compression)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if output_format == "png" and compression is None:
+        compression = config.PNG_COMPRESSION
+    return output_format, compression
+
+async def cloak_cached(contents: bytes, output_format: str, compression: Optional[int],
+                       profile: bool = False, timeout: Optional[float] = None) -> bytes:
+    """
+    Cloak uploaded image bytes, reusing cached outputs and face detections.
+    Profiled requests always run the full pipeline.
+    """
+    digest = await asyncio.to_thread(ResultCache.digest, contents)
+    output_params = {**cloaker_params, "format": output_format, "compression": compression}
+    output_key = result_cache.make_key("cloak", digest, output_params)
+    encoded = None if profile else await result_cache.get_async(output_key)
+    if encoded is None:
+        faces_key = result_cache.make_key("faces", digest, cloaker_params)
+        cached_faces = None if profile else await result_cache.get_async(faces_key)
+        encoded, faces = await run_in_worker(
+            cloak_task, contents, cached_faces, output_format, compression,
+            profile=profile, timeout=timeout, memory=upload_memory(contents), returns_image=True,
+        )
+        metrics.FACES_PER_IMAGE.observe(len(faces))
+        result_cache.put(output_key, encoded)
+        result_cache.put(faces_key, faces)
+    return encoded
+
+async def check_cached(contents: bytes, profile: bool = False) -> Dict[str, Any]:
+    """
+    Run the protection check on uploaded image bytes, reusing cached results and face detections.
+    Profiled requests always run the full pipeline.
+    """
+    digest = await asyncio.to_thread(ResultCache.digest, contents)
+    # Enrolling faces changes check results, so the gallery version is part of the key
+    gallery = get_gallery()
+    result_key = result_cache.make_key("check", digest, {**cloaker_params, "gallery": gallery.version if gallery else None})
+    protection_result = None if profile else await result_cache.get_async(result_key)
+    if protection_result is None:
+        # The check detects on the downscaled proxy, so its faces are cached apart from the exact
+        # full-resolution ones; those are only read, as a starting point
+        proxy_key = result_cache.make_key("faces-proxy", digest, cloaker_params)
+        faces = None if profile else await result_cache.get_async(proxy_key)
+        exact_faces = None if profile or faces is not None else await result_cache.get_async(
+            result_cache.make_key("faces", digest, cloaker_params))
+        protection_result, faces = await run_in_worker(
+            check_task, contents, faces, exact_faces, profile=profile, memory=upload_memory(contents),
+        )
+        metrics.FACES_PER_IMAGE.observe(len(faces))
+        result_cache.put(result_key, protection_result)
+        result_cache.put(proxy_key, faces)
+    return protection_result
+
+async def cloak_verify_cached(contents: bytes, output_format: str,
+                              compression: Optional[int]) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    Cloak and verify uploaded image bytes, reusing cached results and face detections.
+    The verified output is also cached as the plain cloaking result.
+    """
+    digest = await asyncio.to_thread(ResultCache.digest, contents)
+    output_params = {**cloaker_params, "format": output_format, "compression": compression}
+    result_key = result_cache.make_key("verify", digest, output_params)
+    result = await result_cache.get_async(result_key)
+    if result is None:
+        faces_key = result_cache.make_key("faces", digest, cloaker_params)
+        cached_faces = await result_cache.get_async(faces_key)
+        encoded, comparison, faces = await run_in_worker(
+            cloak_verify_task, contents, cached_faces, output_format, compression,
+            memory=upload_memory(contents), returns_image=True,
+        )
+        metrics.FACES_PER_IMAGE.observe(len(faces))
+        result = (encoded, comparison)
+        result_cache.put(result_key, result)
+        result_cache.put(result_cache.make_key("cloak", digest, output_params), encoded)
+        result_cache.put(faces_key, faces)
+    return result
 
 @app.get("/")
 async def root():
@@ -37,47 +458,499 @@ async def root():
 async def health_check():
     return {"status": "healthy", "service": "InvisiFace API"}
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/startup")
+async def startup_timings():
+    return startup_report
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    return result_cache.stats()
+
 @app.post("/api/cloak-image")
-async def cloak_image(file: UploadFile = File(...)):
+async def cloak_image(
+    file: UploadFile = File(...),
+    output_format: str = Query(config.OUTPUT_FORMAT, alias="format"),
+    compression: Optional[int] = Query(None),
+    response: str = Query("json"),
+    profile: bool = Query(False),
+):
     """
     Apply face cloaking to an uploaded image.
-    Returns the cloaked image as base64 encoded string.
+    Returns the cloaked image as base64 encoded string, or as raw bytes with response=binary.
     """
     try:
         # Validate file type
         if not file.content_type.startswith('image/'):
             raise HTTPException(status_code=400, detail="File must be an image")
+        if response not in ("json", "binary"):
+            raise HTTPException(status_code=400, detail="response must be 'json' or 'binary'")
+        output_format, compression = output_options(output_format, compression)
+        profile = profiling_requested(profile)
         
         # Read the uploaded image
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
+        contents = await read_upload(file)
         
-        # Convert PIL image to numpy array
-        image_array = np.array(image)
+        # Apply face cloaking in the worker pool
+        encoded = await cloak_cached(contents, output_format, compression, profile)
         
-        # Apply face cloaking
-        cloaked_image_array = face_cloaker.cloak_image(image_array)
-        
-        # Convert back to PIL Image
-        cloaked_image = Image.fromarray(cloaked_image_array)
+        if response == "binary":
+            return Response(content=encoded, media_type=media_type(output_format))
         
         # Convert to base64 for response
-        buffered = io.BytesIO()
-        cloaked_image.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
+        img_str = base64.b64encode(encoded).decode()
         
         return {
             "success": True,
-            "cloaked_image": f"data:image/png;base64,{img_str}",
+            "cloaked_image": f"data:{media_type(output_format)};base64,{img_str}",
             "message": "Image successfully cloaked"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error cloaking image: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
 
+@app.post("/api/cloak-and-verify")
+async def cloak_and_verify(
+    file: UploadFile = File(...),
+    output_format: str = Query(config.OUTPUT_FORMAT, alias="format"),
+    compression: Optional[int] = Query(None),
+):
+    """
+    Apply face cloaking to an uploaded image and verify it in the same pass.
+    Returns the cloaked image with the per-face similarity between original and cloaked faces.
+    """
+    try:
+        # Validate file type
+        if not file.content_type.startswith('image/'):
+            raise HTTPException(status_code=400, detail="File must be an image")
+        output_format, compression = output_options(output_format, compression)
+        
+        # Read the uploaded image
+        contents = await read_upload(file)
+        
+        # Cloak and re-encode the known faces in the worker pool
+        encoded, comparison = await cloak_verify_cached(contents, output_format, compression)
+        
+        # Convert to base64 for response
+        img_str = base64.b64encode(encoded).decode()
+        
+        return {
+            "success": True,
+            "cloaked_image": f"data:{media_type(output_format)};base64,{img_str}",
+            "verification": comparison,
+            "message": "Image successfully cloaked and verified"
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error cloaking and verifying image: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
+
+async def receive_stream_upload(websocket: WebSocket) -> bytes:
+    """
+    Receive an image over a WebSocket: a JSON message announcing its size, then binary messages carrying it.
+    """
+    try:
+        size = int((await websocket.receive_json())["size"])
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail='The first message must be {"size": <bytes>}')
+    if size <= 0 or size > config.MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Images must be 1 to {config.MAX_UPLOAD_BYTES} bytes")
+    contents = bytearray()
+    while len(contents) < size:
+        data = await websocket.receive_bytes()
+        if len(contents) + len(data) > size:
+            raise HTTPException(status_code=400, detail=f"Received more than the announced {size} bytes")
+        contents += data
+    contents = bytes(contents)
+    await check_image_pixels(contents, "upload", config.MAX_IMAGE_PIXELS)
+    return contents
+
+async def stream_cloaked(websocket: WebSocket, contents: bytes, output_format: str,
+                         compression: Optional[int]) -> Dict[str, Any]:
+    """
+    Cloak uploaded image bytes in the worker pool and forward the worker's progress events
+    over a WebSocket, reusing and filling the result cache like cloak_cached.
+    Returns the summary of the final "done" event.
+    """
+    digest = await asyncio.to_thread(ResultCache.digest, contents)
+    output_params = {**cloaker_params, "format": output_format, "compression": compression}
+    output_key = result_cache.make_key("cloak", digest, output_params)
+    faces_key = result_cache.make_key("faces", digest, cloaker_params)
+    image_event = {"event": "image", "format": output_format, "media_type": media_type(output_format)}
+    
+    encoded = await result_cache.get_async(output_key)
+    faces = await result_cache.get_async(faces_key)
+    if encoded is not None:
+        if faces is not None:
+            width, height = image_size(contents)
+            await websocket.send_json({"event": "faces", "width": width, "height": height,
+                                       "faces": face_summaries(faces)})
+        await websocket.send_json(image_event)
+        for offset in range(0, len(encoded), config.STREAM_CHUNK_BYTES):
+            await websocket.send_bytes(encoded[offset:offset + config.STREAM_CHUNK_BYTES])
+        return {"size": len(encoded), "cached": True}
+    
+    memory = upload_memory(contents)
+    channel = executor.event_channel(output_capacity(memory))
+    task = asyncio.ensure_future(run_in_worker(
+        cloak_stream_task, contents, faces, output_format, compression, channel.sender,
+        config.STREAM_CHUNK_BYTES, memory=memory, on_done=channel.worker_done,
+    ))
+    
+    def task_done(done: asyncio.Future) -> None:
+        # A timed-out task ends the stream while its worker keeps running
+        if not done.cancelled() and done.exception() is not None:
+            channel.end()
+    
+    task.add_done_callback(task_done)
+    chunks: List[bytes] = []
+    try:
+        while True:
+            event = await channel.get()
+            if event is None:
+                break
+            if isinstance(event, bytes):
+                if not chunks:
+                    await websocket.send_json(image_event)
+                chunks.append(event)
+                await websocket.send_bytes(event)
+            else:
+                await websocket.send_json(event)
+        size, faces = await task
+    finally:
+        # A client that went away stops waiting; the worker finishes on its own
+        task.cancel()
+        channel.close()
+    
+    metrics.FACES_PER_IMAGE.observe(len(faces))
+    result_cache.put(output_key, b"".join(chunks))
+    result_cache.put(faces_key, faces)
+    return {"size": size, "cached": False}
+
+@app.websocket("/ws/cloak")
+async def cloak_image_stream(
+    websocket: WebSocket,
+    output_format: str = Query(config.OUTPUT_FORMAT, alias="format"),
+    compression: Optional[int] = Query(None),
+):
+    """
+    Apply face cloaking to an image sent over a WebSocket, streaming progress as it happens.
+    The client sends {"size": <bytes>} and then the image as binary messages. The server sends
+    a "faces" event with the detected boxes, a "face" event per cloaked face, an "image" event
+    followed by the encoded image in binary chunks, and finally a "done" event (or an "error" event).
+    """
+    await websocket.accept()
+    try:
+        output_format, compression = output_options(output_format, compression)
+        contents = await receive_stream_upload(websocket)
+        summary = await stream_cloaked(websocket, contents, output_format, compression)
+        await websocket.send_json({"event": "done", **summary})
+        await websocket.close()
+        
+    except WebSocketDisconnect:
+        logger.info("Streaming client disconnected")
+    except HTTPException as e:
+        event = {"event": "error", "status": e.status_code, "detail": e.detail}
+        if e.headers and "Retry-After" in e.headers:
+            event["retry_after"] = int(e.headers["Retry-After"])
+        await send_stream_error(websocket, event, code=1008 if e.status_code < 500 else 1011)
+    except Exception as e:
+        logger.error(f"Error streaming cloaked image: {str(e)}")
+        event = {"event": "error", "status": 500, "detail": f"Error processing image: {str(e)}"}
+        await send_stream_error(websocket, event, code=1011)
+
+async def send_stream_error(websocket: WebSocket, event: Dict[str, Any], code: int) -> None:
+    """
+    Report an error to a streaming client and close the connection, unless it is already gone.
+    """
+    try:
+        await websocket.send_json(event)
+        await websocket.close(code=code)
+    except Exception:
+        pass
+
+@app.post("/api/cloak-batch")
+async def cloak_batch(
+    files: List[UploadFile] = File(...),
+    output_format: str = Query(config.OUTPUT_FORMAT, alias="format"),
+    compression: Optional[int] = Query(None),
+):
+    """
+    Apply face cloaking to a batch of uploaded images.
+    Returns a zip archive with one cloaked image per upload.
+    """
+    try:
+        if len(files) > config.MAX_BATCH_SIZE:
+            raise HTTPException(status_code=400, detail=f"At most {config.MAX_BATCH_SIZE} images per batch")
+        output_format, compression = output_options(output_format, compression)
+        
+        # Validate file types
+        for file in files:
+            if not file.content_type.startswith('image/'):
+                raise HTTPException(status_code=400, detail=f"File {file.filename} must be an image")
+        
+        # Read the uploaded images
+        uploads = [(file.filename, await read_upload(file)) for file in files]
+        
+        # Apply face cloaking to the whole batch in the worker pool
+        zip_bytes = await run_in_worker(cloak_batch_task, uploads, output_format, compression,
+                                        memory=batch_memory(uploads), returns_image=True)
+        
+        return Response(
+            content=zip_bytes,
+            media_type="application/zip",
+            headers={"Content-Disposition": "attachment; filename=cloaked_images.zip"}
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error cloaking batch: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error processing batch: {str(e)}")
+
+def job_status(job: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Public view of a job record.
+    """
+    status = {
+        "job_id": job["id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "created": job["created"],
+        "updated": job["updated"],
+    }
+    if job["status"] == "done":
+        status["result_url"] = f"/api/jobs/{job['id']}/result"
+    if job.get("error"):
+        status["error"] = job["error"]
+    return status
+
+@app.post("/api/jobs", status_code=202)
+async def submit_job(
+    files: List[UploadFile] = File(...),
+    output_format: str = Query(config.OUTPUT_FORMAT, alias="format"),
+    compression: Optional[int] = Query(None),
+):
+    """
+    Queue uploaded images or a video for cloaking in the background.
+    One image produces a cloaked image, several produce a zip archive and a video produces an MP4 video.
+    """
+    try:
+        if len(files) > config.MAX_BATCH_SIZE:
+            raise HTTPException(status_code=400, detail=f"At most {config.MAX_BATCH_SIZE} images per job")
+        output_format, compression = output_options(output_format, compression)
+        
+        # Validate file types
+        is_video = len(files) == 1 and files[0].content_type.startswith('video/')
+        for file in files:
+            if not is_video and not file.content_type.startswith('image/'):
+                raise HTTPException(status_code=400, detail=f"File {file.filename} must be an image or a single video")
+        
+        # Check the size limits; a single video or image may be cloaked from disk, so it gets the larger ones.
+        # The uploads are not read here: the job store copies them from the multipart parser's spool files.
+        max_bytes, max_pixels = ((config.MAX_SPOOLED_UPLOAD_BYTES, config.TILED_MAX_PIXELS) if len(files) == 1
+                                 else (config.MAX_UPLOAD_BYTES, config.MAX_IMAGE_PIXELS))
+        for file in files:
+            check_upload_bytes(file, max_bytes)
+            if not is_video:
+                await check_image_pixels(file.file, file.filename, max_pixels)
+        
+        if is_video:
+            kind = "video"
+        elif len(files) > 1:
+            kind = "batch"
+        else:
+            # Very large images are cloaked in tiled mode, into a PNG
+            width, height = await asyncio.to_thread(image_size, files[0].file, config.TILED_MAX_PIXELS)
+            kind = "large" if width * height > config.TILED_MIN_PIXELS else "cloak"
+        uploads = [(file.filename, file.file) for file in files]
+        job = await job_scheduler.submit(kind, uploads, {"format": output_format, "compression": compression})
+        return job_status(job)
+        
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error submitting job: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error submitting job: {str(e)}")
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_scheduler.store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_status(job)
+
+@app.get("/api/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    job = job_scheduler.store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    # Streamed from the spool file instead of being loaded into memory
+    return FileResponse(job_scheduler.store.result_path(job_id), media_type=job["media_type"], filename=job["filename"])
+
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = job_scheduler.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {**job_status(job), "deleted": job.get("deleted", False)}
+
+@app.post("/api/cloak-video")
+async def cloak_video(file: UploadFile = File(...)):
+    """
+    Apply face cloaking to an uploaded video.
+    Returns the cloaked video as MP4 (without audio).
+    """
+    try:
+        # Validate file type
+        if not file.content_type.startswith('video/'):
+            raise HTTPException(status_code=400, detail="File must be a video")
+        
+        # Spool the upload to disk, where the worker streams frames from
+        input_path = await spool_upload(file)
+        try:
+            memory = await asyncio.to_thread(video_task_memory, input_path)
+            output_path, stats = await run_file_task(cloak_video_task, input_path, ".mp4", memory=memory)
+        finally:
+            remove_files(input_path)
+        
+        return FileResponse(
+            output_path,
+            media_type="video/mp4",
+            filename="cloaked_video.mp4",
+            headers={"X-Frames": str(stats["frames"]), "X-Keyframes": str(stats["keyframes"])},
+            background=BackgroundTask(remove_files, output_path),
+        )
+        
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error cloaking video: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error processing video: {str(e)}")
+
+def require_gallery():
+    """
+    Return the reference gallery, or fail the request if none is configured.
+    """
+    gallery = get_gallery()
+    if gallery is None:
+        raise HTTPException(status_code=400, detail="No reference gallery is configured (set INVISIFACE_GALLERY_DIR)")
+    return gallery
+
+@app.get("/api/gallery")
+async def gallery_stats():
+    return await asyncio.to_thread(require_gallery().stats)
+
+@app.post("/api/gallery/enroll")
+async def enroll_faces(files: List[UploadFile] = File(...), identity: str = Query(...)):
+    """
+    Enroll reference photos of one identity in the gallery.
+    The largest face of every photo is added; photos without a face are skipped.
+    """
+    try:
+        gallery = require_gallery()
+        if len(files) > config.MAX_BATCH_SIZE:
+            raise HTTPException(status_code=400, detail=f"At most {config.MAX_BATCH_SIZE} images per request")
+        
+        # Validate file types
+        for file in files:
+            if not file.content_type.startswith('image/'):
+                raise HTTPException(status_code=400, detail=f"File {file.filename} must be an image")
+        
+        # Read the uploaded images
+        uploads = [(file.filename, await read_upload(file)) for file in files]
+        
+        # Encode the faces in the worker pool, then append them to the gallery
+        # Photos are decoded one at a time
+        memory = (max(upload_memory(contents) for _, contents in uploads)
+                  + sum(len(contents) for _, contents in uploads))
+        encodings = await run_in_worker(enroll_task, uploads, memory=memory)
+        enrolled = await asyncio.to_thread(
+            gallery.enroll, [(identity, encoding) for encoding in encodings if encoding is not None]
+        )
+        
+        return {
+            "success": True,
+            "identity": identity,
+            "enrolled": enrolled,
+            "skipped": [filename for (filename, _), encoding in zip(uploads, encodings) if encoding is None],
+            "gallery_size": gallery.count
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error enrolling faces: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error enrolling faces: {str(e)}")
+
+@app.post("/api/gallery/index")
+async def build_gallery_index(nlist: Optional[int] = Query(None, ge=1)):
+    """
+    Build the approximate search index over the current gallery.
+    """
+    try:
+        gallery = require_gallery()
+        return await asyncio.to_thread(gallery.build_index, nlist)
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error building gallery index: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error building gallery index: {str(e)}")
+
+@app.post("/api/cloak-large")
+async def cloak_large_image(file: UploadFile = File(...), compression: Optional[int] = Query(None)):
+    """
+    Apply face cloaking to a very large image in tiled mode, with memory bounded by the tile size.
+    Returns the cloaked image as PNG.
+    """
+    try:
+        # Validate file type
+        if not file.content_type.startswith('image/'):
+            raise HTTPException(status_code=400, detail="File must be an image")
+        _, compression = output_options("png", compression)
+        
+        # Spool the upload to disk instead of reading it into memory
+        input_path = await spool_upload(file)
+        try:
+            memory = await asyncio.to_thread(large_task_memory, input_path)
+            output_path, stats = await run_file_task(cloak_large_task, input_path, ".png", compression, memory=memory)
+        finally:
+            remove_files(input_path)
+        
+        return FileResponse(
+            output_path,
+            media_type="image/png",
+            filename="cloaked_image.png",
+            headers={"X-Faces": str(stats["faces"]), "X-Tiles": str(stats["tiles"])},
+            background=BackgroundTask(remove_files, output_path),
+        )
+        
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error cloaking large image: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
+
 @app.post("/api/check-protection")
-async def check_protection(file: UploadFile = File(...)):
+async def check_protection(file: UploadFile = File(...), profile: bool = Query(False)):
     """
     Check if an image is protected against face recognition.
     Returns protection status and confidence scores.
@@ -87,17 +960,15 @@ async def check_protection(file: UploadFile = File(...)):
         if not file.content_type.startswith('image/'):
             raise HTTPException(status_code=400, detail="File must be an image")
         
-        # Read the uploaded image
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
+        profile = profiling_requested(profile)
         
-        # Convert PIL image to numpy array
-        image_array = np.array(image)
+        # Read the uploaded image
+        contents = await read_upload(file)
         
-        # Check face recognition
-        protection_result = face_cloaker.check_face_recognition(image_array)
+        # Check face recognition in the worker pool
+        protection_result = await check_cached(contents, profile)
         
-        return {
+        response = {
             "success": True,
             "is_protected": protection_result["is_protected"],
             "faces_detected": protection_result["faces_detected"],
@@ -105,13 +976,24 @@ async def check_protection(file: UploadFile = File(...)):
             "protection_level": protection_result["protection_level"],
             "message": protection_result["message"]
         }
+        # Gallery checks report the real matches
+        for key in ("match_rate", "matches", "gallery_size"):
+            if key in protection_result:
+                response[key] = protection_result[key]
+        return response
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error checking protection: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error checking protection: {str(e)}")
 
 @app.post("/api/download-cloaked")
-async def download_cloaked_image(file: UploadFile = File(...)):
+async def download_cloaked_image(
+    file: UploadFile = File(...),
+    output_format: str = Query(config.OUTPUT_FORMAT, alias="format"),
+    compression: Optional[int] = Query(None),
+):
     """
     Process and return a cloaked image for download.
     """
@@ -119,31 +1001,23 @@ async def download_cloaked_image(file: UploadFile = File(...)):
         # Validate file type
         if not file.content_type.startswith('image/'):
             raise HTTPException(status_code=400, detail="File must be an image")
+        output_format, compression = output_options(output_format, compression)
         
         # Read the uploaded image
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-        
-        # Convert PIL image to numpy array
-        image_array = np.array(image)
+        contents = await read_upload(file)
         
-        # Apply face cloaking
-        cloaked_image_array = face_cloaker.cloak_image(image_array)
+        # Apply face cloaking in the worker pool
+        encoded = await cloak_cached(contents, output_format, compression)
         
-        # Convert back to PIL Image
-        cloaked_image = Image.fromarray(cloaked_image_array)
-        
-        # Prepare for download
-        buffered = io.BytesIO()
-        cloaked_image.save(buffered, format="PNG")
-        buffered.seek(0)
-        
-        return StreamingResponse(
-            io.BytesIO(buffered.getvalue()),
-            media_type="image/png",
-            headers={"Content-Disposition": "attachment; filename=cloaked_image.png"}
+        # The encoded buffer is sent as-is, without another copy
+        return Response(
+            content=encoded,
+            media_type=media_type(output_format),
+            headers={"Content-Disposition": f"attachment; filename=cloaked_image.{file_extension(output_format)}"}
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error preparing download: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error preparing download: {str(e)}")
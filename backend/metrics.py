@@ -0,0 +1,234 @@
+import bisect
+import functools
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Latency buckets in seconds, from sub-millisecond stages to long cloaks
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Span = Tuple[str, float]  # (stage name, seconds)
+
+
+class _Metric:
+    """Base class of the metric types: a name, help text and label names."""
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _format_labels(self, labelvalues: Tuple[str, ...], extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, labelvalues))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Monotonically increasing value."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{self._format_labels(labels)} {value}" for labels, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    """Value read from a callback each time the metrics are rendered."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name} {float(self.callback())}"]
+
+
+class CallbackCounter(Gauge):
+    """Counter whose running total is kept elsewhere and read from a callback."""
+
+    kind = "counter"
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        with self._lock:
+            # Per-bucket counts followed by the +Inf count and the sum
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0.0] * (len(self.buckets) + 2)
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def _samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for labels, series in self._series.items():
+                cumulative = 0.0
+                for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{self.name}_bucket{self._format_labels(labels, ('le', le))} {cumulative}")
+                lines.append(f"{self.name}_count{self._format_labels(labels)} {cumulative}")
+                lines.append(f"{self.name}_sum{self._format_labels(labels)} {series[-1]}")
+        return lines
+
+
+REGISTRY: List[_Metric] = []
+
+STAGE_SECONDS = Histogram("invisiface_stage_seconds", "Time spent in each processing stage", ["stage"])
+REQUEST_SECONDS = Histogram("invisiface_request_seconds", "HTTP request latency", ["endpoint"])
+FACES_PER_IMAGE = Histogram("invisiface_faces_per_image", "Faces found per processed image",
+                            buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34))
+BYTES_IN = Counter("invisiface_bytes_in_total", "Request body bytes received", ["endpoint"])
+BYTES_OUT = Counter("invisiface_bytes_out_total", "Response body bytes sent", ["endpoint"])
+ADMISSION_REJECTED = Counter("invisiface_admission_rejected_total", "Requests refused by admission control",
+                             ["reason"])
+
+
+def render() -> str:
+    """Render every registered metric in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+# Spans of the task running on the current thread, when a trace is being collected
+_trace = threading.local()
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Time a processing stage.
+
+    Inside collect_trace() the span is recorded in the trace, so it can be
+    shipped back from a worker process; otherwise it is observed directly.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        spans = getattr(_trace, "spans", None)
+        if spans is not None:
+            spans.append((name, elapsed))
+        else:
+            STAGE_SECONDS.observe(elapsed, name)
+
+
+def timed_stage(name: str) -> Callable:
+    """Decorator form of stage()."""
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def collect_trace() -> Iterator[List[Span]]:
+    """Collect the stage spans recorded on this thread instead of observing them."""
+    previous = getattr(_trace, "spans", None)
+    _trace.spans = spans = []
+    try:
+        yield spans
+    finally:
+        _trace.spans = previous
+
+
+def observe_trace(spans: List[Span]) -> None:
+    """Record spans collected by collect_trace(), possibly in another process."""
+    for name, elapsed in spans:
+        STAGE_SECONDS.observe(elapsed, name)
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for a single task.
+
+    A background thread samples the stack of the profiled thread at a fixed
+    interval and counts the folded stacks, which can be fed to flame graph
+    tools. The overhead is limited to the sampling thread, so it is safe to
+    enable for one production request at a time.
+    """
+
+    def __init__(self, interval: float = 0.005, max_depth: int = 64):
+        """
+        Initialize the profiler.
+
+        Args:
+            interval: Seconds between samples
+            max_depth: Frames kept per sampled stack
+        """
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples: _Tally = _Tally()
+        self._target: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "SamplingProfiler":
+        self._target = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def folded(self, limit: Optional[int] = None) -> str:
+        """Folded stacks ("frame;frame;frame count"), most frequent first."""
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common(limit))
@@ -0,0 +1,112 @@
+import logging
+import threading
+import zlib
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class NoiseBank:
+    """
+    Bank of pre-blurred noise fields that face perturbations are cut from.
+
+    Drawing Gaussian noise and smoothing it for every face dominates the cost
+    of the random-noise cloak on large faces. The bank draws a few square
+    float32 fields once, smooths each with a single blur over all channels,
+    and afterwards every face only copies a window at a random offset, which
+    is then scaled to the perturbation strength and clipped. Faces larger
+    than a field take a wrapped window, which keeps the noise statistics
+    unchanged (a resized window would stretch the noise grain).
+
+    With a seed, the fields are generated from the seed and the window of a
+    face is chosen from a checksum of its pixels, so the same image always
+    gets the same perturbation.
+    """
+
+    def __init__(self, size: int = 512, fields: int = 4, channels: int = 3, seed: Optional[int] = None):
+        """
+        Initialize the noise bank.
+
+        Args:
+            size: Side length of each noise field
+            fields: Number of noise fields
+            channels: Channels of each field; faces with other channel counts reuse them cyclically
+            seed: Seed for reproducible noise (random when None)
+        """
+        self.size = size
+        self.fields = fields
+        self.channels = channels
+        self.seed = seed
+        self._rng = np.random.default_rng(seed)
+        self._bank: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+
+    def build(self) -> np.ndarray:
+        """
+        Draw and smooth the noise fields, if not done yet.
+
+        Returns:
+            Array of shape (fields, size, size, channels) with unit-strength smoothed noise
+        """
+        with self._lock:
+            if self._bank is None:
+                bank = np.random.default_rng(self.seed).standard_normal(
+                    (self.fields, self.size, self.size, self.channels), dtype=np.float32
+                )
+                for field in bank:
+                    # Same smoothing as freshly generated noise, all channels at once
+                    cv2.GaussianBlur(field, (3, 3), 0.5, dst=field)
+                self._bank = bank
+                logger.info(f"Built noise bank of {self.fields} {self.size}x{self.size} field(s), "
+                            f"{bank.nbytes / 1e6:.1f} MB")
+            return self._bank
+
+    def _window(self, shape: Tuple[int, ...], region: np.ndarray) -> Tuple[int, int, int]:
+        """Choose the field and offset of the window for a face region."""
+        if self.seed is None:
+            rng = self._rng
+        else:
+            checksum = zlib.crc32(np.ascontiguousarray(region))
+            rng = np.random.default_rng([self.seed, checksum, *shape])
+        field, top, left = rng.integers(0, [self.fields, self.size, self.size])
+        return int(field), int(top), int(left)
+
+    def sample(self, region: np.ndarray, strength: float, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Cut the perturbation for a face region out of the bank.
+
+        Args:
+            region: Face region as numpy array (grayscale or with channels)
+            strength: Perturbation strength the unit-strength noise is scaled by
+            out: float32 array with the shape of region to write the noise into
+
+        Returns:
+            float32 noise with the shape of region, clipped to [-0.1, 0.1]
+        """
+        bank = self.build()
+        noise = out if out is not None else np.empty(region.shape, dtype=np.float32)
+        if region.size == 0:
+            return noise
+        height, width = region.shape[:2]
+        field, top, left = self._window(region.shape, region)
+
+        if top + height <= self.size and left + width <= self.size:
+            window = bank[field, top:top + height, left:left + width]
+        else:
+            rows = np.arange(top, top + height) % self.size
+            columns = np.arange(left, left + width) % self.size
+            window = bank[field][rows[:, None], columns]
+
+        if region.ndim == 2:
+            np.copyto(noise, window[..., 0])
+        elif region.shape[2] == self.channels:
+            np.copyto(noise, window)
+        else:
+            np.copyto(noise, window[..., np.arange(region.shape[2]) % self.channels])
+
+        noise *= strength
+        np.clip(noise, -0.1, 0.1, out=noise)
+        return noise
@@ -0,0 +1,213 @@
+import logging
+import math
+import time
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+Location = Tuple[int, int, int, int]  # (top, right, bottom, left)
+
+# Larger face boxes are downscaled to this side length while optimizing; dlib
+# aligns faces to 150x150 chips before embedding, so more resolution is wasted work.
+WORKING_FACE_SIZE = 150
+
+
+class _FaceTile:
+    """A face prepared for optimization: a padded crop resized to working resolution."""
+
+    def __init__(self, image: np.ndarray, location: Location, margin: float):
+        top, right, bottom, left = location
+        height, width = bottom - top, right - left
+        pad_y, pad_x = int(height * margin), int(width * margin)
+        crop_top, crop_left = max(top - pad_y, 0), max(left - pad_x, 0)
+        crop_bottom, crop_right = min(bottom + pad_y, image.shape[0]), min(right + pad_x, image.shape[1])
+
+        self.face_shape = (height, width)
+        self.scale = min(WORKING_FACE_SIZE / float(max(height, width)), 1.0)
+        crop = image[crop_top:crop_bottom, crop_left:crop_right]
+        tile_size = (max(int(round(crop.shape[1] * self.scale)), 1), max(int(round(crop.shape[0] * self.scale)), 1))
+        self.tile = cv2.resize(crop, tile_size, interpolation=cv2.INTER_AREA).astype(np.float32)
+        if self.tile.ndim == 2 and crop.ndim == 3:
+            self.tile = self.tile[:, :, np.newaxis]
+
+        # Face box inside the tile
+        self.box_top = int(round((top - crop_top) * self.scale))
+        self.box_left = int(round((left - crop_left) * self.scale))
+        self.box_bottom = min(self.box_top + max(int(round(height * self.scale)), 1), self.tile.shape[0])
+        self.box_right = min(self.box_left + max(int(round(width * self.scale)), 1), self.tile.shape[1])
+        # Encoding of the unperturbed tile, set on the first iteration
+        self.reference_encoding: Optional[np.ndarray] = None
+
+    @property
+    def box_shape(self) -> Tuple[int, int]:
+        return self.box_bottom - self.box_top, self.box_right - self.box_left
+
+    def render(self, perturbation: np.ndarray) -> np.ndarray:
+        """Return the tile with a (box-sized) perturbation applied to the face box."""
+        tile = self.tile.copy()
+        face = tile[self.box_top:self.box_bottom, self.box_left:self.box_right]
+        face += perturbation.reshape(face.shape)
+        np.clip(tile, 0, 255, out=tile)
+        return tile.astype(np.uint8)
+
+
+class EmbeddingOptimizer:
+    """
+    Iteratively optimizes cloaking perturbations that push face embeddings
+    away from the originals, in the spirit of Fawkes.
+
+    The dlib ResNet behind face_recognition is not differentiable, so the
+    gradient of the embedding distance is estimated with antithetic NES
+    sampling in a low-resolution perturbation space, followed by a signed
+    gradient ascent step projected onto an L-infinity budget. Every step
+    evaluates all candidate perturbations of all faces with a single call to
+    the encoder by laying the face tiles out on one canvas. Faces stop
+    being optimized as soon as they reach the target embedding distance, and
+    all of them once the next iteration would end past the deadline.
+    """
+
+    def __init__(self, encode: Callable[[np.ndarray, List[Location]], List[np.ndarray]],
+                 budget: float, step_size: float, max_iterations: int, target_distance: float,
+                 samples: int = 4, sigma: Optional[float] = None, grid_size: int = 16,
+                 margin: float = 0.25, rng: Optional[np.random.Generator] = None,
+                 deadline: Optional[float] = None):
+        """
+        Initialize the optimizer.
+
+        Args:
+            encode: Function returning one encoding per known face location of an image
+            budget: Maximum absolute perturbation per pixel, in 0-255 units
+            step_size: Gradient ascent step, in 0-255 units
+            max_iterations: Maximum optimization iterations
+            target_distance: Embedding distance at which a face counts as cloaked
+            samples: Antithetic sample pairs per face and iteration
+            sigma: Exploration radius of the gradient estimate (defaults to the budget)
+            grid_size: Side length of the low-resolution perturbation grid
+            margin: Context kept around each face box, as a fraction of the box size
+            rng: Random generator used for sampling
+            deadline: Wall-clock time (time.time()) by which optimization must end;
+                at least one iteration always runs
+        """
+        self.encode = encode
+        self.budget = budget
+        self.step_size = step_size
+        self.max_iterations = max_iterations
+        self.target_distance = target_distance
+        self.samples = samples
+        self.sigma = sigma if sigma is not None else budget
+        self.grid_size = grid_size
+        self.margin = margin
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.deadline = deadline
+
+    def _upsample(self, grid: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+        resized = cv2.resize(grid, (shape[1], shape[0]), interpolation=cv2.INTER_LINEAR)
+        return resized.reshape(shape + grid.shape[2:])
+
+    def _encode_tiles(self, tiles: List[np.ndarray], boxes: List[Location]) -> List[np.ndarray]:
+        """Encode many tiles with one encoder call by placing them on a shared canvas."""
+        cell_height = max(tile.shape[0] for tile in tiles)
+        cell_width = max(tile.shape[1] for tile in tiles)
+        columns = int(math.ceil(math.sqrt(len(tiles))))
+        rows = int(math.ceil(len(tiles) / float(columns)))
+        canvas = np.zeros((rows * cell_height, columns * cell_width) + tiles[0].shape[2:], dtype=np.uint8)
+
+        locations = []
+        for index, (tile, (top, right, bottom, left)) in enumerate(zip(tiles, boxes)):
+            y, x = (index // columns) * cell_height, (index % columns) * cell_width
+            canvas[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+            locations.append((y + top, x + right, y + bottom, x + left))
+
+        if canvas.ndim == 3 and canvas.shape[2] == 1:
+            canvas = canvas[:, :, 0]
+        return self.encode(canvas, locations)
+
+    def _encode_all(self, tiles: List[np.ndarray], boxes: List[Location]) -> List[np.ndarray]:
+        """Encode tiles in as few encoder calls as possible (one per channel layout)."""
+        groups = {}
+        for index, tile in enumerate(tiles):
+            groups.setdefault(tile.shape[2:], []).append(index)
+
+        encodings: List[Optional[np.ndarray]] = [None] * len(tiles)
+        for indices in groups.values():
+            group_encodings = self._encode_tiles([tiles[i] for i in indices], [boxes[i] for i in indices])
+            for i, encoding in zip(indices, group_encodings):
+                encodings[i] = encoding
+        return encodings
+
+    def optimize(self, faces: Sequence[Tuple[np.ndarray, Location]]) -> Tuple[List[np.ndarray], List[float]]:
+        """
+        Optimize one perturbation per face.
+
+        Distances are measured against the encoding of the unperturbed face at
+        working resolution, so resampling does not count as progress.
+
+        Args:
+            faces: (image, location) per face; faces may come from different images
+
+        Returns:
+            Perturbations at native face-box resolution (float32, 0-255 units)
+            and the embedding distance each face reached
+        """
+        tiles = [_FaceTile(image, location, self.margin) for image, location in faces]
+        channels = [tile.tile.shape[2:] for tile in tiles]
+        grids = [np.zeros((self.grid_size, self.grid_size) + shape, dtype=np.float32) for shape in channels]
+        distances = [0.0] * len(tiles)
+        active = list(range(len(tiles)))
+
+        iteration_seconds = 0.0
+        for iteration in range(self.max_iterations):
+            started = time.time()
+            if self.deadline is not None and iteration > 0 and started + iteration_seconds > self.deadline:
+                logger.info(f"Stopped optimizing {len(active)} face(s) at the deadline, "
+                            f"after {iteration} of {self.max_iterations} iteration(s)")
+                break
+            # Candidate perturbations: the current one plus antithetic samples around it
+            noise = [self.rng.standard_normal((self.samples,) + grids[i].shape, dtype=np.float32) for i in active]
+            rendered, boxes = [], []
+            for i, samples in zip(active, noise):
+                tile = tiles[i]
+                box = (tile.box_top, tile.box_right, tile.box_bottom, tile.box_left)
+                candidates = [grids[i]]
+                for sample in samples:
+                    candidates.append(grids[i] + self.sigma * sample)
+                    candidates.append(grids[i] - self.sigma * sample)
+                for candidate in candidates:
+                    rendered.append(tile.render(self._upsample(candidate, tile.box_shape)))
+                    boxes.append(box)
+
+            encodings = self._encode_all(rendered, boxes)
+
+            per_face = 1 + 2 * self.samples
+            still_active = []
+            for position, (i, samples) in enumerate(zip(active, noise)):
+                face_encodings = encodings[position * per_face:(position + 1) * per_face]
+                if tiles[i].reference_encoding is None:
+                    # The perturbation is still zero, so candidate 0 is the untouched face
+                    tiles[i].reference_encoding = face_encodings[0]
+                losses = np.linalg.norm(np.asarray(face_encodings) - tiles[i].reference_encoding, axis=1)
+                distances[i] = float(losses[0])
+                if distances[i] >= self.target_distance:
+                    continue
+
+                # NES gradient estimate of the distance w.r.t. the perturbation grid
+                differences = losses[1::2] - losses[2::2]
+                gradient = np.tensordot(differences, samples, axes=1)
+                grids[i] += self.step_size * np.sign(gradient)
+                np.clip(grids[i], -self.budget, self.budget, out=grids[i])
+                still_active.append(i)
+
+            active = still_active
+            iteration_seconds = time.time() - started
+            if not active:
+                logger.debug(f"All faces reached the target distance after {iteration + 1} iteration(s)")
+                break
+
+        perturbations = [
+            self._upsample(grid, tile.face_shape).astype(np.float32, copy=False)
+            for grid, tile in zip(grids, tiles)
+        ]
+        return perturbations, distances
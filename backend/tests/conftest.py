@@ -0,0 +1,24 @@
+import os
+import sys
+import tempfile
+
+# Settings are read when config is imported, so they are set before any backend module loads
+_state_dir = tempfile.mkdtemp(prefix="invisiface-tests-")
+os.environ.setdefault("INVISIFACE_WARM_UP", "0")
+os.environ.setdefault("INVISIFACE_WORKER_MODE", "thread")
+os.environ.setdefault("INVISIFACE_WORKERS", "2")
+os.environ.setdefault("INVISIFACE_JOB_DIR", os.path.join(_state_dir, "jobs"))
+os.environ.setdefault("INVISIFACE_CACHE_DIR", "")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+@pytest.fixture
+def client():
+    """Test client of the API, started and shut down around each test."""
+    from fastapi.testclient import TestClient
+    import main
+    with TestClient(main.app) as test_client:
+        yield test_client
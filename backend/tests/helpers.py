@@ -0,0 +1,51 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+def encode(array: np.ndarray, fmt: str = "PNG") -> bytes:
+    """Encode an image array, for use as an upload."""
+    buffered = io.BytesIO()
+    Image.fromarray(array).save(buffered, format=fmt)
+    return buffered.getvalue()
+
+
+def random_image(width: int = 64, height: int = 48, seed: int = 0) -> np.ndarray:
+    """Reproducible random RGB image."""
+    return np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+
+class FixedDetector:
+    """Detector returning preset boxes, so cloaking runs without the face models."""
+
+    name = "fixed"
+
+    def __init__(self, locations):
+        self.locations = [tuple(location) for location in locations]
+
+    def detect(self, image):
+        height, width = image.shape[:2]
+        return [((top, min(right, width), min(bottom, height), left), 0.9)
+                for top, right, bottom, left in self.locations if top < height and left < width]
+
+    def detect_batch(self, images):
+        return [self.detect(image) for image in images]
+
+    def settings(self):
+        return {"name": self.name, "locations": self.locations}
+
+    def warm_up(self):
+        pass
+
+
+def fixed_noise_cloaker(locations, noise: float = 0.1):
+    """FaceCloaker with a FixedDetector and a constant perturbation, so results are reproducible."""
+    from face_cloaker import FaceCloaker
+
+    cloaker = FaceCloaker()
+    cloaker.detector = FixedDetector(locations)
+    cloaker.generate_adversarial_noise = lambda region, target_encoding=None, out=None: np.full(
+        region.shape, noise, dtype=np.float32)
+    cloaker.generate_adversarial_noise_batch = lambda regions: [
+        np.full(region.shape, noise, dtype=np.float32) for region in regions]
+    return cloaker
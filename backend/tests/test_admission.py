@@ -0,0 +1,107 @@
+import asyncio
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+from admission import AdmissionController, AdmissionError, estimate_image_memory
+from helpers import encode, random_image
+from tiling import estimate_memory
+from video import frame_size
+
+
+def run(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+
+def test_waiting_request_is_admitted_once_memory_is_released():
+    async def scenario():
+        admission = AdmissionController(memory_budget=100, cpu_slots=4)
+        release = await admission.acquire(80)
+        waiter = asyncio.ensure_future(admission.acquire(30))
+        await asyncio.sleep(0.01)
+        assert admission.waiting == 1 and not waiter.done()
+        release()
+        (await waiter)()
+        return admission.memory_in_use, admission.running
+
+    assert run(scenario()) == (0, 0)
+
+
+def test_full_wait_queue_and_long_waits_are_rejected():
+    async def scenario():
+        admission = AdmissionController(memory_budget=100, cpu_slots=1, max_waiting=1, max_wait=0.05)
+        await admission.acquire(10)
+        waiter = asyncio.ensure_future(admission.acquire(10))
+        await asyncio.sleep(0.01)
+        with pytest.raises(AdmissionError) as queue_full:
+            await admission.acquire(10)
+        with pytest.raises(AdmissionError) as timed_out:
+            await waiter
+        return queue_full.value.queue_full, timed_out.value.queue_full
+
+    assert run(scenario()) == (True, False)
+
+
+@pytest.mark.parametrize("waiting, status", [(0, 429), (1, 503)])
+def test_busy_server_answers_with_retry_after(client, monkeypatch, waiting, status):
+    import main
+
+    admission = AdmissionController(memory_budget=1, cpu_slots=1, max_waiting=waiting, max_wait=0.05)
+    admission.running = 1  # a request holds the only CPU slot
+    monkeypatch.setattr(main, "admission", admission)
+
+    response = client.post("/api/cloak-image", files={"file": ("a.png", encode(random_image()), "image/png")})
+
+    assert response.status_code == status
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def test_tiled_estimate_follows_image_size_and_decoding(tmp_path):
+    pixels = random_image(600, 400)
+    for name, fmt in [("small.png", "PNG"), ("big.png", "PNG"), ("big.jpg", "JPEG")]:
+        image = Image.fromarray(pixels if name.startswith("small") else np.tile(pixels, (3, 3, 1)))
+        image.save(str(tmp_path / name), format=fmt)
+
+    small = estimate_memory(str(tmp_path / "small.png"), tile_size=256, band_rows=64)
+    big = estimate_memory(str(tmp_path / "big.png"), tile_size=256, band_rows=64)
+    big_jpeg = estimate_memory(str(tmp_path / "big.jpg"), tile_size=256, band_rows=64)
+
+    assert small < big
+    # JPEG is decoded whole before it is banded
+    assert big_jpeg == big + 1800 * 1200 * 3
+
+
+def test_large_endpoint_reserves_memory_for_the_uploaded_image(client, monkeypatch):
+    import main
+
+    reserved = []
+
+    async def run_file_task(fn, input_path, suffix, *args, memory):
+        reserved.append(memory)
+        raise ValueError("stop here")
+
+    monkeypatch.setattr(main, "run_file_task", run_file_task)
+    for width, height in [(64, 48), (640, 480)]:
+        contents = encode(random_image(width, height), "JPEG")
+        assert client.post("/api/cloak-large", files={"file": ("a.jpg", contents, "image/jpeg")}).status_code == 400
+
+    assert reserved[0] < reserved[1]
+    assert reserved[1] >= 640 * 480 * 3
+
+
+def test_video_reservation_uses_the_probed_frame_size(tmp_path):
+    import main
+
+    path = str(tmp_path / "clip.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 10, (160, 90))
+    if not writer.isOpened():
+        pytest.skip("No video encoder available")
+    for _ in range(3):
+        writer.write(random_image(160, 90))
+    writer.release()
+
+    assert frame_size(path) == (160, 90)
+    assert main.video_task_memory(path) == 2 * estimate_image_memory(160, 90)
+    assert frame_size(str(tmp_path / "missing.avi")) is None
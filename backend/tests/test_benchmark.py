@@ -0,0 +1,31 @@
+import json
+import sys
+
+import benchmark
+import config
+from helpers import FixedDetector
+
+
+def test_benchmark_uses_the_server_cloaker_settings(tmp_path, monkeypatch):
+    created = []
+    server_cloaker = benchmark.create_cloaker
+
+    def create_cloaker():
+        cloaker = server_cloaker()
+        cloaker.detector = FixedDetector([(4, 30, 30, 4)])
+        cloaker.warm_up = lambda: {}
+        created.append(cloaker)
+        return cloaker
+
+    monkeypatch.setattr(benchmark, "create_cloaker", create_cloaker)
+    output = tmp_path / "report.json"
+    monkeypatch.setattr(sys, "argv", ["benchmark.py", "--resolutions", "64x48", "--faces", "1", "--repeats", "1",
+                                      "--warmup", "0", "--output", str(output)])
+
+    assert benchmark.main() == 0
+
+    settings = json.loads(output.read_text())["settings"]
+    assert settings["cloak_method"] == config.CLOAK_METHOD
+    assert settings["detection_max_side"] == (config.DETECTION_MAX_SIDE or None)
+    assert (settings["noise_bank"] is None) == (config.NOISE_BANK_SIZE == 0)
+    assert len(created) == 1
@@ -0,0 +1,57 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import bulk
+import workers
+from face_cloaker import FaceCloaker
+from helpers import FixedDetector, random_image
+
+
+def test_tiled_and_whole_records_share_one_schema(tmp_path, monkeypatch):
+    cloaker = FaceCloaker()
+    cloaker.detector = FixedDetector([(5, 40, 37, 9)])
+    cloaker.generate_adversarial_noise = lambda region, target_encoding=None, out=None: np.full(
+        region.shape, 0.1, dtype=np.float32)
+    monkeypatch.setattr(workers, "get_cloaker", lambda: cloaker)
+    input_path = str(tmp_path / "in.png")
+    Image.fromarray(random_image(64, 48)).save(input_path)
+
+    records = [bulk.cloak_file((input_path, str(tmp_path / f"out{tiled}.png"), tiled, "png", 1))
+               for tiled in (False, True)]
+
+    for record in records:
+        assert record["status"] == "done", record.get("error")
+        assert record["faces"] == 1
+        assert record["boxes"] == [[5, 40, 37, 9]]
+        json.dumps(record)
+    assert records[1]["tiles"] >= 1
+
+
+def test_files_from_different_directories_keep_apart(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for folder in ("a", "b"):
+        (tmp_path / folder).mkdir()
+        Image.fromarray(random_image()).save(tmp_path / folder / "photo.png")
+
+    found = list(bulk.find_images(["a/photo.png", "b/photo.png"], None))
+
+    assert [relative for _, relative in found] == [os.path.join("a", "photo.png"), os.path.join("b", "photo.png")]
+
+
+def test_colliding_outputs_stop_the_run(tmp_path, monkeypatch, capsys):
+    for folder in ("a", "b"):
+        (tmp_path / folder).mkdir()
+        Image.fromarray(random_image()).save(tmp_path / folder / "photo.png")
+    monkeypatch.setattr(sys, "argv", ["bulk.py", str(tmp_path / "a"), str(tmp_path / "b"),
+                                      "--output-dir", str(tmp_path / "out")])
+
+    with pytest.raises(SystemExit):
+        bulk.main()
+
+    assert "would both be cloaked to" in capsys.readouterr().err
+    assert not (tmp_path / "out" / "photo_cloaked.png").exists()
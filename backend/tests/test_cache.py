@@ -0,0 +1,85 @@
+import asyncio
+import pickle
+
+import numpy as np
+import pytest
+
+from cache import ResultCache
+
+
+def test_hit_and_miss_counters():
+    cache = ResultCache(max_bytes=1024)
+    key = cache.make_key("cloak", ResultCache.digest(b"image"), {"format": "png"})
+    assert cache.get(key) is None
+    cache.put(key, b"encoded")
+    assert cache.get(key) == b"encoded"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_keys_separate_namespaces_contents_and_params():
+    digest = ResultCache.digest(b"image")
+    keys = {
+        ResultCache.make_key("cloak", digest, {"format": "png"}),
+        ResultCache.make_key("faces", digest, {"format": "png"}),
+        ResultCache.make_key("cloak", ResultCache.digest(b"other"), {"format": "png"}),
+        ResultCache.make_key("cloak", digest, {"format": "webp"}),
+    }
+    assert len(keys) == 4
+    # Parameter order does not matter
+    assert (ResultCache.make_key("cloak", digest, {"a": 1, "b": 2})
+            == ResultCache.make_key("cloak", digest, {"b": 2, "a": 1}))
+
+
+def test_memory_budget_evicts_least_recently_used():
+    cache = ResultCache(max_bytes=10)
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")
+    cache.get("a")
+    cache.put("c", b"12345")
+    assert cache.get("a") == b"12345"
+    assert cache.get("b") is None
+    assert cache.evictions == 1
+
+
+def test_disk_tier_survives_close(tmp_path):
+    cache = ResultCache(max_bytes=1024, disk_dir=str(tmp_path), disk_max_bytes=1024 * 1024)
+    cache.put("first", {"faces": [1, 2]})
+    cache.close()
+    # Writes keep reaching the disk after close, e.g. when the app starts again
+    cache.put("second", b"encoded")
+    cache.close()
+
+    reopened = ResultCache(max_bytes=1024, disk_dir=str(tmp_path), disk_max_bytes=1024 * 1024)
+    assert reopened.get("first") == {"faces": [1, 2]}
+    assert reopened.get("second") == b"encoded"
+    assert reopened.disk_hits == 2
+
+
+def test_async_lookup_reads_the_disk_tier(tmp_path):
+    cache = ResultCache(max_bytes=1024, disk_dir=str(tmp_path), disk_max_bytes=1024 * 1024)
+    cache.put("faces", [{"location": (1, 2, 3, 4)}])
+    cache.close()
+
+    reopened = ResultCache(max_bytes=1024, disk_dir=str(tmp_path), disk_max_bytes=1024 * 1024)
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(reopened.get_async("faces")) == [{"location": (1, 2, 3, 4)}]
+        assert loop.run_until_complete(reopened.get_async("missing")) is None
+    finally:
+        loop.close()
+    assert (reopened.hits, reopened.misses, reopened.disk_hits) == (1, 1, 1)
+
+
+def test_arrays_are_sized_without_pickling(monkeypatch):
+    monkeypatch.setattr(pickle, "dumps", lambda *args, **kwargs: pytest.fail("pickled in memory"))
+    cache = ResultCache(max_bytes=1024 * 1024)
+    cache.put("faces", [{"encoding": np.zeros(128)}])
+    assert 128 * 8 < cache.stats()["bytes"] < 2 * 128 * 8
+
+
+def test_disk_budget_evicts_oldest_files(tmp_path):
+    cache = ResultCache(max_bytes=1024, disk_dir=str(tmp_path), disk_max_bytes=250)
+    for index in range(5):
+        cache.put(f"entry-{index}", bytes(100))
+        cache.close()
+    assert cache._disk_bytes == sum(size for _, size, _ in cache._disk_files()) <= 250
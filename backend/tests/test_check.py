@@ -0,0 +1,58 @@
+import asyncio
+
+import numpy as np
+
+import workers
+from face_cloaker import FaceCloaker
+from helpers import FixedDetector, encode, random_image
+
+
+def proxy_cloaker(monkeypatch, max_side):
+    cloaker = FaceCloaker()
+    cloaker.detector = FixedDetector([(20, 90, 100, 10)])
+    cloaker.detection_max_side = max_side
+    cloaker.encode_faces = lambda image, faces, rgb_image=None: [
+        {**face, 'encoding': face['encoding'] if face['encoding'] is not None else np.zeros(128)} for face in faces]
+    cloaker.check_face_recognition = lambda image, faces=None, gallery=None: {"faces": len(faces)}
+    monkeypatch.setattr(workers, "get_cloaker", lambda: cloaker)
+    return cloaker
+
+
+def test_check_keeps_faces_in_proxy_coordinates(monkeypatch):
+    proxy_cloaker(monkeypatch, max_side=100)
+    contents = encode(random_image(400, 300), "JPEG")
+    exact = [{'id': 0, 'location': (40, 181, 201, 21), 'encoding': None, 'confidence': 0.9}]
+
+    _, faces = workers.check_task(contents, exact_faces=exact)
+    # Passing the task's own faces back does not move or grow the boxes
+    for _ in range(3):
+        _, again = workers.check_task(contents, faces=faces)
+        assert [face['location'] for face in again] == [face['location'] for face in faces]
+
+    # Draft decoding halves the 400x300 JPEG twice, to 100x75
+    assert faces[0]['location'] == (10, 46, 51, 5)
+    assert exact[0]['location'] == (40, 181, 201, 21) and exact[0]['encoding'] is None
+
+
+def test_check_never_overwrites_the_exact_faces(monkeypatch):
+    import main
+
+    contents = encode(random_image(80, 60, seed=19))
+    digest = main.ResultCache.digest(contents)
+    faces_key = main.result_cache.make_key("faces", digest, main.cloaker_params)
+    proxy_key = main.result_cache.make_key("faces-proxy", digest, main.cloaker_params)
+    exact = [{'id': 0, 'location': (8, 40, 40, 8), 'encoding': None, 'confidence': 0.9}]
+    proxy = [{'id': 0, 'location': (4, 20, 20, 4), 'encoding': np.zeros(128), 'confidence': 0.9}]
+    main.result_cache.put(faces_key, exact)
+    calls = []
+
+    async def run_in_worker(fn, *args, **kwargs):
+        calls.append(args)
+        return {"faces": 1}, proxy
+
+    monkeypatch.setattr(main, "run_in_worker", run_in_worker)
+    asyncio.new_event_loop().run_until_complete(main.check_cached(contents))
+
+    assert calls == [(contents, None, exact)]
+    assert main.result_cache.get(faces_key) is exact
+    assert main.result_cache.get(proxy_key) is proxy
@@ -0,0 +1,101 @@
+import io
+import zipfile
+
+import numpy as np
+from PIL import Image
+
+import workers
+from helpers import encode, fixed_noise_cloaker, random_image
+
+
+def test_batch_matches_single_images():
+    cloaker = fixed_noise_cloaker([(5, 40, 37, 9)])
+    images = [random_image(seed=seed) for seed in range(3)]
+
+    batch = cloaker.cloak_images([image.copy() for image in images])
+
+    for image, cloaked in zip(images, batch):
+        assert np.array_equal(cloaked, cloaker.cloak_image(image))
+        assert not np.array_equal(cloaked, image)
+
+
+def test_batch_endpoint_returns_one_image_per_upload(client, monkeypatch):
+    monkeypatch.setattr(workers, "get_cloaker", lambda: fixed_noise_cloaker([(5, 40, 37, 9)]))
+    files = [("files", (f"photo{index}.png", encode(random_image(seed=index)), "image/png")) for index in range(2)]
+
+    response = client.post("/api/cloak-batch?format=png", files=files)
+
+    assert response.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.namelist() == ["000_photo0_cloaked.png", "001_photo1_cloaked.png"]
+    assert Image.open(io.BytesIO(archive.read("001_photo1_cloaked.png"))).size == (64, 48)
+
+
+def test_batch_size_is_limited(client, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main.config, "MAX_BATCH_SIZE", 1)
+    files = [("files", (f"{index}.png", encode(random_image()), "image/png")) for index in range(2)]
+
+    assert client.post("/api/cloak-batch", files=files).status_code == 400
+
+
+def test_cloaking_never_computes_encodings(monkeypatch):
+    import face_cloaker
+
+    def unavailable():
+        raise AssertionError("encodings computed")
+
+    monkeypatch.setattr(face_cloaker, "_load_face_recognition", unavailable)
+    cloaker = fixed_noise_cloaker([(5, 40, 37, 9)])
+
+    faces = cloaker.detect_faces(random_image(), with_encodings=False)
+    cloaker.cloak_image(random_image())
+
+    assert [face['location'] for face in faces] == [(5, 40, 37, 9)]
+    assert faces[0]['encoding'] is None
+
+
+def test_known_encodings_are_kept_and_records_not_mutated():
+    cloaker = fixed_noise_cloaker([])
+    faces = [{'id': 0, 'location': (5, 40, 37, 9), 'encoding': np.ones(128), 'confidence': 0.9}]
+
+    assert cloaker.encode_faces(random_image(), faces) is faces
+    assert faces[0]['encoding'].sum() == 128
+
+
+def test_boxes_found_on_the_proxy_are_mapped_back():
+    cloaker = fixed_noise_cloaker([(10, 50, 40, 20)])
+    seen = []
+    detect = cloaker.detector.detect
+    cloaker.detector.detect = lambda image: seen.append(image.shape) or detect(image)
+    cloaker.detection_max_side = 100
+
+    faces = cloaker.locate_faces(random_image(400, 300))
+
+    assert seen == [(75, 100, 3)]
+    assert faces[0]['location'] == (40, 200, 160, 80)
+
+
+def test_small_images_are_detected_at_full_resolution():
+    cloaker = fixed_noise_cloaker([(10, 50, 40, 20)])
+    cloaker.detection_max_side = 1000
+
+    assert cloaker.locate_faces(random_image(400, 300))[0]['location'] == (10, 50, 40, 20)
+
+
+def test_in_place_cloaking_touches_only_face_regions():
+    cloaker = fixed_noise_cloaker([(5, 40, 37, 9)])
+    image = random_image()
+    original = image.copy()
+
+    copied = cloaker.cloak_image(image)
+    assert np.array_equal(image, original)
+
+    cloaked = cloaker.cloak_image(image, inplace=True)
+    assert cloaked is image
+    assert np.array_equal(cloaked, copied)
+    outside = np.ones(image.shape[:2], dtype=bool)
+    outside[5:37, 9:40] = False
+    assert np.array_equal(cloaked[outside], original[outside])
+    assert not np.array_equal(cloaked[5:37, 9:40], original[5:37, 9:40])
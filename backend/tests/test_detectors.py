@@ -0,0 +1,85 @@
+import cv2
+import numpy as np
+import pytest
+
+from detectors import FaceDetector, _to_bgr, create_detector
+from face_cloaker import FaceCloaker
+from helpers import random_image
+from video import VideoCloaker
+
+
+class RecordingDetector(FaceDetector):
+    name = "recording"
+
+    def __init__(self):
+        self.images = []
+
+    def detect(self, image):
+        self.images.append(image.copy())
+        return []
+
+
+def red_and_blue(width=64, height=48):
+    """RGB image, red on the left half and blue on the right, as PIL decodes it."""
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    image[:, :width // 2, 0] = 255
+    image[:, width // 2:, 2] = 255
+    return image
+
+
+def cloaker_with(detector):
+    cloaker = FaceCloaker()
+    cloaker.detector = detector
+    return cloaker
+
+
+def test_detectors_receive_bgr():
+    detector = RecordingDetector()
+    cloaker_with(detector).locate_faces(red_and_blue())
+
+    seen = detector.images[0]
+    # Red is the last channel in BGR order
+    assert seen[0, 0].tolist() == [0, 0, 255]
+    assert seen[0, -1].tolist() == [255, 0, 0]
+    # The OpenCV backends pass it on unchanged
+    assert np.array_equal(_to_bgr(seen), seen)
+
+
+def test_opencv_input_of_other_layouts():
+    rgba = np.dstack([red_and_blue(), np.full((48, 64), 255, dtype=np.uint8)])
+    assert _to_bgr(rgba)[0, 0].tolist() == [0, 0, 255]
+    assert _to_bgr(np.full((4, 4), 7, dtype=np.uint8)).shape == (4, 4, 3)
+
+
+def test_video_frames_reach_detectors_in_the_same_order(tmp_path):
+    input_path, output_path = str(tmp_path / "in.avi"), str(tmp_path / "out.avi")
+    writer = cv2.VideoWriter(input_path, cv2.VideoWriter_fourcc(*"MJPG"), 10, (64, 48))
+    if not writer.isOpened():
+        pytest.skip("No video encoder available")
+    for _ in range(2):
+        writer.write(cv2.cvtColor(red_and_blue(), cv2.COLOR_RGB2BGR))
+    writer.release()
+
+    detector = RecordingDetector()
+    VideoCloaker(cloaker_with(detector)).cloak_video(input_path, output_path, fourcc="MJPG")
+
+    seen = detector.images[0].astype(int)
+    assert seen[24, 8, 2] > 200 and seen[24, 8, 0] < 50
+    assert seen[24, 56, 0] > 200 and seen[24, 56, 2] < 50
+    # Written back in OpenCV's order
+    ok, frame = cv2.VideoCapture(output_path).read()
+    assert ok and frame[24, 8, 2] > 200
+
+
+def test_unknown_or_unconfigured_backends_are_rejected():
+    with pytest.raises(ValueError):
+        create_detector("nope")
+    with pytest.raises(ValueError):
+        create_detector("yunet", model_path="/missing.onnx")
+    assert create_detector("HOG").name == "hog"
+
+
+def test_batch_defaults_to_single_detections():
+    detector = RecordingDetector()
+    assert detector.detect_batch([random_image(), random_image(seed=1)]) == [[], []]
+    assert len(detector.images) == 2
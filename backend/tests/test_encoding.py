@@ -0,0 +1,55 @@
+import base64
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import workers
+from helpers import encode, fixed_noise_cloaker, random_image
+from image_io import encode_image, normalize_format
+
+
+@pytest.fixture
+def cloaker(monkeypatch):
+    cloaker = fixed_noise_cloaker([(5, 40, 37, 9)])
+    monkeypatch.setattr(workers, "get_cloaker", lambda: cloaker)
+    return cloaker
+
+
+def upload(seed):
+    return {"file": ("a.png", encode(random_image(seed=seed)), "image/png")}
+
+
+def test_formats_are_normalized_and_validated():
+    assert normalize_format("JPG", 90) == "jpeg"
+    with pytest.raises(ValueError):
+        normalize_format("gif")
+    with pytest.raises(ValueError):
+        normalize_format("png", 10)
+
+
+@pytest.mark.parametrize("fmt", ["png", "webp"])
+def test_lossless_formats_keep_the_perturbation(fmt):
+    pixels = random_image()
+    assert np.array_equal(np.asarray(Image.open(io.BytesIO(encode_image(pixels, fmt, 1)))), pixels)
+
+
+def test_binary_and_json_responses_carry_the_same_image(client, cloaker):
+    binary = client.post("/api/cloak-image?format=webp&response=binary", files=upload(31))
+    data_url = client.post("/api/cloak-image?format=webp", files=upload(31)).json()["cloaked_image"]
+
+    assert binary.headers["content-type"] == "image/webp"
+    assert data_url == "data:image/webp;base64," + base64.b64encode(binary.content).decode()
+
+
+def test_download_is_named_after_the_format(client, cloaker):
+    response = client.post("/api/download-cloaked?format=jpeg&compression=80", files=upload(32))
+
+    assert response.headers["content-disposition"].endswith("cloaked_image.jpg")
+    assert Image.open(io.BytesIO(response.content)).format == "JPEG"
+
+
+@pytest.mark.parametrize("query", ["format=gif", "format=jpeg&compression=0", "response=xml"])
+def test_bad_output_options_are_rejected(client, query):
+    assert client.post(f"/api/cloak-image?{query}", files=upload(33)).status_code == 400
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from gallery import DIMENSION, FaceGallery
+
+
+def clusters(count, seed=0):
+    """Encodings spread around a few well separated centres."""
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(8, DIMENSION)).astype(np.float32) * 4
+    return centres[rng.integers(0, len(centres), count)] + rng.normal(size=(count, DIMENSION)).astype(np.float32) * 0.1
+
+
+def brute_force(encodings, queries, k):
+    distances = np.linalg.norm(queries[:, np.newaxis] - encodings[np.newaxis], axis=2)
+    return np.sort(distances, axis=1)[:, :k]
+
+
+def test_exact_search_matches_brute_force(tmp_path):
+    gallery = FaceGallery(str(tmp_path))
+    encodings = clusters(500)
+    gallery.enroll((f"person{i % 50}", encoding) for i, encoding in enumerate(encodings))
+    queries = clusters(5, seed=1)
+
+    distances, identities = gallery.search(queries, k=3)
+
+    assert np.allclose(distances, brute_force(encodings, queries, 3), atol=1e-3)
+    assert all(len(names) == 3 and None not in names for names in identities)
+
+
+def test_index_search_finds_the_nearest_rows_including_new_ones(tmp_path):
+    gallery = FaceGallery(str(tmp_path), approximate_threshold=1, nprobe=2)
+    encodings = clusters(1000)
+    gallery.enroll(("known", encoding) for encoding in encodings)
+    assert gallery.build_index(nlist=8)["indexed_rows"] == 1000
+
+    late = np.full(DIMENSION, 20, dtype=np.float32)
+    gallery.enroll([("late", late)])
+
+    matches = gallery.match(np.stack([encodings[10] + 0.01, late]))
+    assert [match["identity"] for match in matches] == ["known", "late"]
+    assert all(match["matched"] for match in matches)
+    assert gallery.stats()["index_clusters"] == 8
+
+
+def test_other_processes_see_new_rows(tmp_path):
+    writer, reader = FaceGallery(str(tmp_path)), FaceGallery(str(tmp_path))
+    assert reader.match(np.zeros((1, DIMENSION)))[0] == {"identity": None, "distance": None, "matched": False}
+
+    writer.enroll([("alice", np.ones(DIMENSION))])
+
+    assert reader.match(np.ones((1, DIMENSION)))[0]["identity"] == "alice"
+    assert reader.version == writer.version
+
+
+def test_short_galleries_pad_the_results(tmp_path):
+    gallery = FaceGallery(str(tmp_path))
+    gallery.enroll([("alice", np.zeros(DIMENSION))])
+
+    distances, identities = gallery.search(np.zeros(DIMENSION), k=2)
+
+    assert distances[0, 0] == 0 and np.isinf(distances[0, 1])
+    assert identities == [["alice", None]]
+    with pytest.raises(ValueError):
+        FaceGallery(str(tmp_path / "empty")).build_index()
@@ -0,0 +1,167 @@
+import asyncio
+import io
+import os
+import time
+
+import pytest
+
+from helpers import encode, random_image
+from jobs import CANCELLED, DONE, QUEUED, JobScheduler, JobStore
+
+
+def run(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+
+async def wait_for_status(store, job_id, status, timeout=5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while store.get(job_id)["status"] != status:
+        if asyncio.get_running_loop().time() > deadline:
+            pytest.fail(f"job stayed {store.get(job_id)['status']}, expected {status}")
+        await asyncio.sleep(0.01)
+
+
+def test_store_reopens_after_close(tmp_path):
+    store = JobStore(str(tmp_path))
+    store.close()
+    store.open()
+    assert store.pending() == []
+
+
+def test_uploads_are_spooled_to_files_and_removed_when_done(tmp_path):
+    store = JobStore(str(tmp_path))
+    upload = io.BytesIO(b"header" + b"x" * 100)
+    upload.seek(6)
+    job = store.create("cloak", [("photo.png", upload), ("../evil.p/ng", io.BytesIO(b"y"))], {}, 0.0)
+
+    inputs = store.load_input(job["id"])
+    assert [filename for filename, _ in inputs] == ["photo.png", "../evil.p/ng"]
+    assert inputs[0][1].endswith(".png") and os.path.dirname(inputs[1][1]) == str(tmp_path)
+    with open(inputs[0][1], "rb") as f:
+        assert f.read() == b"x" * 100
+    assert job["input_bytes"] == 101
+
+    store.finish(job["id"], b"result", "image/png", "out.png")
+    assert not any(os.path.exists(path) for _, path in inputs)
+
+
+def test_unfinished_job_resumes_after_restart(tmp_path):
+    started = []
+
+    async def blocking_runner(job, uploads):
+        started.append(job["id"])
+        await asyncio.Event().wait()
+
+    async def echo_runner(job, inputs):
+        with open(inputs[0][1], "rb") as f:
+            return f.read(), "image/png", "out.png"
+
+    async def scenario():
+        store = JobStore(str(tmp_path))
+        scheduler = JobScheduler(store, blocking_runner)
+        await scheduler.start()
+        job = await scheduler.submit("cloak", [("a.png", io.BytesIO(b"payload"))], {})
+        while not started:
+            await asyncio.sleep(0.01)
+        await scheduler.stop()
+
+        # Same store, started again: the interrupted job runs to completion
+        scheduler = JobScheduler(store, echo_runner)
+        await scheduler.start()
+        await wait_for_status(store, job["id"], DONE)
+        await scheduler.stop()
+        with open(store.result_path(job["id"]), "rb") as f:
+            return f.read()
+
+    assert run(scenario()) == b"payload"
+
+
+def test_cancelled_queued_job_never_runs(tmp_path):
+    ran = []
+    release = None
+
+    async def runner(job, uploads):
+        ran.append(job["id"])
+        await release.wait()
+        return b"done", "image/png", "out.png"
+
+    async def scenario():
+        nonlocal release
+        release = asyncio.Event()
+        store = JobStore(str(tmp_path))
+        scheduler = JobScheduler(store, runner, concurrency=1)
+        await scheduler.start()
+        first = await scheduler.submit("cloak", [("a.png", io.BytesIO(b"a"))], {})
+        second = await scheduler.submit("cloak", [("b.png", io.BytesIO(b"b"))], {})
+        while not ran:
+            await asyncio.sleep(0.01)
+        assert store.get(second["id"])["status"] == QUEUED
+        assert scheduler.cancel(second["id"])["status"] == CANCELLED
+        release.set()
+        await wait_for_status(store, first["id"], DONE)
+        await asyncio.sleep(0.05)
+        await scheduler.stop()
+        return first["id"], second["id"]
+
+    first_id, second_id = run(scenario())
+    assert ran == [first_id]
+
+
+def test_app_starts_twice_in_one_process():
+    from fastapi.testclient import TestClient
+    import main
+
+    for _ in range(2):
+        with TestClient(main.app) as client:
+            assert client.get("/health").status_code == 200
+            assert client.get("/api/jobs/unknown").status_code == 404
+
+
+def test_submitted_job_runs_from_the_spooled_upload(client, monkeypatch):
+    import main
+
+    paths = []
+    read_file = main.read_file
+
+    async def cloak_cached(contents, output_format, compression, timeout=None):
+        return contents
+
+    monkeypatch.setattr(main, "read_file", lambda path: paths.append(path) or read_file(path))
+    monkeypatch.setattr(main, "cloak_cached", cloak_cached)
+    contents = encode(random_image(32, 32))
+    response = client.post("/api/jobs", files={"files": ("photo.png", contents, "image/png")})
+    assert response.status_code == 202, response.text
+    job_id = response.json()["job_id"]
+
+    deadline = time.monotonic() + 5
+    while client.get(f"/api/jobs/{job_id}").json()["status"] != "done":
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert os.path.dirname(paths[0]) == main.config.JOB_DIR
+    assert client.get(f"/api/jobs/{job_id}/result").content == contents
+
+
+def test_submitted_large_image_job_runs_from_the_spooled_file(client, monkeypatch):
+    import main
+
+    paths = []
+
+    async def run_file_task(fn, input_path, suffix, *args, memory):
+        paths.append(input_path)
+        with open(input_path, "rb") as f, open(main.temporary_path(suffix), "wb") as output:
+            output.write(f.read())
+        return output.name, None
+
+    monkeypatch.setattr(main, "run_file_task", run_file_task)
+    monkeypatch.setattr(main.config, "TILED_MIN_PIXELS", 100)
+    contents = encode(random_image(32, 32))
+    response = client.post("/api/jobs", files={"files": ("big.png", contents, "image/png")})
+    assert response.status_code == 202, response.text
+    job_id = response.json()["job_id"]
+
+    deadline = time.monotonic() + 5
+    while client.get(f"/api/jobs/{job_id}").json()["status"] != "done":
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert os.path.dirname(paths[0]) == main.config.JOB_DIR
+    assert client.get(f"/api/jobs/{job_id}/result").content == contents
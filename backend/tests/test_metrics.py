@@ -0,0 +1,46 @@
+import metrics
+import workers
+from helpers import encode, fixed_noise_cloaker, random_image
+
+
+def test_histogram_buckets_are_cumulative(monkeypatch):
+    monkeypatch.setattr(metrics, "REGISTRY", [])
+    histogram = metrics.Histogram("latency", "Latency", ["stage"], buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        histogram.observe(value, "decode")
+
+    lines = metrics.render().splitlines()
+
+    assert lines[:2] == ["# HELP latency Latency", "# TYPE latency histogram"]
+    assert 'latency_bucket{stage="decode",le="0.1"} 1.0' in lines
+    assert 'latency_bucket{stage="decode",le="1.0"} 2.0' in lines
+    assert 'latency_bucket{stage="decode",le="+Inf"} 3.0' in lines
+    assert 'latency_sum{stage="decode"} 5.55' in lines
+
+
+def test_stages_inside_a_trace_are_collected_not_observed(monkeypatch):
+    observed = []
+    monkeypatch.setattr(metrics.STAGE_SECONDS, "observe", lambda value, name: observed.append(name))
+
+    with metrics.collect_trace() as spans:
+        with metrics.stage("inner"):
+            pass
+    with metrics.stage("outer"):
+        pass
+
+    assert [name for name, _ in spans] == ["inner"]
+    assert observed == ["outer"]
+
+
+def test_metrics_endpoint_reports_requests_and_stages(client, monkeypatch):
+    monkeypatch.setattr(workers, "get_cloaker", lambda: fixed_noise_cloaker([(5, 40, 37, 9)]))
+    client.post("/api/cloak-image", files={"file": ("a.png", encode(random_image(seed=41)), "image/png")})
+
+    response = client.get("/metrics")
+
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'invisiface_request_seconds_count{endpoint="/api/cloak-image"}' in response.text
+    assert 'invisiface_stage_seconds_count{stage="encode_image"}' in response.text
+    assert "invisiface_queue_depth 0.0" in response.text
+    assert "# TYPE invisiface_cache_misses_total counter" in response.text
+    assert "invisiface_cache_misses_total " in response.text
@@ -0,0 +1,42 @@
+import numpy as np
+
+from face_cloaker import FaceCloaker
+from helpers import FixedDetector, random_image
+from noise_bank import NoiseBank
+
+
+def test_seeded_bank_gives_every_image_the_same_perturbation():
+    region = random_image(40, 30)
+    first = NoiseBank(size=64, fields=2, seed=7).sample(region, 0.05)
+    again = NoiseBank(size=64, fields=2, seed=7).sample(region.copy(), 0.05)
+    other = NoiseBank(size=64, fields=2, seed=7).sample(random_image(40, 30, seed=1), 0.05)
+
+    assert np.array_equal(first, again)
+    assert not np.array_equal(first, other)
+    assert first.dtype == np.float32 and np.abs(first).max() <= 0.1
+
+
+def test_regions_larger_than_a_field_and_other_layouts():
+    bank = NoiseBank(size=16, fields=1, seed=3)
+
+    wrapped = bank.sample(random_image(40, 30), 0.05)
+    gray = bank.sample(random_image(8, 8)[..., 0], 0.05)
+    rgba = bank.sample(np.zeros((8, 8, 4), dtype=np.uint8), 0.05)
+
+    assert wrapped.shape == (30, 40, 3) and gray.shape == (8, 8) and rgba.shape == (8, 8, 4)
+    # A wrapped window repeats the field instead of stretching it
+    assert np.array_equal(wrapped[:14], wrapped[16:30]) and np.array_equal(wrapped[:, :24], wrapped[:, 16:40])
+    assert np.array_equal(rgba[..., 3], rgba[..., 0])
+
+
+def test_cloaker_cuts_batch_noise_from_the_bank():
+    cloaker = FaceCloaker()
+    cloaker.detector = FixedDetector([(5, 40, 37, 9)])
+    cloaker.noise_bank = NoiseBank(size=64, fields=2, seed=11)
+    image = random_image()
+
+    single = cloaker.cloak_image(image)
+    batch = cloaker.cloak_images([image.copy()])[0]
+
+    assert np.array_equal(single, batch)
+    assert not np.array_equal(single, image)
@@ -0,0 +1,67 @@
+import time
+
+import numpy as np
+
+import workers
+from helpers import random_image
+from optimizer import EmbeddingOptimizer
+
+
+class MeanEncoder:
+    """Encoder whose embedding is the mean colour of the face, optionally slow."""
+
+    def __init__(self, seconds=0.0):
+        self.seconds = seconds
+        self.calls = 0
+
+    def __call__(self, canvas, locations):
+        self.calls += 1
+        time.sleep(self.seconds)
+        return [np.resize(canvas[top:bottom, left:right].reshape(-1, canvas.shape[-1]).mean(axis=0) / 255.0, 128)
+                for top, right, bottom, left in locations]
+
+
+def optimizer(encoder, **kwargs):
+    settings = dict(budget=12.0, step_size=3.0, max_iterations=50, target_distance=0.1, samples=2,
+                    rng=np.random.default_rng(0))
+    settings.update(kwargs)
+    return EmbeddingOptimizer(encoder, **settings)
+
+
+def faces():
+    return [(random_image(120, 100, seed=7), (10, 90, 80, 20))]
+
+
+def test_perturbation_stays_in_budget_and_moves_the_embedding():
+    encoder = MeanEncoder()
+    perturbations, distances = optimizer(encoder, target_distance=0.05).optimize(faces())
+
+    assert perturbations[0].shape == (70, 70, 3) and perturbations[0].dtype == np.float32
+    assert np.abs(perturbations[0]).max() <= 12.0
+    assert distances[0] >= 0.05
+    # Faces stop as soon as they reach the target
+    assert encoder.calls < 50
+
+
+def test_iterations_stop_at_the_deadline():
+    encoder = MeanEncoder(seconds=0.02)
+    started = time.time()
+    optimizer(encoder, target_distance=10.0, deadline=started + 0.1).optimize(faces())
+
+    assert time.time() - started < 0.15
+    assert 1 < encoder.calls < 10
+
+
+def test_one_iteration_runs_past_the_deadline():
+    encoder = MeanEncoder()
+    perturbations, _ = optimizer(encoder, target_distance=10.0, deadline=time.time() - 1).optimize(faces())
+
+    assert encoder.calls == 1
+    assert np.abs(perturbations[0]).max() > 0
+
+
+def test_tasks_see_the_request_deadline():
+    seen = workers.traced_task(lambda: workers.get_cloaker().deadline, False, 123.0)[0]
+
+    assert seen == 123.0
+    assert workers.get_cloaker().deadline is None
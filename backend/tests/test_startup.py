@@ -0,0 +1,21 @@
+import os
+import subprocess
+import sys
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_importing_the_app_loads_no_face_models():
+    code = ("import sys, main; "
+            "print(sorted(name for name in ('face_recognition', 'dlib', 'tensorflow') if name in sys.modules))")
+    env = {**os.environ, "INVISIFACE_WARM_UP": "0"}
+
+    output = subprocess.run([sys.executable, "-c", code], cwd=BACKEND, env=env, capture_output=True, text=True,
+                            check=True).stdout
+
+    assert output.strip().splitlines()[-1] == "[]"
+
+
+def test_startup_report_is_served(client):
+    assert client.get("/api/startup").status_code == 200
+    assert client.get("/health").json()["status"] == "healthy"
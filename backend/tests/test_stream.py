@@ -0,0 +1,122 @@
+import asyncio
+import json
+
+import numpy as np
+import pytest
+
+import workers
+from admission import AdmissionController
+from face_cloaker import FaceCloaker
+from helpers import FixedDetector, encode, random_image
+from transport import SharedMemoryTransport
+from workers import CloakingExecutor
+
+
+def emit(events, sizes):
+    """Task putting a JSON event and one bytes event per size."""
+    try:
+        events.put({"event": "start"})
+        for index, size in enumerate(sizes):
+            events.put(bytes([index]) * size)
+    finally:
+        events.put(None)
+
+
+@pytest.fixture
+def fixed_cloaker(monkeypatch):
+    cloaker = FaceCloaker()
+    cloaker.detector = FixedDetector([(5, 40, 37, 9)])
+    cloaker.generate_adversarial_noise = lambda region, target_encoding=None, out=None: np.full(
+        region.shape, 0.1, dtype=np.float32)
+    monkeypatch.setattr(workers, "get_cloaker", lambda: cloaker)
+    return cloaker
+
+
+def stream(client, contents):
+    """Send an image over /ws/cloak and collect the messages up to the final event."""
+    messages = []
+    with client.websocket_connect("/ws/cloak?format=png") as websocket:
+        websocket.send_json({"size": len(contents)})
+        websocket.send_bytes(contents)
+        while not messages or not isinstance(messages[-1], dict) or messages[-1]["event"] not in ("done", "error"):
+            message = websocket.receive()
+            messages.append(message["bytes"] if message.get("bytes") is not None else json.loads(message["text"]))
+    return messages
+
+
+def test_stream_events_and_cached_replay(client, fixed_cloaker, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main.config, "STREAM_CHUNK_BYTES", 1024)
+    contents = encode(random_image(seed=23))
+
+    first = stream(client, contents)
+    events = [message["event"] for message in first if isinstance(message, dict)]
+    image = b"".join(message for message in first if isinstance(message, bytes))
+
+    assert events == ["faces", "face", "image", "done"]
+    assert first[0]["faces"][0]["location"] == [5, 40, 37, 9]
+    assert first[1] == {"event": "face", "index": 0, "total": 1}
+    assert first[-1] == {"event": "done", "size": len(image), "cached": False}
+    assert sum(isinstance(message, bytes) for message in first) > 1
+
+    second = stream(client, contents)
+    assert b"".join(message for message in second if isinstance(message, bytes)) == image
+    assert second[-1]["cached"] is True
+
+
+def test_rejected_stream_reports_the_error(client, fixed_cloaker, monkeypatch):
+    import main
+
+    admission = AdmissionController(memory_budget=1, cpu_slots=1, max_waiting=0)
+    admission.running = 1
+    monkeypatch.setattr(main, "admission", admission)
+
+    messages = stream(client, encode(random_image(seed=24)))
+
+    assert messages[-1]["event"] == "error" and messages[-1]["status"] == 429
+    assert messages[-1]["retry_after"] >= 1
+
+
+def test_process_workers_send_chunks_through_shared_memory():
+    received = []
+
+    async def scenario():
+        executor = CloakingExecutor("process", workers=1, transport=SharedMemoryTransport(min_bytes=16))
+        try:
+            receive = executor.transport.receive
+            executor.transport.receive = lambda result, lease: received.append(result.length) or receive(result, lease)
+            channel = executor.event_channel(100)
+            # The third chunk no longer fits the 1 MiB output segment and is pickled
+            task = asyncio.ensure_future(executor.submit(emit, channel.sender, [512 * 1024] * 3,
+                                                         on_done=channel.worker_done))
+            events = []
+            while True:
+                event = await channel.get()
+                if event is None:
+                    break
+                events.append(event)
+            await task
+            channel.close()
+            return events, executor.transport.pool.in_use
+        finally:
+            executor.shutdown()
+
+    events, in_use = asyncio.new_event_loop().run_until_complete(scenario())
+
+    assert events[0] == {"event": "start"}
+    assert events[1:] == [bytes([index]) * (512 * 1024) for index in range(3)]
+    assert received == [512 * 1024] * 2
+    assert in_use == 0
+
+
+def test_refused_task_ends_the_stream():
+    async def scenario():
+        executor = CloakingExecutor("thread", workers=1, max_queue_depth=0)
+        executor._outstanding = 1
+        channel = executor.event_channel()
+        with pytest.raises(workers.QueueFullError):
+            await executor.submit(emit, channel.sender, [], on_done=channel.worker_done)
+        return await channel.get()
+
+    assert asyncio.new_event_loop().run_until_complete(scenario()) is None
@@ -0,0 +1,105 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from face_cloaker import FaceCloaker
+from helpers import FixedDetector, encode, random_image
+from noise_bank import NoiseBank
+from tiling import TiledCloaker, decode_bands, merge_detections, streams_bands
+
+
+def deterministic_cloaker(locations):
+    cloaker = FaceCloaker()
+    cloaker.detector = FixedDetector(locations)
+    # Same perturbation wherever a face is cut into bands
+    cloaker.generate_adversarial_noise = lambda region, target_encoding=None, out=None: np.full(
+        region.shape, 0.1, dtype=np.float32)
+    return cloaker
+
+
+@pytest.mark.parametrize("fmt, mode", [
+    ("PNG", "RGB"), ("PNG", "RGBA"), ("PNG", "L"), ("PNG", "P"),
+    ("BMP", "RGB"), ("BMP", "P"), ("PPM", "RGB"), ("TIFF", "RGBA"), ("JPEG", "RGB"),
+])
+def test_bands_match_full_decode(fmt, mode):
+    buffered = io.BytesIO()
+    Image.fromarray(random_image(61, 47)).convert(mode).save(buffered, format=fmt)
+    expected = Image.open(io.BytesIO(buffered.getvalue())).convert("RGB")
+
+    image = Image.open(io.BytesIO(buffered.getvalue()))
+    bands = [band.convert("RGB") for band in decode_bands(image, 8)]
+
+    assert [band.size[1] for band in bands] == [8] * 5 + [7]
+    assert np.array_equal(np.concatenate([np.asarray(band) for band in bands]), np.asarray(expected))
+
+
+def test_only_compressed_formats_are_decoded_whole():
+    assert streams_bands(Image.open(io.BytesIO(encode(random_image(), "PNG"))))
+    assert streams_bands(Image.open(io.BytesIO(encode(random_image(), "BMP"))))
+    assert not streams_bands(Image.open(io.BytesIO(encode(random_image(), "JPEG"))))
+
+
+def test_truncated_png_is_rejected():
+    contents = encode(random_image(256, 256), "PNG")
+    image = Image.open(io.BytesIO(contents[:len(contents) // 2]))
+    with pytest.raises(ValueError):
+        list(decode_bands(image, 16))
+
+
+def test_tiled_output_matches_untiled(tmp_path):
+    pixels = random_image(64, 48)
+    input_path, output_path = str(tmp_path / "in.png"), str(tmp_path / "out.png")
+    Image.fromarray(pixels).save(input_path)
+    cloaker = deterministic_cloaker([(5, 40, 37, 9)])
+
+    stats = TiledCloaker(cloaker, tile_size=128, overlap=16, band_rows=8).cloak_file(input_path, output_path)
+
+    assert stats["faces"] == 1
+    expected = cloaker.cloak_image(pixels)
+    assert not np.array_equal(expected, pixels)
+    assert np.array_equal(np.asarray(Image.open(output_path)), expected)
+
+
+def test_pixel_guard_is_raised_only_while_opening(tmp_path, monkeypatch):
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    input_path = str(tmp_path / "in.png")
+    Image.fromarray(random_image(64, 48)).save(input_path)
+
+    TiledCloaker(deterministic_cloaker([])).cloak_file(input_path, str(tmp_path / "out.png"))
+
+    assert Image.MAX_IMAGE_PIXELS == 1000
+    with pytest.raises(Image.DecompressionBombError):
+        Image.open(input_path)
+
+
+def test_overlapping_boxes_are_merged():
+    merged = merge_detections([((0, 50, 50, 0), 0.6), ((10, 60, 55, 20), 0.8), ((100, 150, 150, 100), 0.7)])
+    assert sorted(merged) == [((0, 60, 55, 0), 0.8), ((100, 150, 150, 100), 0.7)]
+
+
+def test_bands_crossing_a_face_share_one_perturbation(tmp_path):
+    pixels = random_image(64, 48)
+    input_path, output_path = str(tmp_path / "in.png"), str(tmp_path / "out.png")
+    Image.fromarray(pixels).save(input_path)
+    cloaker = FaceCloaker()
+    cloaker.detector = FixedDetector([(5, 40, 37, 9)])
+    cloaker.noise_bank = NoiseBank(size=64, fields=2, seed=5)
+
+    stats = TiledCloaker(cloaker, tile_size=128, overlap=16, band_rows=8).cloak_file(input_path, output_path)
+
+    # The seeded bank picks its window from the whole face, not from each band of it
+    assert stats["faces"] == 1
+    assert np.array_equal(np.asarray(Image.open(output_path)), cloaker.cloak_image(pixels))
+
+
+def test_detection_keeps_the_detector_score():
+    cloaker = FaceCloaker()
+    detector = cloaker.detector = FixedDetector([(5, 40, 37, 9)])
+    detect = detector.detect
+    detector.detect = lambda image: [(location, 0.42) for location, _ in detect(image)]
+
+    faces, _ = TiledCloaker(cloaker, tile_size=32, overlap=8).detect(random_image(64, 48))
+
+    assert [face['confidence'] for face in faces] == [0.42]
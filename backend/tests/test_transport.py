@@ -0,0 +1,47 @@
+from transport import SegmentPool, SharedMemoryTransport, SharedSlice, shared_task
+
+
+def upper(data, small):
+    """Task reading a shared buffer in place and returning a large and a small output."""
+    return bytes(data).upper(), small
+
+
+def test_round_trip_through_shared_memory():
+    transport = SharedMemoryTransport(pool_bytes=4 * 1024 * 1024, min_bytes=16)
+    try:
+        args, lease = transport.send((b"a" * 1000, b"tiny"), output_bytes=2000)
+        assert isinstance(args[0], SharedSlice) and args[1] == b"tiny"
+
+        result = shared_task(lease.output, upper, *args)
+        # Outputs go into the output segment whenever they fit
+        assert all(isinstance(shared, SharedSlice) for shared in result)
+        assert transport.receive(result, lease) == (b"A" * 1000, b"tiny")
+
+        lease.release()
+        assert transport.pool.in_use == 2
+        lease.release()
+        assert transport.pool.in_use == 0
+    finally:
+        transport.close()
+
+
+def test_small_buffers_are_pickled():
+    transport = SharedMemoryTransport(min_bytes=1024)
+    assert transport.send((b"small",)) == ((b"small",), None)
+    assert transport.reserve(100) is None
+
+
+def test_pool_reuses_segments_and_drops_the_overflow():
+    pool = SegmentPool(max_bytes=1024 * 1024)
+    try:
+        first, pooled = pool.acquire(10)
+        overflow, overflow_pooled = pool.acquire(10)
+        assert pooled and not overflow_pooled
+        pool.release(first, pooled)
+        pool.release(overflow, overflow_pooled)
+
+        again, _ = pool.acquire(1000)
+        assert again.name == first.name
+        pool.release(again, True)
+    finally:
+        pool.close()
@@ -0,0 +1,45 @@
+import pytest
+
+from helpers import encode, random_image
+from image_io import decode_proxy, image_size
+
+
+@pytest.fixture
+def no_worker(monkeypatch):
+    import main
+
+    async def run_in_worker(*args, **kwargs):
+        raise AssertionError("the upload reached a worker")
+
+    monkeypatch.setattr(main, "run_in_worker", run_in_worker)
+
+
+def post(client, contents, name="a.png"):
+    return client.post("/api/cloak-image", files={"file": (name, contents, "image/png")})
+
+
+@pytest.mark.parametrize("setting, value", [
+    ("MAX_UPLOAD_BYTES", 100),
+    ("MAX_IMAGE_PIXELS", 1000),
+    ("MAX_SPOOLED_UPLOAD_BYTES", 100),
+])
+def test_oversized_uploads_are_refused_before_decoding(client, no_worker, monkeypatch, setting, value):
+    import main
+
+    monkeypatch.setattr(main.config, setting, value)
+
+    assert post(client, encode(random_image(64, 48))).status_code == 413
+
+
+def test_unreadable_uploads_are_bad_requests(client, no_worker):
+    assert post(client, b"not an image" * 10).status_code == 400
+
+
+def test_jpeg_proxies_are_decoded_in_draft_mode():
+    jpeg, png = encode(random_image(400, 300), "JPEG"), encode(random_image(400, 300), "PNG")
+
+    proxy, full_size = decode_proxy(jpeg, 100)
+    assert proxy.shape == (75, 100, 3) and full_size == (400, 300)
+    assert decode_proxy(png, 100)[0].shape == (300, 400, 3)
+    assert decode_proxy(jpeg, 1000)[0].shape == (300, 400, 3)
+    assert image_size(jpeg) == (400, 300)
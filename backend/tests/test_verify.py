@@ -0,0 +1,54 @@
+import types
+
+import numpy as np
+
+import face_cloaker
+import workers
+from helpers import encode, fixed_noise_cloaker, random_image
+
+
+def fake_recognition():
+    """Stand-in for face_recognition: the encoding is the mean colour of the face box."""
+    def face_encodings(image, locations):
+        return [np.resize(image[top:bottom, left:right].mean(axis=(0, 1)) / 255, 128)
+                for top, right, bottom, left in locations]
+
+    def face_distance(known, encoding):
+        return np.linalg.norm(np.asarray(known) - encoding, axis=1)
+
+    return types.SimpleNamespace(face_encodings=face_encodings, face_distance=face_distance)
+
+
+def test_faces_are_located_once(monkeypatch):
+    monkeypatch.setattr(face_cloaker, "_load_face_recognition", fake_recognition)
+    cloaker = fixed_noise_cloaker([(5, 40, 37, 9)])
+    calls = []
+    detect = cloaker.detector.detect
+    cloaker.detector.detect = lambda image: calls.append(1) or detect(image)
+    image = random_image()
+
+    cloaked, comparison, faces = cloaker.cloak_and_verify(image.copy())
+
+    assert len(calls) == 1
+    assert comparison["original_faces"] == comparison["cloaked_faces"] == 1
+    assert comparison["faces"][0]["location"] == [5, 40, 37, 9]
+    assert comparison["average_similarity"] < 1.0
+    assert faces[0]['encoding'] is not None and not np.array_equal(cloaked, image)
+
+
+def test_verified_output_is_reused_by_plain_cloaking(client, monkeypatch):
+    import main
+
+    monkeypatch.setattr(face_cloaker, "_load_face_recognition", fake_recognition)
+    monkeypatch.setattr(workers, "get_cloaker", lambda: fixed_noise_cloaker([(5, 40, 37, 9)]))
+    upload = {"file": ("a.png", encode(random_image(seed=51)), "image/png")}
+
+    verified = client.post("/api/cloak-and-verify?format=png", files=upload).json()
+    assert verified["verification"]["original_faces"] == 1
+
+    async def no_worker(*args, **kwargs):
+        raise AssertionError("cloaked again")
+
+    monkeypatch.setattr(main, "run_in_worker", no_worker)
+    cloaked = client.post("/api/cloak-image?format=png", files=upload).json()
+    assert cloaked["cloaked_image"] == verified["cloaked_image"]
@@ -0,0 +1,38 @@
+import numpy as np
+
+from face_cloaker import FaceCloaker
+from helpers import FixedDetector, random_image
+from video import VideoCloaker
+
+
+def counting_cloaker(locations):
+    cloaker = FaceCloaker()
+    cloaker.detector = FixedDetector(locations)
+    calls = []
+    detect = cloaker.detector.detect
+    cloaker.detector.detect = lambda image: calls.append(1) or detect(image)
+    return cloaker, calls
+
+
+def test_faces_are_tracked_between_keyframes_with_a_stable_perturbation():
+    cloaker, calls = counting_cloaker([(8, 48, 40, 16)])
+    frame = random_image(64, 48, seed=61)
+    video_cloaker = VideoCloaker(cloaker, keyframe_interval=4)
+
+    cloaked = [np.array(output) for output in video_cloaker.cloak_frames(frame.copy() for _ in range(10))]
+
+    assert len(calls) == 3
+    assert video_cloaker.stats["frames"] == 10 and video_cloaker.stats["keyframes"] == 3
+    assert not np.array_equal(cloaked[0], frame)
+    assert all(np.array_equal(output, cloaked[0]) for output in cloaked[1:])
+
+
+def test_scene_cut_forces_a_keyframe():
+    cloaker, calls = counting_cloaker([])
+    dark, bright = random_image(64, 48, seed=62) // 4, 192 + random_image(64, 48, seed=63) // 4
+    video_cloaker = VideoCloaker(cloaker, keyframe_interval=100)
+
+    list(video_cloaker.cloak_frames([dark.copy(), dark.copy(), bright.copy(), bright.copy()]))
+
+    assert len(calls) == 2
+    assert video_cloaker.stats["scene_changes"] == 1
@@ -0,0 +1,93 @@
+import asyncio
+import threading
+
+import pytest
+
+from workers import CloakingExecutor, QueueFullError
+
+
+def wait_for(event):
+    event.wait(5)
+    return threading.current_thread().name
+
+
+def run(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+
+def test_tasks_run_off_the_event_loop():
+    async def scenario():
+        executor = CloakingExecutor("thread", workers=1)
+        try:
+            event = threading.Event()
+            event.set()
+            return await executor.submit(wait_for, event)
+        finally:
+            executor.shutdown()
+
+    assert run(scenario()).startswith("cloaker")
+
+
+def test_outstanding_requests_are_bounded():
+    async def scenario():
+        executor = CloakingExecutor("thread", workers=1, max_queue_depth=1)
+        event = threading.Event()
+        try:
+            running = [asyncio.ensure_future(executor.submit(wait_for, event)) for _ in range(2)]
+            await asyncio.sleep(0.01)
+            assert executor.outstanding == 2 and executor.queue_depth == 1
+            with pytest.raises(QueueFullError):
+                await executor.submit(wait_for, event)
+            event.set()
+            await asyncio.gather(*running)
+            return executor.outstanding
+        finally:
+            event.set()
+            executor.shutdown()
+
+    assert run(scenario()) == 0
+
+
+def test_timed_out_task_holds_its_slot_until_the_worker_is_done():
+    async def scenario():
+        executor = CloakingExecutor("thread", workers=1)
+        event = threading.Event()
+        done = asyncio.Event()
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await executor.submit(wait_for, event, timeout=0.01, on_done=done.set)
+            assert executor.outstanding == 1 and not done.is_set()
+            event.set()
+            await asyncio.wait_for(done.wait(), 5)
+            return executor.outstanding
+        finally:
+            event.set()
+            executor.shutdown()
+
+    assert run(scenario()) == 0
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError):
+        CloakingExecutor("fiber")
+
+
+def test_every_thread_is_warmed_up_and_shares_the_noise_bank(monkeypatch):
+    import workers
+    from face_cloaker import FaceCloaker
+
+    monkeypatch.setattr(workers, "_noise_bank", None)
+    monkeypatch.setattr(FaceCloaker, "warm_up", lambda self: {"bank": id(self.noise_bank), "cloaker": id(self)})
+
+    async def scenario():
+        executor = CloakingExecutor("thread", workers=3)
+        try:
+            return await executor.warm_up()
+        finally:
+            executor.shutdown()
+
+    reports = run(scenario())
+
+    assert len({report["thread"] for report in reports}) == 3
+    assert len({report["cloaker"] for report in reports}) == 3
+    assert len({report["bank"] for report in reports}) == 1
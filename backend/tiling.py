@@ -0,0 +1,414 @@
+import logging
+import os
+import struct
+import tempfile
+import time
+import zlib
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+
+import config
+from admission import estimate_image_memory
+from face_cloaker import FaceCloaker
+from image_io import PngStreamWriter, pixel_limit
+from metrics import timed_stage
+
+logger = logging.getLogger(__name__)
+
+Location = Tuple[int, int, int, int]  # (top, right, bottom, left)
+Detection = Tuple[Location, float]  # face box and detector score
+
+# Rows cloaked and encoded at a time
+BAND_ROWS = 256
+
+# PNG modes whose scanlines hold one byte per sample, laid out as Pillow stores the decoded pixels
+_PNG_BAND_MODES = ("L", "LA", "RGB", "RGBA", "P")
+
+
+def _png_idat(fp: BinaryIO, position: int) -> Iterator[bytes]:
+    """Yield the compressed image data of a PNG file, starting with the IDAT chunk header at position."""
+    fp.seek(position)
+    while True:
+        header = fp.read(8)
+        if len(header) < 8:
+            return
+        length, kind = struct.unpack(">I4s", header)
+        if kind != b"IDAT":
+            return
+        remaining = length
+        while remaining:
+            data = fp.read(min(remaining, 1024 * 1024))
+            if not data:
+                return
+            remaining -= len(data)
+            yield data
+        fp.seek(4, os.SEEK_CUR)  # CRC
+
+
+def _png_bands(image: Image.Image, band_rows: int) -> Iterator[Image.Image]:
+    """
+    Decode a non-interlaced 8-bit PNG band by band.
+
+    The zlib stream is inflated incrementally, a band of filtered scanlines
+    at a time. Each band is unfiltered by Pillow's PNG decoder, seeded with
+    the previous band's last row (stored unfiltered) as the reference row.
+    """
+    width, height = image.size
+    stride = width * len(image.getbands())
+    inflater = zlib.decompressobj()
+    chunks = _png_idat(image.fp, image.tile[0].offset - 8)
+    compressed = b""
+    previous = bytes(stride)
+    for top in range(0, height, band_rows):
+        rows = min(band_rows, height - top)
+        filtered = bytearray(b"\0" + previous)  # filter type None
+        needed = len(filtered) + rows * (stride + 1)
+        while len(filtered) < needed:
+            if not compressed:
+                compressed = next(chunks, b"")
+                if not compressed:
+                    raise ValueError("Image data is truncated")
+            filtered += inflater.decompress(compressed, needed - len(filtered))
+            compressed = inflater.unconsumed_tail
+        unfiltered = Image.frombytes(image.mode, (width, rows + 1), zlib.compress(filtered, 0), "zip", image.mode)
+        unfiltered = unfiltered.tobytes()
+        previous = unfiltered[-stride:]
+        band = Image.frombytes(image.mode, (width, rows), unfiltered[stride:])
+        if image.mode == "P":
+            band.putpalette(image.palette)
+        yield band
+
+
+def _raw_bands(image: Image.Image, band_rows: int) -> Iterator[Image.Image]:
+    """Read an uncompressed image (BMP, PPM, plain TIFF) band by band, seeking to each band's rows."""
+    width, height = image.size
+    tile = image.tile[0]
+    rawmode, stride, orientation = (tile.args, 0, 1) if isinstance(tile.args, str) else tile.args
+    if not stride:
+        stride = len(Image.new(image.mode, (width, 1)).tobytes("raw", rawmode))
+    for top in range(0, height, band_rows):
+        rows = min(band_rows, height - top)
+        # Bottom-up images store the band's last row first
+        first_row = top if orientation > 0 else height - top - rows
+        image.fp.seek(tile.offset + first_row * stride)
+        data = image.fp.read(rows * stride)
+        if len(data) < rows * stride:
+            raise ValueError("Image data is truncated")
+        band = Image.frombytes(image.mode, (width, rows), data, "raw", rawmode, stride, orientation)
+        if image.mode == "P":
+            band.putpalette(image.palette)
+        yield band
+
+
+def decode_bands(image: Image.Image, band_rows: int) -> Iterator[Image.Image]:
+    """
+    Decode an opened image in bands of rows.
+
+    Non-interlaced 8-bit PNG and uncompressed images are decoded one band at
+    a time, so the full raster is never held in memory. Other formats (JPEG,
+    WebP, compressed TIFF, ...) have no bounded decoding in Pillow: they are
+    decoded whole, then handed out band by band.
+
+    Args:
+        image: Image opened with Image.open and not loaded yet
+        band_rows: Rows per band
+
+    Returns:
+        Iterator over the bands, top to bottom, in the image's mode
+    """
+    if streams_bands(image):
+        if image.tile[0].codec_name == "zip":
+            yield from _png_bands(image, band_rows)
+        else:
+            yield from _raw_bands(image, band_rows)
+        return
+    width, height = image.size
+    image.load()
+    for top in range(0, height, band_rows):
+        yield image.crop((0, top, width, min(top + band_rows, height)))
+
+
+def streams_bands(image: Image.Image) -> bool:
+    """
+    Whether decode_bands decodes an opened image without holding its full raster.
+
+    Args:
+        image: Image opened with Image.open and not loaded yet
+
+    Returns:
+        True for non-interlaced 8-bit PNG and uncompressed single-frame images
+    """
+    if len(image.tile) != 1 or getattr(image, "n_frames", 1) != 1:
+        return False
+    tile = image.tile[0]
+    if tile.extents != (0, 0) + image.size:
+        return False
+    if tile.codec_name == "zip":
+        return (image.format == "PNG" and tile.args == image.mode and image.mode in _PNG_BAND_MODES
+                and not image.info.get("interlace"))
+    if tile.codec_name == "raw":
+        rawmode = tile.args if isinstance(tile.args, str) else tile.args[0]
+        try:
+            Image.new(image.mode, (1, 1)).tobytes("raw", rawmode)
+        except (ValueError, OSError):
+            return False  # no packer to size the rows with
+        return True
+    return False
+
+
+def _overlap_ratio(a: Location, b: Location) -> float:
+    """Intersection of two boxes over the area of the smaller one."""
+    inter_h = min(a[2], b[2]) - max(a[0], b[0])
+    inter_w = min(a[1], b[1]) - max(a[3], b[3])
+    if inter_h <= 0 or inter_w <= 0:
+        return 0.0
+    smaller = min((a[2] - a[0]) * (a[1] - a[3]), (b[2] - b[0]) * (b[1] - b[3]))
+    return inter_h * inter_w / float(smaller) if smaller > 0 else 0.0
+
+
+def merge_detections(detections: List[Detection], min_overlap: float = 0.3) -> List[Detection]:
+    """
+    Merge face boxes found by overlapping tiles.
+
+    A face inside a tile overlap is found by several tiles, and a face cut by
+    a seam yields partial boxes. Boxes covering the same face are replaced
+    by their union, scored by the best of their scores, so the whole face
+    gets cloaked.
+
+    Args:
+        detections: Face boxes in image coordinates with their detector scores
+        min_overlap: Intersection over the smaller box above which two boxes are merged
+
+    Returns:
+        Merged face boxes with their scores
+    """
+    merged: List[Detection] = []
+    for location, score in sorted(detections, key=lambda detection: -(detection[0][2] - detection[0][0])
+                                  * (detection[0][1] - detection[0][3])):
+        current = location
+        changed = True
+        while changed:
+            changed = False
+            for index, (other, other_score) in enumerate(merged):
+                if _overlap_ratio(current, other) >= min_overlap:
+                    current = (min(current[0], other[0]), max(current[1], other[1]),
+                               max(current[2], other[2]), min(current[3], other[3]))
+                    score = max(score, other_score)
+                    del merged[index]
+                    changed = True
+                    break
+        merged.append((current, score))
+    return merged
+
+
+def estimate_memory(input_path: str, tile_size: int, band_rows: int = BAND_ROWS) -> int:
+    """
+    Estimate the peak memory of TiledCloaker.cloak_file from the image header.
+
+    A detection tile, the downscaled overview and one band of rows are held
+    at a time, plus the whole decoded raster for formats that decode_bands
+    decodes whole.
+
+    Args:
+        input_path: Image file readable by Pillow
+        tile_size: Side length of the detection tiles
+        band_rows: Rows cloaked and encoded at a time
+
+    Returns:
+        Estimated bytes
+    """
+    with pixel_limit(config.TILED_MAX_PIXELS):
+        image = Image.open(input_path)
+    with image:
+        width, height = image.size
+        raster = 0 if streams_bands(image) else width * height * len(image.getbands())
+        channels = 4 if image.mode == "RGBA" else 3
+    tile = estimate_image_memory(min(width, tile_size), min(height, tile_size), channels)
+    return 2 * tile + estimate_image_memory(width, min(height, band_rows), channels) + raster
+
+
+class TiledCloaker:
+    """
+    Cloaks very large images with memory bounded by the tile size.
+
+    The image is decoded band by band into a disk-backed array, faces are
+    detected on overlapping tiles (plus a downscaled overview for faces
+    larger than a tile), duplicate detections across seams are merged, and
+    the output is cloaked and PNG-encoded one band of rows at a time.
+    """
+
+    def __init__(self, cloaker: FaceCloaker, tile_size: int = 2048, overlap: int = 256, band_rows: int = BAND_ROWS,
+                 spool_dir: Optional[str] = None):
+        """
+        Initialize the tiled cloaker.
+
+        Args:
+            cloaker: FaceCloaker used for detection and perturbations
+            tile_size: Side length of the detection tiles
+            overlap: Overlap between neighbouring tiles; faces up to this size are
+                always fully inside some tile
+            band_rows: Rows cloaked and encoded at a time
+            spool_dir: Directory of the disk-backed pixel buffer (system temp by default)
+        """
+        if overlap >= tile_size:
+            raise ValueError("Tile overlap must be smaller than the tile size")
+        self.cloaker = cloaker
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.band_rows = band_rows
+        self.spool_dir = spool_dir
+
+    def _spill(self, image: Image.Image, mode: str, path: str) -> np.ndarray:
+        """Decode an image into a disk-backed array in the given mode, one band at a time."""
+        width, height = image.size
+        channels = Image.getmodebands(mode)
+        pixels = np.memmap(path, dtype=np.uint8, mode="w+",
+                           shape=(height, width) if channels == 1 else (height, width, channels))
+        top = 0
+        for band in decode_bands(image, self.band_rows):
+            if band.mode != mode:
+                band = band.convert(mode)
+            pixels[top:top + band.size[1]] = np.asarray(band)
+            top += band.size[1]
+        pixels.flush()
+        return pixels
+
+    def _overview(self, pixels: np.ndarray, max_side: int) -> Tuple[np.ndarray, float]:
+        """Downscaled copy of the whole image, built band by band."""
+        height, width = pixels.shape[:2]
+        scale = min(max_side / float(max(height, width)), 1.0)
+        overview_width = max(int(round(width * scale)), 1)
+        bands = []
+        for top in range(0, height, self.tile_size):
+            bottom = min(top + self.tile_size, height)
+            band_height = int(round(bottom * scale)) - int(round(top * scale))
+            if band_height > 0:
+                bands.append(cv2.resize(np.asarray(pixels[top:bottom]), (overview_width, band_height),
+                                        interpolation=cv2.INTER_AREA))
+        return np.concatenate(bands, axis=0), scale
+
+    @timed_stage("detect_tiles")
+    def detect(self, pixels: np.ndarray) -> Tuple[List[Dict], int]:
+        """
+        Detect faces on overlapping tiles and on a downscaled overview.
+
+        Args:
+            pixels: Full image, typically disk-backed
+
+        Returns:
+            Merged face records in image coordinates and the number of tiles scanned
+        """
+        height, width = pixels.shape[:2]
+        step = self.tile_size - self.overlap
+        detections: List[Detection] = []
+        tiles = 0
+        for tile_top in range(0, max(height - self.overlap, 1), step):
+            for tile_left in range(0, max(width - self.overlap, 1), step):
+                tile = np.array(pixels[tile_top:tile_top + self.tile_size, tile_left:tile_left + self.tile_size])
+                for face in self.cloaker.locate_faces(tile):
+                    top, right, bottom, left = face['location']
+                    detections.append(((top + tile_top, right + tile_left, bottom + tile_top, left + tile_left),
+                                       face['confidence']))
+                tiles += 1
+
+        # Faces too large to fit in a tile are found on the overview
+        if max(height, width) > self.tile_size:
+            overview, scale = self._overview(pixels, self.tile_size)
+            for face in self.cloaker.locate_faces(overview):
+                top, right, bottom, left = face['location']
+                detections.append(((int(top / scale), min(int(round(right / scale)), width),
+                                    min(int(round(bottom / scale)), height), int(left / scale)), face['confidence']))
+
+        faces = [
+            {'id': i, 'location': location, 'encoding': None, 'confidence': score}
+            for i, (location, score) in enumerate(merge_detections(detections))
+        ]
+        return faces, tiles
+
+    def cloak_file(self, input_path: str, output_path: str, compress_level: int = 6) -> Dict[str, Any]:
+        """
+        Cloak an image file into a PNG file without holding the image in memory.
+
+        The image is decoded band by band into a disk-backed buffer (whole,
+        then spilled, for formats without bounded decoding; see
+        decode_bands). Grayscale, RGB and RGBA images keep their mode, other
+        modes are converted to RGB one band at a time.
+
+        Args:
+            input_path: Image file readable by Pillow
+            output_path: Path of the cloaked PNG image
+            compress_level: zlib level of the PNG output
+
+        Returns:
+            Image size, tiles scanned, faces found with their boxes, and timings
+        """
+        started = time.perf_counter()
+        try:
+            # Tiled mode exists for images beyond Pillow's decompression-bomb guard
+            with pixel_limit(config.TILED_MAX_PIXELS):
+                image = Image.open(input_path)
+        except UnidentifiedImageError:
+            raise ValueError("Could not read image")
+        with image:
+            width, height = image.size
+            if width * height > config.TILED_MAX_PIXELS:
+                raise ValueError(f"Image has {width * height} pixels, the limit is {config.TILED_MAX_PIXELS}")
+            mode = image.mode if image.mode in ("L", "RGB", "RGBA") else "RGB"
+            fd, spool_path = tempfile.mkstemp(prefix="invisiface-tiles-", suffix=".raw", dir=self.spool_dir)
+            os.close(fd)
+            try:
+                pixels = self._spill(image, mode, spool_path)
+            except Exception:
+                os.remove(spool_path)
+                raise
+
+        try:
+            faces, tiles = self.detect(pixels)
+
+            # Each face's noise is made once for the whole face and sliced per band, so bands
+            # crossing a face get one continuous perturbation; random noise is made on the
+            # face's first band and dropped after its last one
+            noises: List[Optional[np.ndarray]] = [None] * len(faces)
+            if self.cloaker.cloak_method == "optimize" and faces:
+                noises = self.cloaker.generate_optimized_noise([(pixels, faces)])[0]
+
+            channels = 1 if pixels.ndim == 2 else pixels.shape[2]
+            with open(output_path, "wb") as f:
+                writer = PngStreamWriter(f, width, height, channels, compress_level)
+                for band_top in range(0, height, self.band_rows):
+                    band_bottom = min(band_top + self.band_rows, height)
+                    band = np.array(pixels[band_top:band_bottom])
+                    for index, face in enumerate(faces):
+                        top, right, bottom, left = face['location']
+                        if bottom <= band_top or top >= band_bottom:
+                            continue
+                        if noises[index] is None:
+                            noises[index] = self.cloaker.generate_adversarial_noise(
+                                np.asarray(pixels[top:bottom, left:right]))
+                        # The part of the face inside this band, in band coordinates
+                        clip_top, clip_bottom = max(top, band_top), min(bottom, band_bottom)
+                        location = (clip_top - band_top, right, clip_bottom - band_top, left)
+                        band_noise = noises[index][clip_top - top:clip_bottom - top].copy()
+                        if bottom <= band_bottom:
+                            noises[index] = None
+                        self.cloaker.apply_cloaking_to_face(band, {'location': location}, noise=band_noise)
+                    writer.write_rows(band)
+                writer.close()
+        finally:
+            del pixels
+            os.remove(spool_path)
+
+        stats = {
+            "width": width,
+            "height": height,
+            "tiles": tiles,
+            "faces": len(faces),
+            "boxes": [[int(value) for value in face['location']] for face in faces],
+            "seconds": time.perf_counter() - started,
+        }
+        logger.info(f"Cloaked {width}x{height} image in {tiles} tile(s), {len(faces)} face(s), "
+                    f"in {stats['seconds']:.2f}s")
+        return stats
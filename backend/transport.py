@@ -0,0 +1,396 @@
+import logging
+import threading
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Smallest segment created; smaller requests share this size class so segments are reusable
+MIN_SEGMENT_BYTES = 1024 * 1024
+
+
+class SharedSlice:
+    """
+    Descriptor of a byte buffer placed in a shared memory segment.
+
+    Only descriptors cross the process boundary; the bytes themselves are
+    written once into the segment and read in place by the other side.
+    """
+
+    __slots__ = ("name", "offset", "length", "pooled")
+
+    def __init__(self, name: str, offset: int, length: int, pooled: bool):
+        """
+        Initialize the descriptor.
+
+        Args:
+            name: Name of the shared memory segment
+            offset: Start of the buffer in the segment
+            length: Length of the buffer in bytes
+            pooled: Whether the segment is reused across requests (workers keep it attached)
+        """
+        self.name = name
+        self.offset = offset
+        self.length = length
+        self.pooled = pooled
+
+
+def _map_buffers(value: Any, fn: Callable[[Any], Any]) -> Any:
+    """Apply fn to every bytes object and SharedSlice in nested lists and tuples."""
+    if isinstance(value, (bytes, bytearray, SharedSlice)):
+        return fn(value)
+    if type(value) in (list, tuple):
+        return type(value)(_map_buffers(item, fn) for item in value)
+    return value
+
+
+def _size_class(length: int) -> int:
+    """Round a buffer length up to the segment size class holding it (a power of two)."""
+    size = MIN_SEGMENT_BYTES
+    while size < length:
+        size *= 2
+    return size
+
+
+class SegmentPool:
+    """
+    Pool of shared memory segments reused across requests.
+
+    Segments are created in power-of-two size classes and kept after use,
+    up to max_bytes of pooled segments in total; creating and mapping a new
+    segment costs a system call and page faults on every first touch, which
+    a reused segment has already paid. Requests that do not fit the pool get
+    a transient segment, removed as soon as it is released.
+
+    Thread-safe.
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        Initialize the pool.
+
+        Args:
+            max_bytes: Total size of the segments kept for reuse
+        """
+        self.max_bytes = max_bytes
+        self.pooled_bytes = 0
+        self.in_use = 0
+        self._free: Dict[int, List[SharedMemory]] = {}
+        self._pooled: Dict[str, SharedMemory] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, length: int) -> Tuple[SharedMemory, bool]:
+        """
+        Take a segment of at least length bytes.
+
+        Args:
+            length: Bytes needed
+
+        Returns:
+            The segment and whether it belongs to the pool
+        """
+        size = _size_class(length)
+        with self._lock:
+            # The smallest free segment that is large enough
+            for free_size in sorted(self._free):
+                if free_size >= size and self._free[free_size]:
+                    self.in_use += 1
+                    return self._free[free_size].pop(), True
+            pooled = self.pooled_bytes + size <= self.max_bytes
+            if pooled:
+                self.pooled_bytes += size
+            self.in_use += 1
+        try:
+            segment = SharedMemory(create=True, size=size)
+        except Exception:
+            with self._lock:
+                self.in_use -= 1
+                if pooled:
+                    self.pooled_bytes -= size
+            raise
+        if pooled:
+            with self._lock:
+                self._pooled[segment.name] = segment
+        return segment, pooled
+
+    def release(self, segment: SharedMemory, pooled: bool) -> None:
+        """
+        Return a segment taken with acquire.
+
+        Args:
+            segment: The segment
+            pooled: Whether it belongs to the pool, as returned by acquire
+        """
+        with self._lock:
+            self.in_use -= 1
+            if pooled:
+                self._free.setdefault(segment.size, []).append(segment)
+                return
+        segment.close()
+        segment.unlink()
+
+    def close(self) -> None:
+        """Remove all pooled segments."""
+        with self._lock:
+            segments = list(self._pooled.values())
+            self._pooled.clear()
+            self._free.clear()
+            self.pooled_bytes = 0
+        for segment in segments:
+            try:
+                segment.close()
+                segment.unlink()
+            except Exception as e:
+                logger.error(f"Error removing shared memory segment {segment.name}: {str(e)}")
+
+
+class Lease:
+    """
+    Segments carrying one request's buffers.
+
+    They are returned to the pool once both the worker has finished and the
+    caller has copied the result out, whichever happens last: a request that
+    timed out must not hand its segments to another request while the worker
+    still writes to them.
+    """
+
+    def __init__(self, pool: SegmentPool):
+        self.pool = pool
+        self.segments: List[Tuple[SharedMemory, bool]] = []
+        self.output: Optional[SharedSlice] = None
+        self._holders = 2
+
+    def add(self, length: int) -> SharedMemory:
+        """Acquire a segment of at least length bytes for this request."""
+        segment, pooled = self.pool.acquire(length)
+        self.segments.append((segment, pooled))
+        return segment
+
+    def release(self) -> None:
+        """Called once by the worker side and once by the caller side; the last call frees the segments."""
+        self._holders -= 1
+        if self._holders == 0:
+            self.free()
+
+    def free(self) -> None:
+        """Return the segments to the pool right away."""
+        for segment, pooled in self.segments:
+            self.pool.release(segment, pooled)
+        self.segments = []
+
+
+class SharedMemoryTransport:
+    """
+    Passes image buffers between the API process and process workers through shared memory.
+
+    Pickling uploads to the workers and encoded results back copies every
+    buffer through a pipe several times. With the transport, the API process
+    writes a task's upload bytes into one pooled segment and sends only
+    SharedSlice descriptors; the worker decodes straight from the segment and
+    writes its encoded outputs into an output segment reserved by the API
+    process, which copies them out once. Buffers smaller than min_bytes are
+    still pickled, as are outputs that do not fit the output segment.
+
+    send, receive and Lease.release are called from the event loop; the
+    pool itself is thread-safe.
+    """
+
+    def __init__(self, pool_bytes: int = 256 * 1024 * 1024, min_bytes: int = 64 * 1024):
+        """
+        Initialize the transport.
+
+        Args:
+            pool_bytes: Total size of the segments kept for reuse
+            min_bytes: Smallest buffer worth passing through shared memory
+        """
+        self.pool = SegmentPool(pool_bytes)
+        self.min_bytes = min_bytes
+
+    def start(self) -> None:
+        """Prepare the transport; call before the worker processes start."""
+        # Workers then share this process' resource tracker, so segments they
+        # attach to are not removed when a worker exits
+        resource_tracker.ensure_running()
+
+    def close(self) -> None:
+        """Remove the pooled segments."""
+        self.pool.close()
+
+    def send(self, args: Tuple[Any, ...], output_bytes: int = 0) -> Tuple[Tuple[Any, ...], Optional[Lease]]:
+        """
+        Move a task's large byte arguments into shared memory.
+
+        Args:
+            args: Task arguments; bytes at any depth of lists and tuples are moved
+            output_bytes: Expected size of the task's encoded outputs (0 = no output segment)
+
+        Returns:
+            The arguments with SharedSlice descriptors in place of the moved
+            bytes, and the lease holding the segments (None when nothing was moved)
+        """
+        buffers = []
+        _map_buffers(args, lambda buffer: buffers.append(buffer) if len(buffer) >= self.min_bytes else None)
+        if not buffers and output_bytes < self.min_bytes:
+            return args, None
+
+        lease = Lease(self.pool)
+        try:
+            if buffers:
+                segment = lease.add(sum(len(buffer) for buffer in buffers))
+                pooled = lease.segments[-1][1]
+                offset = 0
+
+                def place(buffer: bytes) -> Any:
+                    nonlocal offset
+                    if len(buffer) < self.min_bytes:
+                        return buffer
+                    segment.buf[offset:offset + len(buffer)] = buffer
+                    shared = SharedSlice(segment.name, offset, len(buffer), pooled)
+                    offset += len(buffer)
+                    return shared
+
+                shared_args = _map_buffers(args, place)
+            else:
+                shared_args = args
+            if output_bytes >= self.min_bytes:
+                segment = lease.add(output_bytes)
+                lease.output = SharedSlice(segment.name, 0, segment.size, lease.segments[-1][1])
+        except Exception as e:
+            # Out of shared memory: the task still works with pickled buffers
+            logger.error(f"Error placing buffers in shared memory: {str(e)}")
+            lease.free()
+            return args, None
+        return shared_args, lease
+
+    def reserve(self, output_bytes: int) -> Optional[Lease]:
+        """
+        Reserve an output segment for a task that hands over its outputs while it runs.
+
+        Args:
+            output_bytes: Expected size of the task's outputs
+
+        Returns:
+            A lease whose output the task writes through a SharedWriter (None
+            when the outputs are too small or shared memory is exhausted)
+        """
+        if output_bytes < self.min_bytes:
+            return None
+        return self.send((), output_bytes)[1]
+
+    def receive(self, result: Any, lease: Lease) -> Any:
+        """
+        Copy a task's outputs out of the lease's output segment.
+
+        Args:
+            result: Task result, possibly holding SharedSlice descriptors
+            lease: The lease returned by send
+
+        Returns:
+            The result with bytes in place of the descriptors
+        """
+        segments = {segment.name: segment for segment, _ in lease.segments}
+        return _map_buffers(result, lambda shared: bytes(
+            segments[shared.name].buf[shared.offset:shared.offset + shared.length]
+        ) if isinstance(shared, SharedSlice) else shared)
+
+
+# Segments attached by this worker process, by name
+_attached: Dict[str, SharedMemory] = {}
+_attached_lock = threading.Lock()
+
+
+def _attach(name: str) -> SharedMemory:
+    with _attached_lock:
+        segment = _attached.get(name)
+        if segment is None:
+            segment = _attached[name] = SharedMemory(name=name)
+        return segment
+
+
+def _detach(name: str) -> None:
+    with _attached_lock:
+        segment = _attached.pop(name, None)
+    if segment is not None:
+        try:
+            segment.close()
+        except BufferError:
+            pass  # a view is still referenced; the mapping goes away with it
+
+
+class SharedWriter:
+    """
+    Appends buffers to an output segment reserved by the API process, inside a worker process.
+    """
+
+    def __init__(self, output: SharedSlice):
+        """
+        Initialize the writer.
+
+        Args:
+            output: Output segment of a lease
+        """
+        self.output = output
+        self.offset = output.offset
+
+    def place(self, buffer: Any) -> Optional[SharedSlice]:
+        """
+        Write a buffer after the previous ones.
+
+        Args:
+            buffer: Bytes to write
+
+        Returns:
+            Descriptor of the written bytes, or None when they do not fit the segment
+        """
+        if self.offset + len(buffer) > self.output.offset + self.output.length:
+            return None
+        _attach(self.output.name).buf[self.offset:self.offset + len(buffer)] = buffer
+        shared = SharedSlice(self.output.name, self.offset, len(buffer), self.output.pooled)
+        self.offset += len(buffer)
+        return shared
+
+    def close(self) -> None:
+        """Detach from a transient segment; pooled ones stay attached for the next request."""
+        if not self.output.pooled:
+            _detach(self.output.name)
+
+
+def shared_task(output: Optional[SharedSlice], fn: Callable[..., Any], *args: Any) -> Any:
+    """
+    Run a task in a worker process on arguments passed through shared memory.
+
+    SharedSlice arguments are replaced by memoryviews of the segment, so the
+    task reads the uploaded bytes in place. Byte buffers in the result are
+    written into the output segment while they fit and returned as
+    descriptors; the rest is pickled as usual.
+
+    Args:
+        output: Output segment reserved by the API process, if any
+        fn: Task function
+        *args: Task arguments, possibly holding SharedSlice descriptors
+
+    Returns:
+        The task's result, possibly holding SharedSlice descriptors
+    """
+    transient = set()
+    writer = SharedWriter(output) if output is not None else None
+
+    def resolve(shared: Any) -> Any:
+        if not isinstance(shared, SharedSlice):
+            return shared
+        if not shared.pooled:
+            transient.add(shared.name)
+        return _attach(shared.name).buf[shared.offset:shared.offset + shared.length]
+
+    try:
+        result = fn(*_map_buffers(args, resolve))
+        if writer is not None:
+            result = _map_buffers(result, lambda buffer: buffer if isinstance(buffer, SharedSlice)
+                                  else writer.place(buffer) or buffer)
+        return result
+    finally:
+        if writer is not None:
+            writer.close()
+        for name in transient:
+            _detach(name)
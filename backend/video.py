@@ -0,0 +1,307 @@
+import logging
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from face_cloaker import FaceCloaker, _box_iou
+from metrics import timed_stage
+
+logger = logging.getLogger(__name__)
+
+Box = Tuple[float, float, float, float]  # (top, right, bottom, left), sub-pixel
+
+
+def frame_size(input_path: str) -> Optional[Tuple[int, int]]:
+    """
+    Read the frame size of a video from its container, without decoding frames.
+
+    Args:
+        input_path: Video file readable by OpenCV
+
+    Returns:
+        Width and height in pixels, or None if the video cannot be opened
+    """
+    capture = cv2.VideoCapture(input_path)
+    try:
+        if not capture.isOpened():
+            return None
+        width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        return (width, height) if width > 0 and height > 0 else None
+    finally:
+        capture.release()
+
+
+class _Track:
+    """A face followed across frames, with the perturbation it keeps for its lifetime."""
+
+    def __init__(self, track_id: int, box: Box, noise: np.ndarray):
+        self.id = track_id
+        self.box = box
+        self.noise = noise
+        self.missed_keyframes = 0
+
+    def location(self, frame_shape: Tuple[int, ...]) -> Tuple[int, int, int, int]:
+        """Integer face box clipped to the frame."""
+        top, right, bottom, left = self.box
+        height, width = frame_shape[:2]
+        return (min(max(int(round(top)), 0), height), min(max(int(round(right)), 0), width),
+                min(max(int(round(bottom)), 0), height), min(max(int(round(left)), 0), width))
+
+
+class VideoCloaker:
+    """
+    Cloaks faces in video streams.
+
+    Full face detection only runs on keyframes: every keyframe_interval
+    frames, after a scene cut, or when a face can no longer be tracked. In
+    between, face boxes follow the sparse optical flow of feature points
+    inside them. Each track keeps the perturbation generated when it was
+    first detected, so the noise on a face stays stable over time instead
+    of flickering from frame to frame.
+    """
+
+    def __init__(self, cloaker: FaceCloaker, keyframe_interval: int = 30, scene_change_threshold: float = 0.4,
+                 tracking_max_side: int = 640, match_iou: float = 0.3, min_track_points: int = 6,
+                 max_missed_keyframes: int = 1):
+        """
+        Initialize the video cloaker.
+
+        Args:
+            cloaker: FaceCloaker used for detection and perturbations
+            keyframe_interval: Frames between full detections
+            scene_change_threshold: Bhattacharyya distance between the luma histograms
+                of consecutive frames above which a scene cut forces a keyframe
+            tracking_max_side: Longest side of the grayscale frames used for tracking
+            match_iou: Minimum overlap for a detection to continue an existing track
+            min_track_points: Feature points a track needs to keep following its face
+            max_missed_keyframes: Keyframes a tracked face may go undetected before its track ends
+        """
+        self.cloaker = cloaker
+        self.keyframe_interval = keyframe_interval
+        self.scene_change_threshold = scene_change_threshold
+        self.tracking_max_side = tracking_max_side
+        self.match_iou = match_iou
+        self.min_track_points = min_track_points
+        self.max_missed_keyframes = max_missed_keyframes
+        self.stats: Dict[str, Any] = {}
+        self._reset()
+
+    def _reset(self) -> None:
+        self._tracks: List[_Track] = []
+        self._next_track_id = 0
+        self._previous_gray: Optional[np.ndarray] = None
+        self._previous_histogram: Optional[np.ndarray] = None
+        self._tracking_scale = 1.0
+        self.stats = {"frames": 0, "keyframes": 0, "scene_changes": 0, "lost_tracks": 0, "tracks": 0}
+
+    def _grayscale(self, frame: np.ndarray) -> np.ndarray:
+        height, width = frame.shape[:2]
+        self._tracking_scale = min(self.tracking_max_side / float(max(height, width)), 1.0)
+        gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        if self._tracking_scale < 1.0:
+            size = (max(int(width * self._tracking_scale), 1), max(int(height * self._tracking_scale), 1))
+            gray = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+        return gray
+
+    def _is_scene_change(self, gray: np.ndarray) -> bool:
+        histogram = cv2.calcHist([gray], [0], None, [64], [0, 256])
+        cv2.normalize(histogram, histogram)
+        previous, self._previous_histogram = self._previous_histogram, histogram
+        if previous is None:
+            return False
+        return cv2.compareHist(previous, histogram, cv2.HISTCMP_BHATTACHARYYA) > self.scene_change_threshold
+
+    @timed_stage("track_faces")
+    def _track(self, gray: np.ndarray) -> bool:
+        """
+        Move every track along the optical flow since the previous frame.
+
+        Returns:
+            False if any track lost its face, so the frame needs a fresh detection
+        """
+        if not self._tracks:
+            return True
+
+        # Feature points of all tracks, tracked with a single pyramidal Lucas-Kanade call
+        scale = self._tracking_scale
+        points, owners = [], []
+        for index, track in enumerate(self._tracks):
+            top, right, bottom, left = (int(round(value * scale)) for value in track.box)
+            mask = np.zeros_like(self._previous_gray)
+            mask[max(top, 0):max(bottom, 0), max(left, 0):max(right, 0)] = 255
+            corners = cv2.goodFeaturesToTrack(self._previous_gray, maxCorners=40, qualityLevel=0.01,
+                                              minDistance=3, mask=mask)
+            if corners is None or len(corners) < self.min_track_points:
+                return False
+            points.append(corners)
+            owners.extend([index] * len(corners))
+
+        previous_points = np.concatenate(points).astype(np.float32)
+        next_points, status, _ = cv2.calcOpticalFlowPyrLK(self._previous_gray, gray, previous_points, None,
+                                                          winSize=(21, 21), maxLevel=3)
+        owners = np.asarray(owners)
+        found = status.ravel() == 1
+
+        for index, track in enumerate(self._tracks):
+            selected = found & (owners == index)
+            if np.count_nonzero(selected) < self.min_track_points:
+                return False
+            before = previous_points[selected].reshape(-1, 2) / scale
+            after = next_points[selected].reshape(-1, 2) / scale
+
+            # Median motion is robust to the odd point that latches onto the background
+            shift_x, shift_y = (float(value) for value in np.median(after - before, axis=0))
+            spread_before = np.median(np.linalg.norm(before - np.median(before, axis=0), axis=1))
+            spread_after = np.median(np.linalg.norm(after - np.median(after, axis=0), axis=1))
+            zoom = float(np.clip(spread_after / spread_before, 0.8, 1.25)) if spread_before > 0 else 1.0
+
+            top, right, bottom, left = track.box
+            center_y, center_x = (top + bottom) / 2 + shift_y, (left + right) / 2 + shift_x
+            half_height, half_width = (bottom - top) * zoom / 2, (right - left) * zoom / 2
+            track.box = (center_y - half_height, center_x + half_width, center_y + half_height, center_x - half_width)
+        return True
+
+    def _new_noises(self, frame: np.ndarray, faces: List[Dict]) -> List[np.ndarray]:
+        if self.cloaker.cloak_method == "optimize":
+            noises = self.cloaker.generate_optimized_noise([(frame, faces)])[0]
+        else:
+            regions = []
+            for face in faces:
+                top, right, bottom, left = face['location']
+                regions.append(frame[top:bottom, left:right])
+            noises = self.cloaker.generate_adversarial_noise_batch(regions)
+        return [np.ascontiguousarray(noise, dtype=np.float32) for noise in noises]
+
+    def _update_tracks(self, frame: np.ndarray, faces: List[Dict]) -> None:
+        """Match keyframe detections to tracks; unmatched detections start new tracks."""
+        unmatched = list(self._tracks)
+        new_faces = []
+        for face in faces:
+            best, best_iou = None, self.match_iou
+            for track in unmatched:
+                iou = _box_iou(face['location'], track.location(frame.shape))
+                if iou >= best_iou:
+                    best, best_iou = track, iou
+            if best is None:
+                new_faces.append(face)
+            else:
+                # Snap the drifting tracked box back onto the detection
+                best.box = tuple(float(value) for value in face['location'])
+                best.missed_keyframes = 0
+                unmatched.remove(best)
+
+        # Tracks the detector missed are kept a little longer, so a face is not
+        # left uncloaked because of one missed detection
+        for track in unmatched:
+            track.missed_keyframes += 1
+            if track.missed_keyframes > self.max_missed_keyframes:
+                self._tracks.remove(track)
+
+        new_faces = [face for face in new_faces if face['location'][2] > face['location'][0]
+                     and face['location'][1] > face['location'][3]]
+        for face, noise in zip(new_faces, self._new_noises(frame, new_faces) if new_faces else []):
+            self._tracks.append(_Track(self._next_track_id, tuple(float(v) for v in face['location']), noise))
+            self._next_track_id += 1
+        self.stats["tracks"] = self._next_track_id
+
+    def _apply(self, frame: np.ndarray) -> None:
+        for track in self._tracks:
+            top, right, bottom, left = location = track.location(frame.shape)
+            if bottom <= top or right <= left:
+                continue
+            # Resizing makes a fresh copy, which apply_cloaking_to_face is free to overwrite
+            noise = cv2.resize(track.noise, (right - left, bottom - top), interpolation=cv2.INTER_LINEAR)
+            noise = noise.reshape(frame[top:bottom, left:right].shape)
+            self.cloaker.apply_cloaking_to_face(frame, {'location': location}, noise=noise)
+
+    def cloak_frames(self, frames: Iterable[np.ndarray]) -> Iterator[np.ndarray]:
+        """
+        Cloak a sequence of frames, one at a time.
+
+        Frames are modified in place and yielded as soon as they are done,
+        so a caller can encode them incrementally.
+
+        Args:
+            frames: Frames in display order (RGB or grayscale, like the images FaceCloaker works on)
+
+        Yields:
+            Cloaked frames
+        """
+        self._reset()
+        frames_since_keyframe = 0
+        for frame in frames:
+            gray = self._grayscale(frame)
+            scene_change = self._is_scene_change(gray)
+            keyframe = (self._previous_gray is None or scene_change
+                        or frames_since_keyframe >= self.keyframe_interval
+                        or self._previous_gray.shape != gray.shape)
+            if not keyframe and not self._track(gray):
+                self.stats["lost_tracks"] += 1
+                keyframe = True
+
+            if keyframe:
+                self._update_tracks(frame, self.cloaker.detect_faces(frame, with_encodings=False))
+                self.stats["keyframes"] += 1
+                self.stats["scene_changes"] += int(scene_change)
+                frames_since_keyframe = 0
+
+            self._apply(frame)
+            self._previous_gray = gray
+            frames_since_keyframe += 1
+            self.stats["frames"] += 1
+            yield frame
+
+    def cloak_video(self, input_path: str, output_path: str, fourcc: str = "mp4v") -> Dict[str, Any]:
+        """
+        Cloak a video file, streaming frames from the decoder to the encoder.
+
+        Only the current and previous frame are held in memory. Frames are
+        converted from OpenCV's BGR order to RGB for cloaking and back for
+        encoding. Audio tracks are not carried over.
+
+        Args:
+            input_path: Video file readable by OpenCV
+            output_path: Path of the cloaked video
+            fourcc: Codec of the output video
+
+        Returns:
+            Processing statistics: frames, keyframes, scene changes, tracks and timings
+        """
+        started = time.perf_counter()
+        capture = cv2.VideoCapture(input_path)
+        if not capture.isOpened():
+            raise ValueError("Could not open video")
+        writer = None
+        try:
+            fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+
+            def read_frames() -> Iterator[np.ndarray]:
+                while True:
+                    ok, frame = capture.read()
+                    if not ok:
+                        return
+                    yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame) if frame.ndim == 3 else frame
+
+            for frame in self.cloak_frames(read_frames()):
+                if writer is None:
+                    height, width = frame.shape[:2]
+                    writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height),
+                                             frame.ndim == 3)
+                    if not writer.isOpened():
+                        raise ValueError(f"Could not open video writer for codec {fourcc}")
+                writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR, dst=frame) if frame.ndim == 3 else frame)
+        finally:
+            capture.release()
+            if writer is not None:
+                writer.release()
+
+        if self.stats["frames"] == 0:
+            raise ValueError("Video contains no decodable frames")
+        self.stats["fps"] = fps
+        self.stats["seconds"] = time.perf_counter() - started
+        logger.info(f"Cloaked {self.stats['frames']} frame(s) with {self.stats['keyframes']} keyframe(s) "
+                    f"in {self.stats['seconds']:.2f}s")
+        return dict(self.stats)
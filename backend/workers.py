@@ -0,0 +1,741 @@
+import asyncio
+import io
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import zipfile
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import config
+import metrics
+from detectors import create_detector
+from face_cloaker import FaceCloaker
+from gallery import FaceGallery
+from image_io import decode_image, decode_proxy, encode_image, file_extension, write_image
+from noise_bank import NoiseBank
+from tiling import TiledCloaker
+from transport import Lease, SharedMemoryTransport, SharedSlice, SharedWriter, shared_task
+from video import VideoCloaker
+
+logger = logging.getLogger(__name__)
+
+# One FaceCloaker per worker thread (thread mode) or per worker process
+# (process mode, where tasks run on the process' main thread).
+_local = threading.local()
+
+
+# Reference gallery, shared by all threads of a process
+_gallery: Optional[FaceGallery] = None
+_gallery_lock = threading.Lock()
+
+# Noise bank, built once per process and read by all its threads
+_noise_bank: Optional[NoiseBank] = None
+_noise_bank_lock = threading.Lock()
+
+
+class QueueFullError(Exception):
+    """Raised when the worker pool already has the maximum number of queued requests."""
+
+
+def create_cloaker() -> FaceCloaker:
+    """Create a FaceCloaker configured from the server settings."""
+    cloaker = FaceCloaker()
+    cloaker.detection_max_side = config.DETECTION_MAX_SIDE or None
+    cloaker.refine_detections = config.REFINE_DETECTIONS
+    cloaker.cloak_method = config.CLOAK_METHOD
+    cloaker.detector = create_detector(config.DETECTOR, config.DETECTOR_MODEL, config.DETECTOR_CONFIG,
+                                       config.DETECTOR_CONFIDENCE or None)
+    cloaker.noise_bank = get_noise_bank()
+    return cloaker
+
+
+def get_noise_bank() -> Optional[NoiseBank]:
+    """Return the noise bank of the current process, creating it if needed (None when disabled)."""
+    global _noise_bank
+    if config.NOISE_BANK_SIZE <= 0:
+        return None
+    with _noise_bank_lock:
+        if _noise_bank is None:
+            _noise_bank = NoiseBank(config.NOISE_BANK_SIZE, config.NOISE_BANK_FIELDS,
+                                    seed=int(config.NOISE_SEED) if config.NOISE_SEED else None)
+        return _noise_bank
+
+
+def _init_worker() -> None:
+    """Create the FaceCloaker instance owned by the current worker."""
+    _local.cloaker = create_cloaker()
+
+
+def warm_up_task(barrier: Optional[threading.Barrier] = None) -> Dict[str, float]:
+    """
+    Load the face models in the current worker.
+
+    Args:
+        barrier: Barrier shared by the warm-ups of a thread pool; waiting on it
+            keeps this thread from picking up another worker's warm-up
+
+    Returns:
+        Warm-up timings from FaceCloaker.warm_up, plus the worker's process id and thread name
+    """
+    report = get_cloaker().warm_up()
+    report["pid"] = os.getpid()
+    report["thread"] = threading.current_thread().name
+    if barrier is not None:
+        barrier.wait()
+    return report
+
+
+def get_cloaker() -> FaceCloaker:
+    """Return the FaceCloaker owned by the current worker, creating it if needed."""
+    cloaker = getattr(_local, "cloaker", None)
+    if cloaker is None:
+        _init_worker()
+        cloaker = _local.cloaker
+    return cloaker
+
+
+def get_gallery() -> Optional[FaceGallery]:
+    """Return this process' up-to-date reference gallery, or None when no gallery is configured."""
+    global _gallery
+    if not config.GALLERY_DIR:
+        return None
+    with _gallery_lock:
+        if _gallery is None:
+            _gallery = FaceGallery(
+                config.GALLERY_DIR,
+                tolerance=config.GALLERY_TOLERANCE,
+                approximate_threshold=config.GALLERY_APPROXIMATE_THRESHOLD,
+                nprobe=config.GALLERY_NPROBE,
+            )
+    # Pick up faces enrolled by other processes
+    _gallery.refresh()
+    return _gallery
+
+
+def traced_task(fn: Callable[..., Any], profile: bool, deadline: Optional[float],
+                *args: Any) -> Tuple[Any, List[metrics.Span], Optional[str]]:
+    """
+    Run a task while collecting its stage timings, optionally under the sampling profiler.
+
+    The spans are returned rather than recorded so that timings from worker
+    processes reach the metrics of the API process. The worker's cloaker
+    holds the request's deadline while the task runs, so long-running stages
+    can stop in time.
+
+    Args:
+        fn: Task function
+        profile: Sample the task's stacks while it runs
+        deadline: Wall-clock time (time.time()) the request must finish by, if any
+        *args: Arguments passed to the task
+
+    Returns:
+        The task's result, its stage spans and the folded profile (None unless profiling)
+    """
+    cloaker = get_cloaker()
+    cloaker.deadline = deadline
+    try:
+        with metrics.collect_trace() as spans:
+            if not profile:
+                return fn(*args), spans, None
+            with metrics.SamplingProfiler() as profiler:
+                result = fn(*args)
+            return result, spans, profiler.folded()
+    finally:
+        cloaker.deadline = None
+
+
+def cloak_task(contents: bytes, faces: Optional[List[Dict]] = None, output_format: str = "png",
+               compression: Optional[int] = None) -> Tuple[bytes, List[Dict]]:
+    """
+    Decode, cloak and encode an uploaded image inside a worker.
+
+    Args:
+        contents: Raw bytes of the uploaded image
+        faces: Previously detected faces of this image, if cached
+        output_format: Normalized output format, see image_io.encode_image
+        compression: Compression setting of the output format
+
+    Returns:
+        Encoded cloaked image and the faces found in the original
+    """
+    cloaker = get_cloaker()
+    image_array = decode_image(contents)
+    if faces is None:
+        faces = cloaker.detect_faces(image_array, with_encodings=False)
+    cloaked_image_array = cloaker.cloak_image(image_array, inplace=True, faces=faces)
+    return encode_image(cloaked_image_array, output_format, compression), faces
+
+
+def cloak_batch_task(uploads: List[Tuple[str, bytes]], output_format: str = "png",
+                     compression: Optional[int] = None) -> bytes:
+    """
+    Cloak a batch of uploaded images inside a worker and zip the results.
+
+    Args:
+        uploads: (filename, raw bytes) pairs of the uploaded images
+        output_format: Normalized output format, see image_io.encode_image
+        compression: Compression setting of the output format
+
+    Returns:
+        Zip archive holding one encoded image per upload, in upload order
+    """
+    image_arrays = [decode_image(contents) for _, contents in uploads]
+    cloaked_image_arrays = get_cloaker().cloak_images(image_arrays, inplace=True)
+
+    archive = io.BytesIO()
+    # Image data is already compressed, so the entries are stored as-is
+    with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_STORED) as zf:
+        for index, ((filename, _), cloaked) in enumerate(zip(uploads, cloaked_image_arrays)):
+            stem = os.path.splitext(os.path.basename(filename or ""))[0] or "image"
+            zf.writestr(f"{index:03d}_{stem}_cloaked.{file_extension(output_format)}",
+                        encode_image(cloaked, output_format, compression))
+    return archive.getvalue()
+
+
+def _decode_for_detection(cloaker: FaceCloaker, contents: bytes) -> Tuple[np.ndarray, float, float]:
+    """
+    Decode an image for detection-only work, at the resolution of the detection proxy when possible.
+
+    Args:
+        cloaker: FaceCloaker whose detection_max_side bounds the needed resolution
+        contents: Raw bytes of the uploaded image
+
+    Returns:
+        Decoded image and its vertical and horizontal scale relative to the full image
+    """
+    if not cloaker.detection_max_side:
+        return decode_image(contents), 1.0, 1.0
+    image_array, (width, height) = decode_proxy(contents, cloaker.detection_max_side)
+    return image_array, image_array.shape[0] / float(height), image_array.shape[1] / float(width)
+
+
+def _rescale_faces(faces: List[Dict], scale_y: float, scale_x: float, shape: Tuple[int, ...]) -> List[Dict]:
+    """
+    Map face boxes to an image of another resolution, clipped to its bounds.
+
+    Args:
+        faces: Face records; they are not modified
+        scale_y: Vertical scale from the faces' image to the target image
+        scale_x: Horizontal scale from the faces' image to the target image
+        shape: Shape of the target image
+
+    Returns:
+        New face records with rescaled locations
+    """
+    if scale_y == 1.0 and scale_x == 1.0:
+        return faces
+    height, width = shape[:2]
+    rescaled = []
+    for face in faces:
+        top, right, bottom, left = face['location']
+        location = (
+            max(int(top * scale_y), 0),
+            min(int(math.ceil(right * scale_x)), width),
+            min(int(math.ceil(bottom * scale_y)), height),
+            max(int(left * scale_x), 0),
+        )
+        rescaled.append({**face, 'location': location})
+    return rescaled
+
+
+def check_task(contents: bytes, faces: Optional[List[Dict]] = None,
+               exact_faces: Optional[List[Dict]] = None) -> Tuple[Dict[str, Any], List[Dict]]:
+    """
+    Decode an uploaded image and run the protection check inside a worker.
+
+    The check only detects and encodes faces, so JPEG images are decoded at
+    the resolution of the detection proxy instead of in full. Its faces stay
+    in proxy coordinates: they are never mixed with the exact full-resolution
+    faces the cloaking tasks cache.
+
+    Args:
+        contents: Raw bytes of the uploaded image
+        faces: Faces previously returned by this task for this image, if cached
+        exact_faces: Full-resolution faces found by the cloaking tasks, if cached;
+            downscaled to the proxy when faces is not given
+
+    Returns:
+        Protection analysis results from FaceCloaker.check_face_recognition
+        and the faces found in the image, with encodings, in proxy coordinates
+    """
+    cloaker = get_cloaker()
+    image_array, scale_y, scale_x = _decode_for_detection(cloaker, contents)
+    if faces is None and exact_faces is not None:
+        faces = _rescale_faces(exact_faces, scale_y, scale_x, image_array.shape)
+    if faces is None:
+        faces = cloaker.detect_faces(image_array)
+    else:
+        faces = cloaker.encode_faces(image_array, faces)
+    result = cloaker.check_face_recognition(image_array, faces=faces, gallery=get_gallery())
+    return result, faces
+
+
+def enroll_task(uploads: List[Tuple[str, bytes]]) -> List[Optional[np.ndarray]]:
+    """
+    Compute the gallery encodings of reference photos inside a worker.
+
+    Args:
+        uploads: (filename, raw bytes) pairs of the reference photos
+
+    Returns:
+        Per upload, the encoding of its largest face (None if no face was found
+        or the file could not be decoded)
+    """
+    cloaker = get_cloaker()
+    encodings = []
+    for filename, contents in uploads:
+        try:
+            faces = cloaker.detect_faces(_decode_for_detection(cloaker, contents)[0])
+        except Exception as e:
+            logger.error(f"Error decoding {filename}: {str(e)}")
+            faces = []
+        if not faces:
+            encodings.append(None)
+            continue
+        # A reference photo shows one person; smaller faces are bystanders
+        largest = max(faces, key=lambda face: (face['location'][2] - face['location'][0])
+                      * (face['location'][1] - face['location'][3]))
+        encodings.append(np.asarray(largest['encoding'], dtype=np.float32))
+    return encodings
+
+
+def cloak_verify_task(contents: bytes, faces: Optional[List[Dict]] = None, output_format: str = "png",
+                      compression: Optional[int] = None) -> Tuple[bytes, Dict[str, Any], List[Dict]]:
+    """
+    Decode, cloak, verify and encode an uploaded image inside a worker.
+
+    Args:
+        contents: Raw bytes of the uploaded image
+        faces: Previously detected faces of this image, if cached
+        output_format: Normalized output format, see image_io.encode_image
+        compression: Compression setting of the output format
+
+    Returns:
+        Encoded cloaked image, comparison results from FaceCloaker.cloak_and_verify
+        and the faces found in the original, with encodings
+    """
+    cloaker = get_cloaker()
+    image_array = decode_image(contents)
+    cloaked_image_array, comparison, faces = cloaker.cloak_and_verify(image_array, inplace=True, faces=faces)
+    return encode_image(cloaked_image_array, output_format, compression), comparison, faces
+
+
+def face_summaries(faces: List[Dict]) -> List[Dict[str, Any]]:
+    """JSON-ready face boxes and detection confidences of face records."""
+    return [{"location": [int(value) for value in face['location']], "confidence": float(face['confidence'])}
+            for face in faces]
+
+
+class _EventWriter:
+    """File object that puts what is written on an event channel, in chunks of at least chunk_bytes."""
+
+    def __init__(self, events: Any, chunk_bytes: int):
+        self.events = events
+        self.chunk_bytes = chunk_bytes
+        self.size = 0
+        self._buffer = bytearray()
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        self.size += len(data)
+        if len(self._buffer) >= self.chunk_bytes:
+            self.flush()
+        return len(data)
+
+    def flush(self) -> None:
+        if self._buffer:
+            self.events.put(bytes(self._buffer))
+            self._buffer.clear()
+
+
+def cloak_stream_task(contents: bytes, faces: Optional[List[Dict]], output_format: str,
+                      compression: Optional[int], events: Any, chunk_bytes: int = 256 * 1024) -> Tuple[int, List[Dict]]:
+    """
+    Decode, cloak and encode an uploaded image inside a worker, reporting progress as it goes.
+
+    Events put on the channel, in order: a "faces" event with the detected
+    face boxes, a "face" event as each face is cloaked, then the encoded
+    image as bytes chunks, and None once the task ends (also on errors).
+    PNG and JPEG chunks are sent while the encoder is still running.
+
+    Args:
+        contents: Raw bytes of the uploaded image
+        faces: Previously detected faces of this image, if cached
+        output_format: Normalized output format, see image_io.encode_image
+        compression: Compression setting of the output format
+        events: Sender of an EventChannel from CloakingExecutor.event_channel
+        chunk_bytes: Size of the encoded image chunks
+
+    Returns:
+        Size of the encoded image and the faces found in the original
+    """
+    try:
+        cloaker = get_cloaker()
+        image_array = decode_image(contents)
+        if faces is None:
+            faces = cloaker.detect_faces(image_array, with_encodings=False)
+        events.put({
+            "event": "faces",
+            "width": image_array.shape[1],
+            "height": image_array.shape[0],
+            "faces": face_summaries(faces),
+        })
+        cloaker.cloak_image(image_array, inplace=True, faces=faces,
+                            on_face=lambda index, _: events.put({"event": "face", "index": index, "total": len(faces)}))
+        writer = _EventWriter(events, chunk_bytes)
+        write_image(image_array, writer, output_format, compression)
+        writer.flush()
+        return writer.size, faces
+    finally:
+        events.put(None)
+
+
+def cloak_video_task(input_path: str, output_path: str) -> Dict[str, Any]:
+    """
+    Cloak a video file inside a worker, streaming frames to the output file.
+
+    Videos are passed by path so process workers never receive whole clips.
+
+    Args:
+        input_path: Uploaded video file
+        output_path: Path of the cloaked MP4 video
+
+    Returns:
+        Processing statistics from VideoCloaker.cloak_video
+    """
+    video_cloaker = VideoCloaker(
+        get_cloaker(),
+        keyframe_interval=config.VIDEO_KEYFRAME_INTERVAL,
+        scene_change_threshold=config.VIDEO_SCENE_THRESHOLD,
+    )
+    return video_cloaker.cloak_video(input_path, output_path)
+
+
+def cloak_large_task(input_path: str, output_path: str, compression: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Cloak a very large image file in tiled mode inside a worker.
+
+    Args:
+        input_path: Uploaded image file
+        output_path: Path of the cloaked PNG image
+        compression: PNG zlib level (defaults to the server setting)
+
+    Returns:
+        Processing statistics from TiledCloaker.cloak_file
+    """
+    tiled_cloaker = TiledCloaker(get_cloaker(), tile_size=config.TILE_SIZE, overlap=config.TILE_OVERLAP)
+    return tiled_cloaker.cloak_file(input_path, output_path,
+                                    config.PNG_COMPRESSION if compression is None else compression)
+
+
+class _LoopEvents:
+    """Sender side of an EventChannel for thread workers: hands events to the event loop."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, deliver: Callable[[Any], None]):
+        self.loop = loop
+        self.deliver = deliver
+
+    def put(self, event: Any) -> None:
+        try:
+            self.loop.call_soon_threadsafe(self.deliver, event)
+        except RuntimeError:
+            # The event loop is already closed (server shutdown)
+            pass
+
+
+class _PipeEvents:
+    """
+    Sender side of an EventChannel for process workers.
+
+    Bytes events are written into the channel's output segment while they
+    fit, and only their descriptors are sent through the pipe.
+    """
+
+    def __init__(self, connection: Connection, output: Optional[SharedSlice]):
+        self.connection = connection
+        self.output = output
+        self._writer: Optional[SharedWriter] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {"connection": self.connection, "output": self.output, "_writer": None}
+
+    def put(self, event: Any) -> None:
+        if isinstance(event, bytes) and self.output is not None:
+            if self._writer is None:
+                self._writer = SharedWriter(self.output)
+            event = self._writer.place(event) or event
+        elif event is None and self._writer is not None:
+            self._writer.close()
+        self.connection.send(event)
+
+
+class EventChannel:
+    """
+    Carries the progress events of a task in the worker pool to the event loop.
+
+    The task puts events on sender; the event loop awaits them with get(),
+    None marking the end of the stream. Thread workers hand events to the
+    loop with call_soon_threadsafe. Process workers send them through a pipe
+    that the loop reads whenever it becomes readable; with the shared memory
+    transport, bytes events travel through an output segment and the pipe
+    only carries their descriptors.
+
+    Pass worker_done as the task's on_done callback, and close the channel
+    once the events are no longer needed.
+    """
+
+    def __init__(self, mode: str, transport: Optional[SharedMemoryTransport] = None, output_bytes: int = 0):
+        """
+        Initialize the channel; call on the event loop.
+
+        Args:
+            mode: Worker mode of the pool running the task
+            transport: Shared memory transport of a process pool, if any
+            output_bytes: Expected size of the task's bytes events
+        """
+        self._loop = asyncio.get_running_loop()
+        self._events: asyncio.Queue = asyncio.Queue()
+        self._ended = False
+        self._transport = transport
+        self._lease: Optional[Lease] = None
+        self._holders = 0
+        self._reader: Optional[Connection] = None
+        self._writer: Optional[Connection] = None
+        if mode == "process":
+            self._reader, self._writer = multiprocessing.Pipe(duplex=False)
+            if transport is not None:
+                self._lease = transport.reserve(output_bytes)
+            self.sender: Any = _PipeEvents(self._writer, self._lease.output if self._lease is not None else None)
+            self._loop.add_reader(self._reader.fileno(), self._receive)
+        else:
+            self.sender = _LoopEvents(self._loop, self._deliver)
+
+    async def get(self) -> Any:
+        """Wait for the next event (None once the stream has ended)."""
+        return await self._events.get()
+
+    def end(self) -> None:
+        """End the stream early, e.g. when the task failed on the event loop's side."""
+        self._deliver(None)
+
+    def worker_done(self) -> None:
+        """Called once the worker is done with the task; no events arrive after it."""
+        if self._writer is not None:
+            # Everything the worker sent is already in the pipe
+            self._receive()
+            self._writer.close()
+            self._release()
+        self._deliver(None)
+
+    def close(self) -> None:
+        """Stop receiving events; a process worker still sending fails with a broken pipe."""
+        self._stop_reading()
+        self._release()
+
+    def _deliver(self, event: Any) -> None:
+        if self._ended:
+            return
+        self._events.put_nowait(event)
+        self._ended = event is None
+
+    def _receive(self) -> None:
+        try:
+            while self._reader is not None and self._reader.poll():
+                event = self._reader.recv()
+                if isinstance(event, SharedSlice):
+                    event = self._transport.receive(event, self._lease)
+                self._deliver(event)
+                if event is None:
+                    self._stop_reading()
+        except (EOFError, OSError):
+            # The worker went away without ending the stream
+            self._stop_reading()
+            self._deliver(None)
+
+    def _stop_reading(self) -> None:
+        if self._reader is not None:
+            self._loop.remove_reader(self._reader.fileno())
+            self._reader.close()
+            self._reader = None
+
+    def _release(self) -> None:
+        # The worker side and the loop side each release the lease once
+        if self._lease is not None and self._holders < 2:
+            self._holders += 1
+            self._lease.release()
+
+
+class CloakingExecutor:
+    """
+    Runs CPU-bound cloaking work off the asyncio event loop.
+
+    Work is dispatched to a thread pool or a process pool, each worker owning
+    its own FaceCloaker. The number of outstanding requests is bounded so a
+    burst of uploads is rejected early instead of piling up, and every request
+    is subject to a timeout. In process mode, image buffers can travel
+    through a shared memory transport instead of being pickled.
+    """
+
+    def __init__(self, mode: str = "thread", workers: Optional[int] = None,
+                 max_queue_depth: int = 16, timeout: Optional[float] = 120.0,
+                 transport: Optional[SharedMemoryTransport] = None):
+        """
+        Initialize the executor.
+
+        Args:
+            mode: "thread" for a thread pool or "process" for a process pool
+            workers: Number of pool workers (defaults to the number of cores)
+            max_queue_depth: Requests allowed to wait for a free worker
+            timeout: Seconds a request may take before it is abandoned
+            transport: Shared memory transport for the buffers of process workers
+                (ignored in thread mode, where workers share the buffers anyway)
+        """
+        if mode not in ("thread", "process"):
+            raise ValueError(f"Unknown worker mode: {mode}")
+        self.mode = mode
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue_depth = max_queue_depth
+        self.timeout = timeout
+        self.transport = transport if mode == "process" else None
+        self._executor: Optional[Executor] = None
+        self._outstanding = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of requests waiting for a free worker."""
+        return max(self._outstanding - self.workers, 0)
+
+    @property
+    def outstanding(self) -> int:
+        """Number of requests queued or running in the pool."""
+        return self._outstanding
+
+    def start(self) -> None:
+        """Create the worker pool."""
+        if self._executor is not None:
+            return
+        if self.mode == "process":
+            if self.transport is not None:
+                self.transport.start()
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cloaker",
+                                                initializer=_init_worker)
+        logger.info(f"Started {self.mode} worker pool with {self.workers} worker(s)")
+
+    async def warm_up(self) -> List[Dict[str, float]]:
+        """
+        Load the face models in the workers before traffic arrives.
+
+        Every worker owns its FaceCloaker (detector nets and scratch buffers
+        are not shared between threads), so each worker runs one warm-up. In
+        thread mode the warm-ups wait for each other, so each lands on its own
+        thread; the noise bank is shared by the threads of a process and only
+        built by the first of them.
+
+        Returns:
+            Warm-up reports of the workers
+        """
+        barrier = threading.Barrier(self.workers, timeout=self.timeout) if self.mode == "thread" else None
+        return list(await asyncio.gather(*(self.submit(warm_up_task, barrier) for _ in range(self.workers))))
+
+    def shutdown(self) -> None:
+        """Stop the worker pool, dropping requests that have not started yet."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self.transport is not None:
+            self.transport.close()
+
+    def event_channel(self, output_bytes: int = 0) -> EventChannel:
+        """
+        Create a channel that a task in this pool can put progress events on; call on the event loop.
+
+        Args:
+            output_bytes: Expected size of the task's bytes events, reserved
+                in shared memory when the transport is used
+
+        Returns:
+            The channel; pass its sender to the task and its worker_done as on_done
+        """
+        return EventChannel(self.mode, self.transport, output_bytes)
+
+    def _release(self, on_done: Optional[Callable[[], None]] = None) -> None:
+        self._outstanding -= 1
+        if on_done is not None:
+            on_done()
+
+    def _schedule_release(self, loop: asyncio.AbstractEventLoop, on_done: Optional[Callable[[], None]]) -> None:
+        try:
+            loop.call_soon_threadsafe(self._release, on_done)
+        except RuntimeError:
+            # The event loop is already closed (server shutdown)
+            pass
+
+    async def submit(self, fn: Callable[..., Any], *args: Any, timeout: Optional[float] = None,
+                     on_done: Optional[Callable[[], None]] = None, output_bytes: int = 0) -> Any:
+        """
+        Run a function in the worker pool and wait for its result.
+
+        Args:
+            fn: Module-level function to run (must be picklable in process mode)
+            *args: Arguments passed to the function
+            timeout: Seconds the call may take (defaults to the executor's timeout)
+            on_done: Called on the event loop once the worker has finished, even
+                after a timeout, or right away if the task is refused
+            output_bytes: Expected size of the encoded images in the result, reserved
+                in shared memory when the transport is used
+
+        Returns:
+            The function's return value
+
+        Raises:
+            QueueFullError: If too many requests are already outstanding
+            asyncio.TimeoutError: If the request exceeds the configured timeout
+        """
+        if self._executor is None:
+            self.start()
+        if self._outstanding >= self.workers + self.max_queue_depth:
+            if on_done is not None:
+                on_done()
+            raise QueueFullError("Too many requests are being processed, please retry shortly")
+
+        loop = asyncio.get_running_loop()
+        lease = None
+        if self.transport is not None:
+            args, lease = self.transport.send(args, output_bytes)
+            if lease is not None:
+                fn, args = shared_task, (lease.output, fn, *args)
+
+        def done() -> None:
+            if lease is not None:
+                lease.release()
+            if on_done is not None:
+                on_done()
+
+        self._outstanding += 1
+        try:
+            concurrent_future = self._executor.submit(fn, *args)
+        except Exception:
+            self._outstanding -= 1
+            if lease is not None:
+                lease.free()
+            if on_done is not None:
+                on_done()
+            raise
+        # The slot is only released once the worker is actually done, so a
+        # timed-out request that keeps running still counts against the bound.
+        concurrent_future.add_done_callback(lambda _future: self._schedule_release(loop, done))
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(concurrent_future),
+                                            self.timeout if timeout is None else timeout)
+            return result if lease is None else self.transport.receive(result, lease)
+        finally:
+            if lease is not None:
+                lease.release()
@@ -4,6 +4,7 @@ import ImageUpload from './components/ImageUpload';
 import ImageComparison from './components/ImageComparison';
 import ProtectionCheck from './components/ProtectionCheck';
 import LoadingSpinner from './components/LoadingSpinner';
+import { cloakImageStream, DetectedFace, STREAM_UNAVAILABLE } from './cloakStream';
 import './App.css';
 
 interface ProtectionResult {
@@ -14,12 +15,28 @@ interface ProtectionResult {
   message: string;
 }
 
+interface CloakProgress {
+  completed: number;
+  total: number;
+}
+
+const blobToDataUrl = (blob: Blob): Promise<string> =>
+  new Promise((resolve, reject) => {
+    const reader = new FileReader();
+    reader.onload = () => resolve(reader.result as string);
+    reader.onerror = () => reject(reader.error);
+    reader.readAsDataURL(blob);
+  });
+
 function App() {
   const [originalImage, setOriginalImage] = useState<string | null>(null);
   const [cloakedImage, setCloakedImage] = useState<string | null>(null);
   const [isProcessing, setIsProcessing] = useState(false);
   const [protectionResult, setProtectionResult] = useState<ProtectionResult | null>(null);
   const [error, setError] = useState<string | null>(null);
+  const [detectedFaces, setDetectedFaces] = useState<DetectedFace[] | null>(null);
+  const [cloakProgress, setCloakProgress] = useState<CloakProgress | null>(null);
+  const [bytesReceived, setBytesReceived] = useState(0);
 
   const API_BASE_URL = process.env.REACT_APP_API_URL || 'http://localhost:8000';
 
@@ -30,40 +47,68 @@ function App() {
         setOriginalImage(e.target.result as string);
         setCloakedImage(null);
         setProtectionResult(null);
+        setDetectedFaces(null);
         setError(null);
       }
     };
     reader.readAsDataURL(file);
   }, []);
 
+  const cloakWithUpload = async (blob: Blob): Promise<string | null> => {
+    // Create form data
+    const formData = new FormData();
+    formData.append('file', blob, 'image.png');
+
+    // Send to backend
+    const cloakResponse = await axios.post(
+      `${API_BASE_URL}/api/cloak-image`,
+      formData,
+      {
+        headers: {
+          'Content-Type': 'multipart/form-data',
+        },
+      }
+    );
+
+    return cloakResponse.data.success ? cloakResponse.data.cloaked_image : null;
+  };
+
   const handleCloakImage = async () => {
     if (!originalImage) return;
 
     setIsProcessing(true);
     setError(null);
+    setDetectedFaces(null);
+    setCloakProgress(null);
+    setBytesReceived(0);
 
     try {
       // Convert base64 to blob
       const response = await fetch(originalImage);
       const blob = await response.blob();
-      
-      // Create form data
-      const formData = new FormData();
-      formData.append('file', blob, 'image.png');
 
-      // Send to backend
-      const cloakResponse = await axios.post(
-        `${API_BASE_URL}/api/cloak-image`,
-        formData,
-        {
-          headers: {
-            'Content-Type': 'multipart/form-data',
+      // Stream the result so face boxes and progress show up while cloaking runs
+      let cloaked: string | null;
+      try {
+        const cloakedBlob = await cloakImageStream(API_BASE_URL, blob, {
+          onFaces: (faces) => {
+            setDetectedFaces(faces);
+            setCloakProgress({ completed: 0, total: faces.length });
           },
+          onFaceCloaked: (completed, total) => setCloakProgress({ completed, total }),
+          onImageBytes: setBytesReceived,
+        });
+        cloaked = await blobToDataUrl(cloakedBlob);
+      } catch (streamError) {
+        if (!(streamError instanceof Error) || streamError.name !== STREAM_UNAVAILABLE) {
+          throw streamError;
         }
-      );
+        // Servers without the streaming endpoint
+        cloaked = await cloakWithUpload(blob);
+      }
 
-      if (cloakResponse.data.success) {
-        setCloakedImage(cloakResponse.data.cloaked_image);
+      if (cloaked) {
+        setCloakedImage(cloaked);
       } else {
         setError('Failed to cloak image');
       }
@@ -72,6 +117,8 @@ function App() {
       setError('Error processing image. Please try again.');
     } finally {
       setIsProcessing(false);
+      setCloakProgress(null);
+      setBytesReceived(0);
     }
   };
 
@@ -135,10 +182,24 @@ function App() {
     }
   };
 
+  const progressMessage = (): string | undefined => {
+    if (bytesReceived > 0) {
+      return `Receiving cloaked image... ${(bytesReceived / (1024 * 1024)).toFixed(1)} MB`;
+    }
+    if (!cloakProgress) {
+      return undefined;
+    }
+    if (cloakProgress.total === 0) {
+      return 'No faces found, encoding image...';
+    }
+    return `Cloaked ${cloakProgress.completed} of ${cloakProgress.total} face(s)...`;
+  };
+
   const resetApp = () => {
     setOriginalImage(null);
     setCloakedImage(null);
     setProtectionResult(null);
+    setDetectedFaces(null);
     setError(null);
   };
 
@@ -196,6 +257,7 @@ function App() {
             <ImageComparison
               originalImage={originalImage}
               cloakedImage={cloakedImage}
+              detectedFaces={detectedFaces}
               onCloakImage={handleCloakImage}
               onDownloadCloaked={handleDownloadCloaked}
               isProcessing={isProcessing}
@@ -215,7 +277,7 @@ function App() {
         )}
 
         {/* Loading Overlay */}
-        {isProcessing && <LoadingSpinner />}
+        {isProcessing && <LoadingSpinner message={progressMessage()} />}
       </main>
 
       {/* Footer */}
@@ -0,0 +1,93 @@
+export interface DetectedFace {
+  // Face box in image pixels: top, right, bottom, left
+  location: [number, number, number, number];
+  confidence: number;
+}
+
+export interface CloakStreamHandlers {
+  onFaces: (faces: DetectedFace[]) => void;
+  onFaceCloaked: (completed: number, total: number) => void;
+  onImageBytes: (received: number) => void;
+}
+
+// Uploads are sent in slices, below the server's WebSocket message size limit
+const UPLOAD_SLICE_BYTES = 1024 * 1024;
+
+export const STREAM_UNAVAILABLE = 'StreamUnavailable';
+
+/**
+ * Cloak an image over the /ws/cloak WebSocket, reporting detected faces,
+ * cloaked faces and received image bytes as the server streams them.
+ *
+ * Rejects with an error named STREAM_UNAVAILABLE when the connection closes
+ * before the server sent anything, so callers can fall back to /api/cloak-image.
+ */
+export function cloakImageStream(
+  apiBaseUrl: string,
+  image: Blob,
+  handlers: CloakStreamHandlers
+): Promise<Blob> {
+  return new Promise((resolve, reject) => {
+    const socket = new WebSocket(`${apiBaseUrl.replace(/^http/, 'ws')}/ws/cloak`);
+    socket.binaryType = 'arraybuffer';
+
+    const chunks: ArrayBuffer[] = [];
+    let mediaType = 'image/png';
+    let received = 0;
+    let started = false;
+    let settled = false;
+
+    const fail = (error: Error) => {
+      if (!settled) {
+        settled = true;
+        reject(error);
+      }
+    };
+
+    socket.onopen = () => {
+      socket.send(JSON.stringify({ size: image.size }));
+      for (let offset = 0; offset < image.size; offset += UPLOAD_SLICE_BYTES) {
+        socket.send(image.slice(offset, offset + UPLOAD_SLICE_BYTES));
+      }
+    };
+
+    socket.onmessage = (message: MessageEvent) => {
+      started = true;
+      if (typeof message.data !== 'string') {
+        chunks.push(message.data);
+        received += message.data.byteLength;
+        handlers.onImageBytes(received);
+        return;
+      }
+
+      const event = JSON.parse(message.data);
+      switch (event.event) {
+        case 'faces':
+          handlers.onFaces(event.faces);
+          break;
+        case 'face':
+          handlers.onFaceCloaked(event.index + 1, event.total);
+          break;
+        case 'image':
+          mediaType = event.media_type;
+          break;
+        case 'done':
+          settled = true;
+          resolve(new Blob(chunks, { type: mediaType }));
+          socket.close();
+          break;
+        case 'error':
+          fail(new Error(event.detail));
+          break;
+      }
+    };
+
+    socket.onclose = () => {
+      const error = new Error(started ? 'Connection lost while cloaking' : 'Streaming endpoint unavailable');
+      if (!started) {
+        error.name = STREAM_UNAVAILABLE;
+      }
+      fail(error);
+    };
+  });
+}
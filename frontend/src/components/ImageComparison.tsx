@@ -1,8 +1,10 @@
-import React from 'react';
+import React, { useState } from 'react';
+import { DetectedFace } from '../cloakStream';
 
 interface ImageComparisonProps {
   originalImage: string;
   cloakedImage: string | null;
+  detectedFaces?: DetectedFace[] | null;
   onCloakImage: () => void;
   onDownloadCloaked: () => void;
   isProcessing: boolean;
@@ -11,10 +13,13 @@ interface ImageComparisonProps {
 const ImageComparison: React.FC<ImageComparisonProps> = ({
   originalImage,
   cloakedImage,
+  detectedFaces,
   onCloakImage,
   onDownloadCloaked,
   isProcessing,
 }) => {
+  const [naturalSize, setNaturalSize] = useState<{ width: number; height: number } | null>(null);
+
   return (
     <div className="bg-white rounded-xl shadow-lg p-6">
       <div className="text-center mb-6">
@@ -45,8 +50,37 @@ const ImageComparison: React.FC<ImageComparisonProps> = ({
               src={originalImage}
               alt="Original"
               className="w-full h-auto max-h-96 object-contain mx-auto"
+              onLoad={(e) =>
+                setNaturalSize({ width: e.currentTarget.naturalWidth, height: e.currentTarget.naturalHeight })
+              }
             />
+            {/* Face boxes, in image pixels; "meet" matches the object-contain layout */}
+            {detectedFaces && naturalSize && (
+              <svg
+                className="absolute inset-0 w-full h-full pointer-events-none"
+                viewBox={`0 0 ${naturalSize.width} ${naturalSize.height}`}
+                preserveAspectRatio="xMidYMid meet"
+              >
+                {detectedFaces.map(({ location: [top, right, bottom, left] }, index) => (
+                  <rect
+                    key={index}
+                    x={left}
+                    y={top}
+                    width={right - left}
+                    height={bottom - top}
+                    fill="none"
+                    stroke="#22c55e"
+                    strokeWidth={Math.max(naturalSize.width, naturalSize.height) / 250}
+                  />
+                ))}
+              </svg>
+            )}
           </div>
+          {detectedFaces && (
+            <p className="text-center text-sm text-secondary-600">
+              {detectedFaces.length} face(s) detected
+            </p>
+          )}
         </div>
 
         {/* Cloaked Image */}
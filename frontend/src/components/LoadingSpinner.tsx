@@ -1,6 +1,10 @@
 import React from 'react';
 
-const LoadingSpinner: React.FC = () => {
+interface LoadingSpinnerProps {
+  message?: string;
+}
+
+const LoadingSpinner: React.FC<LoadingSpinnerProps> = ({ message }) => {
   return (
     <div className="fixed inset-0 bg-black bg-opacity-50 flex items-center justify-center z-50">
       <div className="bg-white rounded-xl p-8 max-w-sm mx-4 text-center">
@@ -9,7 +13,7 @@ const LoadingSpinner: React.FC = () => {
           Processing Image
         </h3>
         <p className="text-secondary-600 text-sm">
-          Applying face cloaking technology...
+          {message || 'Applying face cloaking technology...'}
         </p>
         <div className="mt-4 text-xs text-secondary-500">
           This may take a few moments depending on image complexity